@@ -25,7 +25,8 @@ from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import User
 
 from races.apps.cabici.models import Club, RaceCourse, Race, STATUS_CHOICES
-from races.apps.cabici.usermodel import PointScore, Rider, RaceResult, ClubGrade, UserRole, ClubRole, RaceStaff, Membership
+from races.apps.cabici.usermodel import PointScore, Rider, RaceResult, ClubGrade, UserRole, ClubRole, RaceStaff, Membership, \
+    PointscoreJob
 
 admin.site.register(Club)
 
@@ -70,6 +71,12 @@ class PointScoreAdmin(admin.ModelAdmin):
 
 admin.site.register(PointScore, PointScoreAdmin)
 
+class PointscoreJobAdmin(admin.ModelAdmin):
+    list_display = ('pointscore', 'race', 'grades', 'status', 'requests', 'created', 'finished')
+    list_filter = ('status',)
+
+admin.site.register(PointscoreJob, PointscoreJobAdmin)
+
 class RaceCourseAdmin(admin.ModelAdmin):
     pass
 
@@ -104,6 +111,21 @@ admin.site.register(User, CabiciUserAdmin)
 
 
 class RaceResultAdmin(admin.ModelAdmin):
-    pass
+
+    # a repeat of the last upload for the race is no longer
+    # the same as what we have, so clear its hash
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        Race.objects.filter(pk=obj.race_id).update(results_hash='')
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        Race.objects.filter(pk=obj.race_id).update(results_hash='')
+
+    def delete_queryset(self, request, queryset):
+        races = list(queryset.values_list('race', flat=True).distinct())
+        super().delete_queryset(request, queryset)
+        Race.objects.filter(pk__in=races).update(results_hash='')
 
 admin.site.register(RaceResult, RaceResultAdmin)
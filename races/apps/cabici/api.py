@@ -27,13 +27,15 @@ from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.authtoken.models import Token
 from rest_framework.exceptions import APIException
 
-import os, json, time, datetime
+import json, datetime, hashlib
 from django.http import Http404
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate
-from django.db import IntegrityError
+from django.db import transaction
+from django.utils import timezone
 from django.conf import settings
 
+from .archive import get_archive
 from .models import Club, Race, RaceCourse
 from .usermodel import Rider, PointScore, RaceResult, RaceStaff, ClubRole, UserRole, ClubGrade, Membership
 
@@ -512,15 +514,26 @@ class PointScoreSerializer(serializers.HyperlinkedModelSerializer):
 
     def result_list(self, ps):
 
-        queryset = ps.tabulate()
+        # ?after_race=<id> gives the standings as they were after that race
+        request = self.context.get('request')
+        after_race = request.query_params.get('after_race') if request else None
+        if after_race:
+            try:
+                race = ps.races.get(pk=int(after_race))
+            except (ValueError, Race.DoesNotExist):
+                raise serializers.ValidationError({'after_race': 'Not a race in this pointscore'})
+            standings = ps.standings_after(race)
+        else:
+            standings = ps.table()
 
-        return [{'rider': " ".join((tally.rider.user.first_name, tally.rider.user.last_name)),
-                'riderid': tally.rider.user.id,
-                'club': tally.rider.club.slug if tally.rider.club else "Unknown",  # avoid crash if no club
-                'grade': tally.pointscore.club.grade(tally.rider),
-                'points': tally.points,
-                'eventcount': tally.eventcount}
-                for tally in queryset]
+        return [{'rider': standing.name,
+                'riderid': standing.userid,
+                'club': standing.club,
+                'grade': standing.grade,
+                'points': standing.points,
+                'eventcount': standing.eventcount,
+                'rank': standing.rank}
+                for standing in standings]
 
     class Meta:
         model = PointScore
@@ -599,27 +612,58 @@ class RaceResultList(generics.ListCreateAPIView):
         except Race.DoesNotExist:
             raise APIException("Invalid Race ID in JSON upload")
 
-        # stash the payload in a file for later analysis
+        # stash the payload for later analysis, it is written in the background
         if settings.SAVE_RESULT_UPLOADS:
-            if not os.path.exists(settings.SAVE_RESULT_UPLOADS_DIR):
-                os.makedirs(settings.SAVE_RESULT_UPLOADS_DIR)
-            filename = os.path.join(settings.SAVE_RESULT_UPLOADS_DIR, "{}-{}.json".format(race.id, time.time()))
-            with open(filename, 'w') as fd:
-                json.dump(data, fd, indent=2)
+            get_archive(settings.SAVE_RESULT_UPLOADS_DIR).submit(race.id, data)
+
+        # the desktop app often sends the same upload again, if nothing
+        # has changed since then there is nothing to do
+        digest = self.digest(data)
+        if race.results_hash == digest:
+            return Response({
+                            'message': 'race results uploaded',
+                            'errors': [],
+                            'ridermap': self.known_ridermap(data.get('riders', [])),
+                            })
 
         ridermap = {}  # will hold a mapping between temporary and real ids for riders
 
+        # look up all existing riders, clubs and current memberships
+        # referenced by rider records up front
+        records = data.get('riders', [])
+        existing = [record['id'] for record in records if not str(record['id']).startswith("ID")]
+        knownriders = Rider.objects.select_related('user').in_bulk(self.valid_ids(existing))
+        # new riders may be users we know already, matched by username
+        usernames = dict((record['id'], Rider.objects.make_username(record['first_name'],
+                                                                    record['last_name'],
+                                                                    str(record['licenceno'])))
+                         for record in records if str(record['id']).startswith("ID"))
+        knownusers = dict((user.username, user)
+                          for user in User.objects.filter(username__in=usernames.values()).select_related('rider'))
+        riderids = list(knownriders) + [user.rider.id for user in knownusers.values() if hasattr(user, 'rider')]
+        memberships = {}
+        for membership in Membership.objects.filter(rider__in=riderids).select_related('club').order_by('-date'):
+            memberships.setdefault(membership.rider_id, membership)
+        clubgrades = {}
+        for clubgrade in ClubGrade.objects.filter(club=race.club, rider__in=riderids):
+            clubgrades.setdefault(clubgrade.rider_id, clubgrade)
+        slugs = set(record['clubslug'] for record in records if 'clubslug' in record)
+        clubs = dict((club.slug, club) for club in Club.objects.filter(slug__in=slugs | {'Unknown'}))
+        newgrades = []
+        changedgrades = set()
+
         # handle new and updated riders
-        for record in data.get('riders', []):
+        for record in records:
             # new rider id starts with "ID"
             if str(record['id']).startswith("ID"):
                 # create a new rider record with these details
-                username = Rider.objects.make_username(record['first_name'],
-                                                       record['last_name'],
-                                                       str(record['licenceno']))
+                username = usernames[record['id']]
 
-                # just in case we know them already we use get_or_create
-                user, created = User.objects.get_or_create(username=username)
+                # just in case we know them already
+                user = knownusers.get(username)
+                created = user is None
+                if created:
+                    user = knownusers[username] = User(username=username)
                 # add user details
                 user.first_name = record['first_name']
                 user.last_name = record['last_name']
@@ -627,16 +671,16 @@ class RaceResultList(generics.ListCreateAPIView):
                     user.email = record['email']
                 user.save()
 
-                try:
-                    club = Club.objects.get(slug=record['clubslug'])
-                except Club.DoesNotExist:
+                if record['clubslug'] in clubs:
+                    club = clubs[record['clubslug']]
+                else:
                     messages.append("Unknown club '%s' in rider record ignored" % (record['clubslug']))
-                    club = Club.objects.get(slug='Unknown')
+                    club = clubs['Unknown']
 
                 if not created:
                     # guard against recreating the rider
                     rider = user.rider
-                    if not rider.club == club:
+                    if not rider.club_id == club.id:
                         rider.club = club
                         rider.save()
                 else:
@@ -647,23 +691,25 @@ class RaceResultList(generics.ListCreateAPIView):
                 if 'member_date' in record:
                     memberdate = datetime.date.fromisoformat(record['member_date'])
 
-                    current = rider.current_membership
+                    current = memberships.get(rider.id)
 
                     if not current:
-                        m = Membership(rider=rider,
-                                       club=rider.club,
-                                       date=memberdate,
-                                       category='race')
+                        m = memberships[rider.id] = Membership(rider=rider,
+                                                               club=club,
+                                                               date=memberdate,
+                                                               category='race')
                         m.save()
 
-                # grade
+                # grade, saved with the others after the loop
                 if 'grade' in record:
-                    cg = rider.clubgrade_set.filter(club=race.club)
+                    cg = clubgrades.get(rider.id)
                     if cg:
-                        cg[0].grade = record['grade']
-                        cg[0].save()
+                        cg.grade = record['grade']
+                        if cg.pk is not None:
+                            changedgrades.add(cg)
                     else:
-                        ClubGrade(rider=rider, club=race.club, grade=record['grade']).save()
+                        clubgrades[rider.id] = ClubGrade(rider=rider, club=race.club, grade=record['grade'])
+                        newgrades.append(clubgrades[rider.id])
 
                 if 'dob' in record:
                     # validate date format
@@ -683,19 +729,18 @@ class RaceResultList(generics.ListCreateAPIView):
                 ridermap[record['id']] = rider.id
             else:
                 # existing rider updated
-                try:
-                    rider = Rider.objects.get(id=record['id'])
-                except Rider.DoesNotExist:
+                rider = knownriders.get(self.valid_id(record['id']))
+                if rider is None:
                     messages.append("Ignored new rider record with unknown temporary rider ID (%s)" % record)
                     continue
 
                 # membership: club and date
                 if 'clubslug' in record:
-                    try:
-                        record['club'] = Club.objects.get(slug=record['clubslug'])
-                    except Club.DoesNotExist:
+                    if record['clubslug'] in clubs:
+                        record['club'] = clubs[record['clubslug']]
+                    else:
                         messages.append("Unknown club '%s' in rider record ignored" % (record['clubslug']))
-                        record['club'] = Club.objects.get(slug='Unknown')
+                        record['club'] = clubs['Unknown']
 
                 # try to parse the member date string
                 if 'member_date' in record:
@@ -704,7 +749,7 @@ class RaceResultList(generics.ListCreateAPIView):
                     except ValueError:
                         del record['member_date']
 
-                m = rider.current_membership
+                m = memberships.get(rider.id)
                 if m:
                     # update club if different
                     if 'club' in record and m.club != record['club']:
@@ -741,21 +786,87 @@ class RaceResultList(generics.ListCreateAPIView):
                     rider.user.last_name = record['last_name']
                     rider.user.save()
 
-        # handle entries, first remove any existing results for this race
-        # then create one result for each entry
-        entryfields = ['rider', 'grade']
+        ClubGrade.objects.bulk_create(newgrades)
+        ClubGrade.objects.bulk_update(changedgrades, ['grade'])
 
-        # count how many results we have already, if non zero we need to
-        # recalculate all of the pointscore, if zero we only need to do this one
-        previousresults = race.raceresult_set.all().count()
+        # handle entries, changing only the results that differ from
+        # those we have for this race
+        with transaction.atomic():
+            grades = self.save_entries(race, data.get('entries', []), ridermap, messages)
+            Race.objects.filter(pk=race.pk).update(results_hash=digest)
+
+        # once results are in place, we tally the pointscores for the grades
+        # that changed, replacing any points from a previous upload
+        if grades:
+            race.queue_pointscores(grades=grades)
+
+        return Response({
+                        'message': 'race results uploaded',
+                        'errors': messages,
+                        'ridermap': ridermap,
+                        })
+
+    def digest(self, data):
+        """A hash of the upload content that doesn't depend on key order"""
+
+        content = json.dumps(data, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def known_ridermap(self, records):
+        """The ridermap for new rider records that were created
+        by an earlier upload"""
+
+        usernames = {}
+        for record in records:
+            if str(record['id']).startswith("ID"):
+                username = Rider.objects.make_username(record['first_name'],
+                                                       record['last_name'],
+                                                       str(record['licenceno']))
+                usernames[username] = record['id']
 
-        race.raceresult_set.all().delete()
-        for entry in data.get('entries', []):
+        riders = Rider.objects.filter(user__username__in=list(usernames)).values_list('user__username', 'id')
+        return dict((usernames[username], riderid) for username, riderid in riders)
 
+    def valid_id(self, riderid):
+        """Return riderid as an integer, or None if it isn't one"""
+
+        try:
+            return int(riderid)
+        except (TypeError, ValueError):
+            return None
+
+    def valid_ids(self, riderids):
+        """The integer ids in riderids"""
+
+        return [i for i in map(self.valid_id, riderids) if i is not None]
+
+    def save_entries(self, race, entries, ridermap, messages):
+        """Make results for the entries in an upload, looking up
+        the riders and their grades for the race club together and
+        saving any new grades in bulk. Return the grades with
+        changed results, see update_results"""
+
+        entryfields = ['rider', 'grade']
+
+        for entry in entries:
             # ensure all required fields
             if not all([f in entry for f in entryfields]):
                 raise APIException("Missing fields in JSON entry")
 
+        riderids = [ridermap.get(entry['rider'], entry['rider']) for entry in entries]
+        riders = Rider.objects.in_bulk(self.valid_ids(riderids))
+        # the grade of each rider with the race club, the last one as
+        # with Rider.grades if there is more than one
+        grades = {}
+        for clubgrade in ClubGrade.objects.filter(club=race.club, rider__in=riders):
+            grades[clubgrade.rider_id] = clubgrade
+
+        results = []
+        newgrades = []
+        changed = set()
+        touched = set()
+        for entry in entries:
+
             if str(entry['rider']).startswith("ID"):
                 if entry['rider'] in ridermap:
                     entry['rider'] = ridermap[entry['rider']]
@@ -765,65 +876,104 @@ class RaceResultList(generics.ListCreateAPIView):
                     messages.append("Ignored result record with unknown temporary rider ID (%s/%s)" % (grade, number))
                     continue
 
-            try:
-                rider = Rider.objects.get(id=entry['rider'])
-            except Rider.DoesNotExist:
+            rider = riders.get(self.valid_id(entry['rider']))
+            if rider is None:
                 grade = entry.get('grade','Unknown')
                 number = entry.get('number', 'Unknown')
                 messages.append("Rider (id=%s) not found for result (%s/%s)" % (entry['rider'], grade, number))
                 continue
 
-            if race.club.slug in rider.grades:
-                usual_grade = rider.grades[race.club.slug]
+            if rider.id in grades:
+                usual_grade = grades[rider.id].grade
             else:
                 usual_grade = entry['grade']
                 # create a rider grade
-                ClubGrade(rider=rider, club=race.club, grade=usual_grade).save()
-                rider.save() # to trigger timestamp update
+                grades[rider.id] = ClubGrade(rider=rider, club=race.club, grade=usual_grade)
+                newgrades.append(grades[rider.id])
+                touched.add(rider.id)
 
             if not usual_grade == entry['grade'] and 'grade_change' in entry and entry['grade_change'] == 'y':
                 # update rider grade
-                grade = ClubGrade.objects.get(rider=rider, club=race.club)
-                grade.grade = entry['grade']
-                grade.save()
-                rider.save() # to trigger timestamp update
+                grades[rider.id].grade = entry['grade']
+                if grades[rider.id].pk is not None:
+                    changed.add(grades[rider.id])
+                touched.add(rider.id)
 
             if 'dnf' in entry and entry['dnf']:
                 dnf = True
             else:
                 dnf = False
 
-            result = RaceResult(rider=rider, race=race,
-                                grade=entry['grade'],
-                                number=entry.get('number', 999),
-                                usual_grade=usual_grade,
-                                place=entry.get('place', 0),
-                                dnf=dnf)
-            try:
-                result.save()
-            except IntegrityError:
-                # since we deleted all entries for this race at the start of the loop
-                # the most likely cause of this error is two upload requests running
-                # at the same time, so we just ignore this error assuming that
-                # the existing record is the same as this one
-                pass
-
-        # once results are in place, we tally the pointscores for this race
-        if previousresults > 0:
-            # need to recalculate pointscores since we've deleted results
-            for ps in race.pointscore_set.all():
-                ps.recalculate()
-        else:
-            # can just tally these results
-            race.tally_pointscores()
-
-        return Response({
-                        'message': 'race results uploaded',
-                        'errors': messages,
-                        'ridermap': ridermap,
-                        })
+            results.append(RaceResult(rider=rider, race=race,
+                                      grade=entry['grade'],
+                                      number=entry.get('number', 999),
+                                      usual_grade=usual_grade,
+                                      place=entry.get('place', 0),
+                                      dnf=dnf))
+
+        ClubGrade.objects.bulk_create(newgrades)
+        ClubGrade.objects.bulk_update(changed, ['grade'])
+        # to trigger timestamp update on riders with new grades
+        Rider.objects.filter(id__in=touched).update(updated=timezone.now())
+
+        return self.update_results(race, results)
+
+    def update_results(self, race, results):
+        """Make the stored results for the race match results,
+        inserting, updating and deleting only the rows that differ.
+        Return the set of grades with changed results."""
+
+        def value(name, result):
+            return RaceResult._meta.get_field(name).to_python(getattr(result, name))
+
+        existing = dict((result.rider_id, result) for result in race.raceresult_set.all())
+
+        grades = set()
+        create = []
+        update = []
+        riders = set()
+        numbers = set()
+        for result in results:
+            # a repeated entry or number, keep the first one
+            if result.rider_id in riders or (result.grade, value('number', result)) in numbers:
+                continue
+            riders.add(result.rider_id)
+            numbers.add((result.grade, value('number', result)))
+
+            old = existing.pop(result.rider_id, None)
+            if old is None:
+                create.append(result)
+                grades.add(result.grade)
+            elif old.grade != result.grade or old.number != value('number', result):
+                # the old row would clash with another result so replace it
+                existing[result.rider_id] = old
+                create.append(result)
+                grades.update([old.grade, result.grade])
+            elif any(getattr(old, name) != value(name, result) for name in ['usual_grade', 'place', 'dnf']):
+                result.pk = old.pk
+                update.append(result)
+                grades.add(result.grade)
+
+        # anything left over is not in this upload
+        grades.update(result.grade for result in existing.values())
+        RaceResult.objects.filter(pk__in=[result.pk for result in existing.values()]).delete()
+        RaceResult.objects.bulk_update(update, ['usual_grade', 'place', 'dnf'])
+        # a clash here is most likely two upload requests running at the
+        # same time, we keep the existing record assuming that it is the same
+        RaceResult.objects.bulk_create(create, ignore_conflicts=True)
+
+        return grades
 
 
 class RaceResultDetail(generics.RetrieveUpdateDestroyAPIView):
     queryset = RaceResult.objects.all()
     serializer_class = RaceResultSerializer
+
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        # so that repeating the last upload puts the result back
+        Race.objects.filter(pk=serializer.instance.race_id).update(results_hash='')
+
+    def perform_destroy(self, instance):
+        super().perform_destroy(instance)
+        Race.objects.filter(pk=instance.race_id).update(results_hash='')
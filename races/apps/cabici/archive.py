@@ -0,0 +1,151 @@
+"""
+Archive of results uploads
+
+When SAVE_RESULT_UPLOADS is set every JSON results upload is kept for
+later analysis. Uploads are handed to a background thread so that the
+request never waits for the disk. The thread appends each upload as
+a separate gzip member to an archive file for the day, eg.
+
+    uploads-2024-03-02.gz
+    uploads-2024-03-02.idx
+
+The index has one JSON line per upload giving the race, time, offset
+and length of the member in the archive so that the uploads for a race
+can be read back without decompressing everything, see
+UploadArchive.history.
+"""
+
+import atexit
+import datetime
+import fcntl
+import glob
+import gzip
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class UploadArchive:
+    """Rolling per-day archive of results uploads in a directory"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, raceid, data):
+        """Queue an upload to be written to the archive, the data
+        is serialised straight away since the caller may change it"""
+
+        content = json.dumps(data, separators=(',', ':'), default=str).encode('utf-8')
+        self.start()
+        self.queue.put((raceid, time.time(), content))
+
+    def start(self):
+        """Start the writer thread if it isn't running"""
+
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="upload-archive", daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            raceid, timestamp, content = self.queue.get()
+            try:
+                self.write(raceid, timestamp, content)
+            except Exception:
+                logger.exception("Failed to archive upload for race %s", raceid)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """Wait until all queued uploads are written"""
+
+        self.queue.join()
+
+    def paths(self, day):
+        """The archive and index file names for a date"""
+
+        name = os.path.join(self.directory, "uploads-%s" % day.isoformat())
+        return name + ".gz", name + ".idx"
+
+    def write(self, raceid, timestamp, content):
+        """Append one upload to the archive for its day"""
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+
+        archivename, indexname = self.paths(datetime.date.fromtimestamp(timestamp))
+        member = gzip.compress(content)
+
+        with open(archivename, 'ab') as archive:
+            # other processes may be writing to the same archive
+            fcntl.flock(archive, fcntl.LOCK_EX)
+            try:
+                offset = archive.seek(0, os.SEEK_END)
+                archive.write(member)
+                archive.flush()
+
+                entry = {'race': raceid, 'time': timestamp, 'offset': offset, 'length': len(member)}
+                with open(indexname, 'a') as index:
+                    index.write(json.dumps(entry) + "\n")
+            finally:
+                fcntl.flock(archive, fcntl.LOCK_UN)
+
+    def entries(self, raceid=None):
+        """The index entries for all uploads, or those for one race,
+        oldest first, each with the name of its archive file"""
+
+        entries = []
+        for indexname in glob.glob(os.path.join(self.directory, "uploads-*.idx")):
+            archivename = indexname[:-len(".idx")] + ".gz"
+            with open(indexname) as index:
+                for line in index:
+                    entry = json.loads(line)
+                    if raceid is None or entry['race'] == raceid:
+                        entry['archive'] = archivename
+                        entries.append(entry)
+
+        entries.sort(key=lambda entry: entry['time'])
+        return entries
+
+    def read(self, entry):
+        """The upload for an index entry"""
+
+        with open(entry['archive'], 'rb') as archive:
+            archive.seek(entry['offset'])
+            return json.loads(gzip.decompress(archive.read(entry['length'])))
+
+    def history(self, raceid):
+        """All uploads for a race, oldest first, as a list of
+        (datetime, data) pairs"""
+
+        return [(datetime.datetime.fromtimestamp(entry['time']), self.read(entry))
+                for entry in self.entries(raceid)]
+
+
+_archives = {}
+
+
+def get_archive(directory):
+    """The shared UploadArchive for a directory"""
+
+    if directory not in _archives:
+        _archives[directory] = UploadArchive(directory)
+    return _archives[directory]
+
+
+@atexit.register
+def flush_archives():
+    """Finish writing queued uploads before the process exits"""
+
+    for archive in list(_archives.values()):
+        if archive.thread is not None and archive.thread.is_alive():
+            archive.flush()
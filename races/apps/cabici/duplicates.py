@@ -0,0 +1,306 @@
+"""
+Finding and merging duplicate riders
+
+Riders are only compared with others that share a blocking key: the
+same normalised surname and first initial, the same licence number
+or the same date of birth and surname initial. Each block is small so
+the scan is close to linear in the number of riders. Pairs within a
+block are scored on how much of their details agree and pairs over a
+threshold are joined into groups, each with the rider to keep.
+
+merge_riders moves everything that refers to the other riders in a
+group to the rider being kept with one set based update per table.
+"""
+
+import csv
+import datetime
+import unicodedata
+from collections import defaultdict, namedtuple
+
+import ngram
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Count, Exists, OuterRef, Q
+
+from .models import Race
+from .usermodel import (Rider, ClubGrade, UserRole, PointScore, PointscoreJob, PointscoreTally,
+                        PointscoreRacePoints, PointscoreStanding)
+
+# the default date of birth, it doesn't tell us anything
+DEFAULT_DOB = datetime.date(1970, 1, 1)
+
+# blocks bigger than this are too common to be useful and are skipped
+MAX_BLOCK = 200
+
+# tables calculated from the results, they are recalculated after a merge
+DERIVED = [PointscoreTally, PointscoreRacePoints, PointscoreStanding]
+
+# fields that should be unique for a rider but aren't enforced by the database
+EXTRA_UNIQUE = {ClubGrade: [('club',)]}
+
+DuplicateGroup = namedtuple('DuplicateGroup', ['keep', 'riders', 'pairs'])
+
+
+def normalise(text):
+    """Lower case letters and digits only, without accents"""
+
+    text = unicodedata.normalize('NFKD', text or '')
+    return ''.join(c for c in text.lower() if c.isalnum() and c.isascii())
+
+
+def useful_licence(licenceno):
+    """The normalised licence number if it identifies a rider"""
+
+    licence = normalise(licenceno)
+    if licence.strip('0') == '':
+        return ''
+    return licence
+
+
+def load_riders(queryset=None):
+    """The details used to compare riders, keyed by rider id"""
+
+    if queryset is None:
+        queryset = Rider.objects.all()
+
+    rows = queryset.order_by().annotate(results=Count('raceresult')).values_list(
+        'id', 'user_id', 'user__first_name', 'user__last_name', 'user__email', 'licenceno', 'dob', 'club_id', 'results',
+        named=True)
+    return dict((row.id, row) for row in rows)
+
+
+def blocks(riders):
+    """Group rider ids by blocking key, return the blocks with more
+    than one rider and the keys of blocks that were too big"""
+
+    found = defaultdict(list)
+    for rider in riders.values():
+        surname = normalise(rider.user__last_name)
+        first = normalise(rider.user__first_name)
+        if surname:
+            found[('name', surname, first[:1])].append(rider.id)
+        licence = useful_licence(rider.licenceno)
+        if licence:
+            found[('licence', licence)].append(rider.id)
+        if rider.dob and rider.dob != DEFAULT_DOB:
+            found[('dob', rider.dob, surname[:1])].append(rider.id)
+
+    result = []
+    skipped = []
+    for key, ids in found.items():
+        if len(ids) > MAX_BLOCK:
+            skipped.append(key)
+        elif len(ids) > 1:
+            result.append(ids)
+    return result, skipped
+
+
+def score(a, b):
+    """How likely it is that two riders are the same person,
+    return a score and a list of the reasons for it"""
+
+    total = 0
+    reasons = []
+
+    def add(points, reason):
+        nonlocal total
+        total += points
+        reasons.append(reason)
+
+    if normalise(a.user__last_name) and normalise(a.user__last_name) == normalise(b.user__last_name):
+        add(0.25, 'surname')
+
+    similarity = ngram.NGram.compare(normalise(a.user__first_name), normalise(b.user__first_name))
+    if similarity and similarity >= 0.5:
+        add(round(0.35 * similarity, 2), 'first name')
+
+    licence_a, licence_b = useful_licence(a.licenceno), useful_licence(b.licenceno)
+    if licence_a and licence_b:
+        if licence_a == licence_b:
+            add(0.5, 'licence')
+        else:
+            add(-0.3, 'different licence')
+
+    if a.dob and b.dob and DEFAULT_DOB not in (a.dob, b.dob):
+        if a.dob == b.dob:
+            add(0.3, 'dob')
+        else:
+            add(-0.3, 'different dob')
+
+    if a.user__email and a.user__email.lower() == b.user__email.lower():
+        add(0.3, 'email')
+
+    if a.club_id and a.club_id == b.club_id:
+        add(0.1, 'club')
+
+    return round(total, 2), reasons
+
+
+def choose_keep(riders):
+    """The rider to keep from a group, one with a licence number
+    and the most results, the oldest record if that's a tie"""
+
+    return max(riders, key=lambda rider: (bool(useful_licence(rider.licenceno)), rider.results, -rider.id))
+
+
+def find_duplicates(threshold=0.6, queryset=None):
+    """Find groups of riders that are probably the same person,
+    return a list of DuplicateGroup and the list of blocks skipped
+    because they were too big"""
+
+    riders = load_riders(queryset)
+    found, skipped = blocks(riders)
+
+    pairs = {}
+    for ids in found:
+        ids = sorted(ids)
+        for i, a in enumerate(ids):
+            for b in ids[i + 1:]:
+                if (a, b) not in pairs:
+                    pairs[(a, b)] = score(riders[a], riders[b])
+
+    # join pairs over the threshold into groups
+    parent = {}
+
+    def root(rider_id):
+        while parent.get(rider_id, rider_id) != rider_id:
+            rider_id = parent[rider_id]
+        return rider_id
+
+    matched = set()
+    for (a, b), (points, reasons) in pairs.items():
+        if points >= threshold:
+            parent[root(b)] = root(a)
+            matched.update((a, b))
+
+    members = defaultdict(list)
+    for rider_id in matched:
+        members[root(rider_id)].append(rider_id)
+
+    groups = []
+    for ids in members.values():
+        ids = set(ids)
+        group = [riders[rider_id] for rider_id in sorted(ids)]
+        scores = dict((pair, result) for pair, result in pairs.items()
+                      if pair[0] in ids and pair[1] in ids and result[0] >= threshold)
+        groups.append(DuplicateGroup(choose_keep(group), group, scores))
+
+    groups.sort(key=lambda group: group.keep.id)
+    return groups, skipped
+
+
+REPORT_FIELDS = ['group', 'action', 'rider', 'user', 'first_name', 'last_name', 'email',
+                 'licenceno', 'dob', 'club', 'results', 'score', 'reasons']
+
+
+def write_report(groups, fd):
+    """Write a CSV report of duplicate groups for review. Each
+    rider is marked keep or merge, changing merge to skip
+    leaves that rider out when the report is applied"""
+
+    writer = csv.DictWriter(fd, fieldnames=REPORT_FIELDS)
+    writer.writeheader()
+    for n, group in enumerate(groups, 1):
+        for rider in group.riders:
+            best = max([result for pair, result in group.pairs.items() if rider.id in pair],
+                       key=lambda result: result[0], default=(0, []))
+            writer.writerow({'group': n,
+                             'action': 'keep' if rider.id == group.keep.id else 'merge',
+                             'rider': rider.id,
+                             'user': rider.user_id,
+                             'first_name': rider.user__first_name,
+                             'last_name': rider.user__last_name,
+                             'email': rider.user__email,
+                             'licenceno': rider.licenceno,
+                             'dob': rider.dob,
+                             'club': rider.club_id or '',
+                             'results': rider.results,
+                             'score': best[0],
+                             'reasons': ' '.join(best[1])})
+
+
+def read_report(fd):
+    """Read a reviewed report, return a list of (keep, [merge ids])"""
+
+    groups = defaultdict(lambda: [None, []])
+    for row in csv.DictReader(fd):
+        if row['action'] == 'keep':
+            groups[row['group']][0] = int(row['rider'])
+        elif row['action'] == 'merge':
+            groups[row['group']][1].append(int(row['rider']))
+
+    return [(keep, merge) for keep, merge in groups.values() if keep is not None and merge]
+
+
+def rider_relations():
+    """The models with a foreign key to Rider, with the sets of
+    other fields that must be unique together with the rider"""
+
+    for relation in Rider._meta.related_objects:
+        if not relation.one_to_many:
+            continue
+        model = relation.related_model
+        name = relation.field.name
+
+        uniques = [tuple(f for f in fields if f != name)
+                   for fields in model._meta.unique_together if name in fields]
+        uniques.extend(EXTRA_UNIQUE.get(model, []))
+
+        yield model, name, uniques
+
+
+@transaction.atomic
+def merge_riders(keep, merge):
+    """Merge riders into the rider keep, everything that refers to them
+    is moved to keep and then they are deleted with their user records.
+    Rows that would duplicate one that keep already has are dropped.
+    Pointscores they were in are queued to be recalculated.
+    Return a dictionary of the number of rows moved for each model."""
+
+    merge = [rider for rider in merge if rider.pk != keep.pk]
+    moved = defaultdict(int)
+
+    pointscores = set(PointscoreTally.objects.filter(rider__in=merge).values_list('pointscore', flat=True))
+    for model in DERIVED:
+        model.objects.filter(rider__in=merge).delete()
+
+    # results are moved with update, which doesn't send signals
+    Race.objects.filter(raceresult__rider__in=merge).exclude(results_hash='').update(results_hash='')
+
+    for model, name, uniques in rider_relations():
+        if model in DERIVED:
+            continue
+        rows = model.objects.filter(**{name + '__in': merge})
+        for fields in uniques:
+            # a row clashes with one keep has or with an earlier row of another merged rider
+            same = dict((f, OuterRef(f)) for f in fields)
+            clash = model.objects.filter(Q(**{name: keep}) | Q(**{name + '__in': merge, 'pk__lt': OuterRef('pk')}), **same)
+            rows.filter(Exists(clash)).delete()
+        moved[model.__name__] += rows.update(**{name: keep})
+
+    # roles belong to the user
+    users = [rider.user_id for rider in merge]
+    roles = UserRole.objects.filter(user__in=users)
+    clash = UserRole.objects.filter(Q(user=keep.user_id) | Q(user__in=users, pk__lt=OuterRef('pk')),
+                                    club=OuterRef('club'), role=OuterRef('role'))
+    roles.filter(Exists(clash)).delete()
+    moved['UserRole'] += roles.update(user=keep.user_id)
+
+    # fill in details that keep doesn't have
+    for rider in merge:
+        if not useful_licence(keep.licenceno) and useful_licence(rider.licenceno):
+            keep.licenceno = rider.licenceno
+        if keep.dob in (None, DEFAULT_DOB) and rider.dob not in (None, DEFAULT_DOB):
+            keep.dob = rider.dob
+        if not keep.user.email and rider.user.email:
+            keep.user.email = rider.user.email
+            keep.user.save(update_fields=['email'])
+
+    # deleting the users deletes the riders
+    User.objects.filter(rider__in=merge).delete()
+    keep.save()
+
+    for ps in PointScore.objects.filter(pk__in=pointscores):
+        PointscoreJob.objects.queue(ps)
+
+    return dict(moved)
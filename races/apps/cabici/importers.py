@@ -0,0 +1,348 @@
+"""
+Staged import of race results from a spreadsheet
+
+Race.load_excel_results used to look up and save riders, grades,
+memberships and results one row at a time. RaceResultsImport works
+in stages instead: everything a batch of rows refers to is loaded in
+a few queries, each row is resolved in memory in the order of the
+spreadsheet and the changes are then written in bulk. All batches
+are saved in one transaction.
+
+Uploads are read with SpreadsheetReader which streams the rows in
+chunks so that large files are imported in batches of bounded size
+rather than being loaded into memory all at once.
+"""
+
+import csv
+import datetime
+import itertools
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+import pyexcel
+
+from .models import Club
+from .usermodel import Rider, RaceResult, Membership, ClubGrade
+
+CHUNKSIZE = 500
+
+
+class SpreadsheetError(ValueError):
+    """An uploaded spreadsheet can't be read or is missing columns,
+    missing is the list of required columns not found"""
+
+    def __init__(self, message, missing=()):
+        super().__init__(message)
+        self.missing = list(missing)
+
+
+class SpreadsheetReader:
+    """Read the rows of an xls, xlsx or csv file as dictionaries
+    keyed by the header row, iterating gives lists of at most
+    chunksize rows.
+
+    The first row is read when the reader is created so that a file
+    without the required columns is rejected before any work is done.
+    """
+
+    def __init__(self, fd, file_type, required=(), chunksize=None, encoding='utf-8'):
+        self.file_type = file_type
+        self.chunksize = chunksize or CHUNKSIZE
+
+        if file_type == 'csv':
+            # csv values are kept as strings, lines might be bytes from an upload
+            lines = (line.decode(encoding) if isinstance(line, bytes) else line for line in fd)
+            self.rows = csv.DictReader(lines)
+        else:
+            self.rows = pyexcel.iget_records(file_stream=fd, file_type=file_type)
+
+        try:
+            self.first = next(iter(self.rows), None)
+            if file_type == 'csv':
+                self.headers = self.rows.fieldnames or []
+            elif self.first is not None:
+                self.headers = list(self.first.keys())
+            else:
+                self.headers = []
+        except Exception:
+            self.close()
+            raise SpreadsheetError('Error reading uploaded file, please check the file format.')
+
+        self.missing = [name for name in required if name not in self.headers]
+        if self.missing:
+            self.close()
+            raise SpreadsheetError('Error in spreadsheet format, required columns missing.', self.missing)
+
+    def __iter__(self):
+        rows = self.rows
+        if self.first is not None:
+            rows = itertools.chain([self.first], rows)
+            self.first = None
+
+        try:
+            chunk = []
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) == self.chunksize:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        """Release the file handles held by pyexcel"""
+
+        if self.file_type != 'csv':
+            pyexcel.free_resources()
+
+
+def key(obj):
+    """A key for a model instance that works before it is saved"""
+
+    if obj.pk is None:
+        return ('new', id(obj))
+    return obj.pk
+
+
+class RaceResultsImport:
+    """Import the rows of a results spreadsheet into a race"""
+
+    def __init__(self, race):
+        self.race = race
+        self.endofyear = datetime.date(day=31, month=12, year=datetime.date.today().year)
+
+        # bib numbers and riders with a result so far
+        self.numbers = set()
+        self.entered = set()
+        # (rider, club) of the race memberships we know about
+        self.memberships = set()
+
+        self.clear()
+
+    def clear(self):
+        """Forget the changes for a batch once they are saved"""
+
+        self.newusers = []
+        self.changedusers = {}
+        self.newriders = []
+        self.changedriders = {}
+        self.newmemberships = []
+        self.newgrades = []
+        self.changedgrades = {}
+        self.results = []
+
+    def load(self, chunks):
+        """Import lists of rows replacing any results for the race,
+        each list is resolved and saved as a batch, then places in
+        small grades are fixed, return a list of messages for the user"""
+
+        messages = []
+        with transaction.atomic():
+            RaceResult.objects.filter(race=self.race).delete()
+
+            for rows in chunks:
+                self.prefetch(rows)
+
+                for row in rows:
+                    message = self.resolve(row)
+                    if message != []:
+                        messages.append('\n'.join(message))
+
+                self.save()
+
+            # places are only right once we know the size of each grade
+            self.race.fix_small_races()
+
+        return messages
+
+    def username(self, row):
+        return Rider.objects.make_username(row['FirstName'], row['LastName'], str(row['LicenceNo']))
+
+    def prefetch(self, rows):
+        """Load the riders, users, clubs, grades and memberships
+        referred to by the rows"""
+
+        newrows = [row for row in rows if type(row['Id']) != int]
+
+        self.riders = Rider.objects.select_related('user', 'club').in_bulk(
+            [row['Id'] for row in rows if type(row['Id']) == int])
+
+        # riders not in the spreadsheet might still be known to us
+        self.users = {}
+        usernames = set(self.username(row) for row in newrows)
+        for user in User.objects.filter(username__in=usernames).select_related('rider__club'):
+            self.users[(user.username, user.first_name, user.last_name)] = user
+
+        self.clubs = Club.objects.closest_many([row['Club'] for row in newrows])
+
+        riderids = list(self.riders)
+        for user in self.users.values():
+            if hasattr(user, 'rider'):
+                riderids.append(user.rider.id)
+
+        self.grades = {}
+        for grading in ClubGrade.objects.filter(club=self.race.club, rider__in=riderids):
+            self.grades[grading.rider_id] = grading
+
+        self.memberships.update(Membership.objects.filter(rider__in=riderids,
+                                                          date=self.endofyear,
+                                                          category='race').values_list('rider_id', 'club_id'))
+
+    def resolve(self, row):
+        """Work out the changes needed for one row, return a list
+        of messages about the row"""
+
+        message = []
+
+        if type(row['Id']) != int:
+            # this should be a new rider, but it could be someone we know who
+            # wasn't in the spreadsheet
+            username = self.username(row)
+
+            user = self.users.get((username, row['FirstName'], row['LastName']))
+            created = user is None
+            if created:
+                user = User(username=username, first_name=row['FirstName'], last_name=row['LastName'])
+                self.users[(username, row['FirstName'], row['LastName'])] = user
+                self.newusers.append(user)
+
+            if row['Email'] != '':
+                user.email = row['Email']
+                if user.pk is not None:
+                    self.changedusers[user.pk] = user
+
+            club = self.clubs[row['Club']]
+            if created:
+                # make the rider record
+                rider = Rider(licenceno=row['LicenceNo'], club=club, user=user)
+                self.newriders.append(rider)
+                message.append('Added new rider record for %s %s' % (row['FirstName'], row['LastName']))
+            else:
+                # we didn't find this person by licence number so set it if we have it
+                rider = user.rider
+                if row['LicenceNo'] != '':
+                    rider.licenceno = str(row['LicenceNo'])
+                    message.append('Updated Licence Number to %s' % (row['LicenceNo'],))
+                if club.slug != 'Unknown':
+                    rider.club = club
+                    message.append('Updated Club to %s' % (club.slug,))
+                self.changed_rider(rider)
+        else:
+            rider = self.riders.get(row['Id'])
+            if rider is None:
+                return ["Rider Id '%s' not found in database " % row['Id']]
+
+            # validate a bit
+            if row['LastName'] != rider.user.last_name:
+                return ["Rider with Id %s has wrong last name, expected %s but found %s." % (row['Id'], rider.user.last_name, row['LastName'])]
+
+        # ok, we now have our rider, either existing or new
+
+        # update licenceno if we didn't know it before
+        if rider.licenceno == '0' and row['LicenceNo'] != '0':
+            rider.licenceno = row['LicenceNo']
+            self.changed_rider(rider)
+            message.append("Updated licence number for %s %s to %s" % (rider.user.first_name, rider.user.last_name, rider.licenceno))
+
+        # we know that this rider is a current member of their club if the Regd field is R
+        if row['Regd'] == 'R':
+            membership = (key(rider), rider.club.pk if rider.club else None)
+            if membership not in self.memberships:
+                self.memberships.add(membership)
+                self.newmemberships.append(Membership(rider=rider, club=rider.club, date=self.endofyear, category='race'))
+                message.append('Updated membership of rider %s of club %s to %s' % (str(rider), rider.club.slug, self.endofyear))
+
+        # deal with grades
+        grading = self.grades.get(key(rider))
+        if grading is None:
+            # allocate the grade they raced this time
+            grading = ClubGrade(club=self.race.club, rider=rider, grade=row['Grade'])
+            self.grades[key(rider)] = grading
+            self.newgrades.append(grading)
+
+        usual_grade = grading.grade
+
+        # a grade ending in P means the rider is being permanently re-graded
+        # so we should change their recorded grade
+        if row['Grade'].endswith('P'):
+            # get the real grade for the result
+            row['Grade'] = row['Grade'][0]
+            grading.grade = row['Grade']
+            if grading.pk is not None:
+                self.changedgrades[grading.pk] = grading
+            message.append('Updated grade of %s to %s' % (str(rider), grading.grade))
+        elif not row['Grade'] == usual_grade:
+            message.append('%s rode in grade %s but is usually %s grade' % (str(rider), row['Grade'], usual_grade))
+
+        # work out place from points - actually need to account for small grades (E, F)
+        points = int(row['Points'])
+        if points == 2:
+            place = 0
+        elif points > 0:
+            place = 8-points
+        else:
+            place = 0
+
+        if row['ShirtNo'] == '':
+            shirtno = 0
+        else:
+            shirtno = int(row['ShirtNo'])
+
+        # special case of number 999 indicates a helper, change the 'grade'
+        if shirtno == 999:
+            row['Grade'] = "Helper"
+            message.append('%s recorded as a Helper' % (str(rider),))
+
+        # check for duplicate race number
+        while shirtno in self.numbers:
+            shirtno = shirtno + 200
+
+        # check for duplicate race/rider
+        if key(rider) in self.entered:
+            # not much we can do here
+            message.append("Error: duplicate result discarded for rider %s" % (str(rider)))
+        else:
+            self.numbers.add(shirtno)
+            self.entered.add(key(rider))
+            self.results.append(RaceResult(rider=rider, race=self.race, place=place,
+                                           usual_grade=usual_grade, grade=row['Grade'],
+                                           number=shirtno))
+
+        return message
+
+    def changed_rider(self, rider):
+        """Remember that an existing rider needs to be saved"""
+
+        if rider.pk is not None:
+            self.changedriders[rider.pk] = rider
+
+    def save(self):
+        """Write the changes for a batch, new records are created in bulk"""
+
+        User.objects.bulk_create(self.newusers)
+        User.objects.bulk_update(self.changedusers.values(), ['email'])
+
+        Rider.objects.bulk_create(self.newriders)
+        now = timezone.now()
+        for rider in self.changedriders.values():
+            rider.updated = now
+        Rider.objects.bulk_update(self.changedriders.values(), ['licenceno', 'club', 'updated'])
+
+        Membership.objects.bulk_create(self.newmemberships)
+
+        ClubGrade.objects.bulk_create(self.newgrades)
+        ClubGrade.objects.bulk_update(self.changedgrades.values(), ['grade'])
+
+        RaceResult.objects.bulk_create(self.results)
+
+        # new riders now have an id that later batches will find them by,
+        # the id() of an unsaved rider may be reused once it is freed
+        self.entered = set(k for k in self.entered if not isinstance(k, tuple))
+        self.entered.update(result.rider.pk for result in self.results)
+        self.memberships = set(m for m in self.memberships if not isinstance(m[0], tuple))
+        self.memberships.update((m.rider.pk, m.club.pk if m.club else None) for m in self.newmemberships)
+
+        self.clear()
@@ -0,0 +1,112 @@
+"""
+Concurrent race ingest
+
+Fetching a club's calendar or web page is slow and the clubs are
+independent, so the fetches run in a pool of threads. Each fetch only
+downloads and parses, it doesn't touch the database; the races found
+are saved in the calling thread as each fetch finishes, so saving one
+club's races overlaps with fetching the others.
+
+When fetch is given a cache and only_changed, sources that haven't
+changed since the last run are not parsed or saved at all. Calendar
+events outside a window of dates, by default today until about 18
+months ahead, are skipped before they are parsed. Each club gets its
+own session of the cache that is only committed once its races are
+saved without errors, so a source that failed is read again next run.
+
+Each club's source in races.ingest.registry has a fetch interval, with
+due_only clubs fetched more recently than that, or with no source at
+all, are left out. Club.ingested records when each club was last
+fetched without errors.
+"""
+
+import concurrent.futures
+import datetime
+import time
+from collections import namedtuple
+
+from django.utils import timezone
+
+from races.ingest import registry
+from races.ingest.fetch import NotModified
+
+WORKERS = 4
+
+# days before and after today to read calendar events for
+DAYS_BEFORE = 0
+DAYS_AFTER = 548
+
+# the outcome of ingesting one club, fetch and save are times in seconds
+IngestResult = namedtuple('IngestResult', ['club', 'found', 'races', 'errors', 'unchanged', 'fetch', 'save'])
+
+
+def date_window(before=DAYS_BEFORE, after=DAYS_AFTER, today=None):
+    """The pair of dates from before days ago until after days ahead"""
+
+    today = today or datetime.date.today()
+    return (today - datetime.timedelta(days=before), today + datetime.timedelta(days=after))
+
+
+def due_clubs(clubs, now=None):
+    """The clubs that have a source that is due to be fetched"""
+
+    now = now or timezone.now()
+    due = []
+    for club in clubs:
+        source = registry.source_for(club)
+        if source is not None and source.is_due(club.ingested, now):
+            due.append(club)
+    return due
+
+
+def fetch_club(club, options):
+    """Fetch the races for a club in a worker thread,
+    return (racedicts, errors, unchanged, seconds)"""
+
+    start = time.perf_counter()
+    unchanged = False
+    try:
+        racedicts, error = club.fetch_races(**options)
+        errors = [error] if error else []
+    except NotModified:
+        racedicts, errors, unchanged = [], [], True
+    except Exception as e:
+        racedicts, errors = [], ["%s: %s" % (type(e).__name__, e)]
+    return racedicts, errors, unchanged, time.perf_counter() - start
+
+
+def ingest_clubs(clubs, workers=WORKERS, due_only=False, **options):
+    """Ingest races for a list of clubs, fetching up to workers
+    sources at once, if due_only just the clubs that are due.
+    Options are passed on to Club.fetch_races, eg. a date window,
+    timeouts and retries. Yield an IngestResult for each club as
+    it finishes."""
+
+    if due_only:
+        clubs = due_clubs(clubs)
+
+    cache = options.pop('cache', None)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {}
+        for club in clubs:
+            session = cache.session() if cache is not None else None
+            future = executor.submit(fetch_club, club, dict(options, cache=session))
+            futures[future] = (club, session)
+
+        for future in concurrent.futures.as_completed(futures):
+            club, session = futures[future]
+            racedicts, errors, unchanged, fetched = future.result()
+
+            start = time.perf_counter()
+            races = []
+            if racedicts:
+                races, save_errors = club.ingest_race_list(racedicts)
+                errors.extend(save_errors)
+            if not errors:
+                if session is not None:
+                    session.commit()
+                club.ingested = timezone.now()
+                club.save(update_fields=['ingested'])
+
+            yield IngestResult(club, len(racedicts), races, errors, unchanged, fetched, time.perf_counter() - start)
@@ -0,0 +1,212 @@
+#!/usr/bin/python
+#
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Benchmark the pointscore engine on a generated season.
+
+A season of the requested size is generated inside a transaction,
+each operation is timed and its queries counted, then everything is
+rolled back so nothing is left in the database. Use --output to write
+the results as JSON so that runs can be compared between commits.
+'''
+
+import datetime
+import json
+import random
+import statistics
+import subprocess
+import time
+
+from django.contrib.auth.models import User, AnonymousUser
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from races.apps.cabici.api import PointScoreSerializer
+from races.apps.cabici.models import Club, Race, RaceCourse
+from races.apps.cabici.usermodel import Rider, RaceResult, ClubGrade, ClubRole, RaceStaff, PointScore
+from races.apps.cabici.views import ClubPointscoreAuditView
+
+GRADES = 'ABCDEFGH'
+
+
+def generate_season(clubs=2, riders=400, races=20, grades=4, helpers=2, seed=None):
+    """Generate a season of races with results for each club and a
+    pointscore for each club containing its races.
+    Return the pointscores and a dictionary with the number of
+    objects created."""
+
+    rand = random.Random(seed)
+    grades = GRADES[:grades]
+    today = datetime.date.today()
+
+    course = RaceCourse.objects.create(name="Benchmark Course", location="-33.8,151.2")
+    role, created = ClubRole.objects.get_or_create(name="Helper")
+
+    clublist = [Club.objects.create(name="Benchmark Club %d" % n, slug="BENCH%d" % n,
+                                    website="http://example.com/")
+                for n in range(clubs)]
+
+    users = User.objects.bulk_create([User(username="benchmark%d" % n, first_name="Rider%d" % n,
+                                           last_name="Benchmark%d" % (n % 97))
+                                      for n in range(riders)])
+    riderlist = Rider.objects.bulk_create([Rider(user=user, club=rand.choice(clublist), licenceno="B%d" % user.id)
+                                           for user in users])
+
+    # every rider has a grade with every club
+    ingrade = dict((grade, []) for grade in grades)
+    clubgrades = []
+    for n, rider in enumerate(riderlist):
+        grade = grades[n % len(grades)]
+        ingrade[grade].append(rider)
+        clubgrades.extend(ClubGrade(club=club, rider=rider, grade=grade) for club in clublist)
+    ClubGrade.objects.bulk_create(clubgrades)
+
+    pointscores = []
+    results = []
+    staff = []
+    racecount = 0
+    for club in clublist:
+        clubraces = Race.objects.bulk_create([
+            Race(club=club, title="Benchmark Race %d" % n, location=course, signontime="08:00",
+                 date=today - datetime.timedelta(days=7 * (races - n)))
+            for n in range(races)])
+        racecount += len(clubraces)
+
+        ps = PointScore.objects.create(club=club, name="Benchmark")
+        ps.races.set(clubraces)
+        pointscores.append(ps)
+
+        for race in clubraces:
+            for grade in grades:
+                field = rand.sample(ingrade[grade], rand.randint(len(ingrade[grade]) // 2, len(ingrade[grade])))
+                for place, rider in enumerate(field, 1):
+                    results.append(RaceResult(race=race, rider=rider, grade=grade, usual_grade=grade,
+                                              number=place, place=place if place <= 5 else 0))
+            # helpers are picked from all riders so some will also have raced
+            for rider in rand.sample(riderlist, min(helpers, len(riderlist))):
+                staff.append(RaceStaff(race=race, rider=rider, role=role))
+
+    RaceResult.objects.bulk_create(results, batch_size=1000)
+    RaceStaff.objects.bulk_create(staff)
+
+    return pointscores, {'clubs': clubs, 'riders': riders, 'races': racecount, 'grades': len(grades),
+                         'results': len(results), 'helpers': len(staff)}
+
+
+def measure(function, repeat):
+    """Call function repeat times, return a dictionary of timings
+    and the number of queries used by the first call"""
+
+    times = []
+    queries = None
+    for n in range(repeat):
+        with CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+        if queries is None:
+            queries = len(captured)
+
+    return {'runs': repeat,
+            'min': min(times),
+            'median': statistics.median(times),
+            'max': max(times),
+            'queries': queries}
+
+
+class Command(BaseCommand):
+    help = "Benchmark pointscore calculation on a generated season"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clubs', type=int, default=2)
+        parser.add_argument('--riders', type=int, default=400)
+        parser.add_argument('--races', type=int, default=20, help="Races per club")
+        parser.add_argument('--grades', type=int, default=4)
+        parser.add_argument('--helpers', type=int, default=2, help="Helpers per race")
+        parser.add_argument('--repeat', type=int, default=3, help="Times to run each benchmark")
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--output', default=None, help="File to write JSON results to")
+
+    def handle(self, *args, **options):
+
+        with transaction.atomic():
+            start = time.perf_counter()
+            pointscores, dataset = generate_season(clubs=options['clubs'], riders=options['riders'], races=options['races'],
+                                      grades=options['grades'], helpers=options['helpers'], seed=options['seed'])
+            dataset['seconds'] = time.perf_counter() - start
+            self.stdout.write("Generated %(results)d results in %(races)d races in %(seconds).2fs" % dataset)
+
+            results = self.run_benchmarks(pointscores, options['repeat'])
+
+            # leave the database as we found it
+            transaction.set_rollback(True)
+
+        for name, result in results.items():
+            self.stdout.write("%-12s median %.4fs min %.4fs max %.4fs %d queries" %
+                              (name, result['median'], result['min'], result['max'], result['queries']))
+
+        if options['output']:
+            report = {'date': datetime.datetime.now().isoformat(),
+                      'commit': self.commit(),
+                      'dataset': dataset,
+                      'results': results}
+            with open(options['output'], 'w') as fd:
+                json.dump(report, fd, indent=2)
+
+    def run_benchmarks(self, pointscores, repeat):
+        """Time each operation on the generated season"""
+
+        ps = pointscores[0]
+        # a race from the middle of the season being uploaded again
+        races = list(ps.rounds())
+        race = races[len(races) // 2]
+
+        def recalculate():
+            for pointscore in pointscores:
+                pointscore.recalculate()
+
+        results = {'recalculate': measure(recalculate, repeat),
+                   'rescore_race': measure(race.tally_pointscores, repeat)}
+
+        def standings():
+            # a fresh instance each time so nothing is cached
+            return PointScoreSerializer(PointScore.objects.get(pk=ps.pk), context={'request': None}).data
+
+        results['standings'] = measure(standings, repeat)
+
+        # audit page for the rider with the longest audit trail
+        leader = ps.results.order_by('-eventcount')[0].rider
+        factory = RequestFactory()
+
+        def audit():
+            request = factory.get('/')
+            request.user = AnonymousUser()
+            response = ClubPointscoreAuditView.as_view()(request, slug=ps.club.slug, pk=ps.pk, rider=leader.user.id)
+            response.render()
+
+        results['audit'] = measure(audit, repeat)
+
+        return results
+
+    def commit(self):
+        """The current git commit, if we can find it"""
+
+        try:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+#
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Benchmark the race ingest scrapers offline.
+
+The pages recorded in the vcrpy cassettes are read straight from the
+cassette files, no network is used, and each is parsed repeatedly by
+the scraper module for its source. The time to build a tree of the
+whole page is given for comparison. Use --output to write the results
+as JSON so that runs can be compared between commits.
+'''
+
+import contextlib
+import datetime
+import io
+import json
+import os
+import statistics
+import time
+from importlib import import_module
+
+from bs4 import BeautifulSoup
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from vcr.persisters.filesystem import FilesystemPersister
+from vcr.serializers import yamlserializer
+
+from races.ingest.scrape import PARSER
+
+CASSETTES = os.path.join(settings.PROJECT_DIR, 'fixtures', 'vcr_cassettes')
+
+# scraper module and the cassette with a recording of its page
+SOURCES = {'lacc': ('races.ingest.lacc', 'lacc.yaml'),
+           'waratahs': ('races.ingest.waratahs', 'module_waratahs.yaml')}
+
+
+def recorded_page(cassette):
+    """The body of the first response recorded in a cassette"""
+
+    requests, responses = FilesystemPersister.load_cassette(cassette, yamlserializer)
+    body = responses[0]['body']['string']
+    return body.encode('utf-8') if isinstance(body, str) else body
+
+
+def measure(function, repeat):
+    """Call function repeat times, return its last result and
+    a dictionary of timings"""
+
+    times = []
+    for n in range(repeat):
+        start = time.perf_counter()
+        # the scrapers print warnings about rows they don't understand
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = function()
+        times.append(time.perf_counter() - start)
+
+    return result, {'runs': repeat,
+                    'min': min(times),
+                    'median': statistics.median(times),
+                    'max': max(times)}
+
+
+class Command(BaseCommand):
+    help = "Benchmark the ingest scrapers on recorded pages"
+
+    def add_arguments(self, parser):
+        parser.add_argument('sources', nargs='*', help="Sources to benchmark, default is all of them")
+        parser.add_argument('--cassettes', default=CASSETTES, help="Directory of vcrpy cassettes")
+        parser.add_argument('--repeat', type=int, default=5, help="Times to parse each page")
+        parser.add_argument('--output', default=None, help="File to write JSON results to")
+
+    def handle(self, *args, **options):
+
+        names = options['sources'] or sorted(SOURCES)
+        for name in names:
+            if name not in SOURCES:
+                raise CommandError("Unknown source %s, choose from %s" % (name, ", ".join(sorted(SOURCES))))
+
+        self.stdout.write("Parsing with %s" % PARSER)
+
+        results = {}
+        for name in names:
+            modulename, cassette = SOURCES[name]
+            module = import_module(modulename)
+            page = recorded_page(os.path.join(options['cassettes'], cassette))
+
+            races, scrape = measure(lambda: module.parse_web_text(page), options['repeat'])
+            tree, full = measure(lambda: BeautifulSoup(page, PARSER), options['repeat'])
+
+            results[name] = {'bytes': len(page), 'races': len(races), 'scrape': scrape, 'full_parse': full}
+            self.stdout.write("%-10s %7d bytes %4d races scrape median %.4fs min %.4fs, full parse median %.4fs" %
+                              (name, len(page), len(races), scrape['median'], scrape['min'], full['median']))
+
+        if options['output']:
+            report = {'date': datetime.datetime.now().isoformat(),
+                      'parser': PARSER,
+                      'results': results}
+            with open(options['output'], 'w') as fd:
+                json.dump(report, fd, indent=2)
@@ -20,30 +20,92 @@ Created on Apr 17, 2013
 @author: steve
 '''
 
+import time
+
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 
 from races.apps.cabici.models import Club
-
-
+from races.apps.cabici.ingest import ingest_clubs, due_clubs, date_window, WORKERS, DAYS_BEFORE, DAYS_AFTER
+from races.ingest import fetch
 
 
 class Command(BaseCommand):
+    help = "Ingest races from club calendars and web sites"
+
+    def add_arguments(self, parser):
+        parser.add_argument('clubs', nargs='*', help="Slugs of the clubs to ingest, default is all clubs")
+        parser.add_argument('--workers', type=int, default=WORKERS, help="Number of sources fetched at once")
+        parser.add_argument('--connect-timeout', type=float, default=fetch.CONNECT_TIMEOUT,
+                            help="Seconds to wait for a connection")
+        parser.add_argument('--read-timeout', type=float, default=fetch.READ_TIMEOUT,
+                            help="Seconds to wait for data from a connection")
+        parser.add_argument('--retries', type=int, default=fetch.RETRIES,
+                            help="Number of times to retry a failed fetch")
+        parser.add_argument('--backoff', type=float, default=fetch.BACKOFF,
+                            help="Seconds before the first retry, doubled for each retry after")
+        parser.add_argument('--cache', default=settings.INGEST_CACHE_DIR,
+                            help="Directory to cache fetched calendars and pages in")
+        parser.add_argument('--no-cache', dest='use_cache', action='store_false', help="Don't use the cache")
+        parser.add_argument('--force', action='store_true', help="Parse sources even if they haven't changed")
+        parser.add_argument('--all', dest='all_sources', action='store_true',
+                            help="Fetch all sources, not just those that are due, clubs named are always fetched")
+        parser.add_argument('--offline', action='store_true',
+                            help="Reprocess the cached copies without fetching anything")
+        parser.add_argument('--days-before', type=int, default=DAYS_BEFORE,
+                            help="Read calendar events from this many days ago")
+        parser.add_argument('--days-after', type=int, default=DAYS_AFTER,
+                            help="Read calendar events up to this many days ahead")
+        parser.add_argument('--all-dates', action='store_true', help="Read all calendar events")
 
     def handle(self, *args, **options):
-        
-        if len(args) > 0:
+
+        if options['clubs']:
             clubs = []
-            for arg in args:
-                clubs.append(Club.objects.get(slug=arg))
+            for slug in options['clubs']:
+                try:
+                    clubs.append(Club.objects.get(slug=slug))
+                except Club.DoesNotExist:
+                    raise CommandError("Unknown club %s" % slug)
         else:
-            clubs = Club.objects.all()
-        
-        
-        for club in clubs:
-            try:
-                (races, errors) = club.ingest()
-                print("Club: ", club, "found", len(races), "races")
-            except Exception as e:
-                print("Club: ", club, "error:", e)
-            
\ No newline at end of file
+            clubs = list(Club.objects.all())
+
+        if options['offline'] and not options['use_cache']:
+            raise CommandError("--offline needs the cache")
+
+        fetch_options = {'connect_timeout': options['connect_timeout'],
+                         'read_timeout': options['read_timeout'],
+                         'retries': options['retries'],
+                         'backoff': options['backoff']}
+        if not options['all_dates']:
+            fetch_options['window'] = date_window(options['days_before'], options['days_after'])
+        if options['use_cache']:
+            fetch_options.update(cache=fetch.FetchCache(options['cache']),
+                                 only_changed=not options['force'],
+                                 offline=options['offline'])
+
+        due_only = not options['clubs'] and not options['all_sources']
+        if due_only:
+            due = due_clubs(clubs)
+            if len(due) < len(clubs):
+                self.stdout.write("Skipping %d clubs that aren't due or have no ingest source" % (len(clubs) - len(due)))
+            clubs = due
+
+        start = time.perf_counter()
+        total = 0
+        failed = 0
+        unchanged = 0
+        for result in ingest_clubs(clubs, workers=options['workers'], **fetch_options):
+            if result.unchanged:
+                self.stdout.write("Club: %s unchanged, fetch %.2fs" % (result.club, result.fetch))
+            else:
+                self.stdout.write("Club: %s found %d races, %d new, fetch %.2fs save %.2fs" %
+                                  (result.club, result.found, len(result.races), result.fetch, result.save))
+            for error in result.errors:
+                self.stdout.write("Club: %s error: %s" % (result.club, error))
+            total += len(result.races)
+            failed += bool(result.errors)
+            unchanged += result.unchanged
+
+        self.stdout.write("Ingested %d new races from %d clubs in %.2fs, %d unchanged, %d with errors" %
+                          (total, len(clubs), time.perf_counter() - start, unchanged, failed))
@@ -18,13 +18,16 @@
 Created on August 18, 2015
 
 @author: steve
+
+Merge duplicate rider records, either one pair at a time with
+--rider and --merge, or in bulk: --find-duplicates writes a report
+of likely duplicates for review and --apply merges the groups in
+a reviewed report.
 '''
 
-from django.conf import settings
-from django.core.management.base import BaseCommand, CommandError
-from django.contrib.auth.models import User
-from races.apps.cabici.usermodel import PointScore, Rider, PointscoreTally
-from races.apps.cabici.models import Race
+from django.core.management.base import BaseCommand
+from races.apps.cabici.usermodel import Rider
+from races.apps.cabici.duplicates import find_duplicates, write_report, read_report, merge_riders
 
 class Command(BaseCommand):
 
@@ -33,10 +36,20 @@ class Command(BaseCommand):
         parser.add_argument('--rider', dest='rider' )
         parser.add_argument('--merge', dest='merge')
         parser.add_argument('--search', dest='search')
+        parser.add_argument('--find-duplicates', dest='find', action='store_true',
+                            help="Find likely duplicate riders and report them")
+        parser.add_argument('--threshold', type=float, default=0.6, help="Score needed to report a pair")
+        parser.add_argument('--report', dest='report', help="CSV file to write the duplicates report to")
+        parser.add_argument('--apply', dest='apply', help="Merge the groups in a reviewed duplicates report")
+        parser.add_argument('--yes', action='store_true', help="Don't ask for confirmation")
 
     def handle(self, *args, **options):
 
-        if options['search']:
+        if options['find']:
+            self.find(options['threshold'], options['report'])
+        elif options['apply']:
+            self.apply(options['apply'], options['yes'])
+        elif options['search']:
             riders = Rider.objects.filter(user__last_name__icontains=options['search'])
             if riders.count() == 0:
                 print("No riders matched")
@@ -58,19 +71,57 @@ class Command(BaseCommand):
                         print(result)
 
                     print("\nAll race results for '"+str(mergerider)+"' will be moved over to '"+str(rider)+"'")
-                    response = input("Continue? [y/N]")
+                    response = 'y' if options['yes'] else input("Continue? [y/N]")
 
                     if response == 'y':
-                        for result in mergeresults:
-                            result.rider = rider
-                            result.save()
+                        merge_riders(rider, [mergerider])
 
-                        mergerider.user.delete()
-                        mergerider.delete()
-                        
                         print("\nResults for ", rider)
                         for result in rider.raceresult_set.all():
                             print(result)
 
                     else:
                         print("ok, no action")
+
+    def find(self, threshold, report):
+        """Find duplicate riders and write the report"""
+
+        groups, skipped = find_duplicates(threshold=threshold)
+
+        for key in skipped:
+            self.stderr.write("Skipped block %s, too many riders to compare" % (key,))
+
+        if report:
+            with open(report, 'w', newline='') as fd:
+                write_report(groups, fd)
+        else:
+            write_report(groups, self.stdout)
+
+        self.stderr.write("%d groups of duplicates, %d riders to merge" %
+                          (len(groups), sum(len(group.riders) - 1 for group in groups)))
+
+    def apply(self, report, yes):
+        """Merge the groups in a reviewed report"""
+
+        with open(report, newline='') as fd:
+            groups = read_report(fd)
+
+        if not yes:
+            response = input("Merge %d groups of riders? [y/N]" % len(groups))
+            if response != 'y':
+                self.stdout.write("ok, no action")
+                return
+
+        merged = 0
+        for keepid, mergeids in groups:
+            riders = Rider.objects.select_related('user').in_bulk([keepid] + mergeids)
+            if keepid not in riders:
+                self.stderr.write("Rider %d not found, group skipped" % keepid)
+                continue
+            others = [riders[pk] for pk in mergeids if pk in riders]
+            moved = merge_riders(riders[keepid], others)
+            merged += len(others)
+            self.stdout.write("Merged %s into %s: %s" % (", ".join(str(r.pk) for r in others), keepid,
+                              ", ".join("%s %d" % item for item in sorted(moved.items()) if item[1])))
+
+        self.stdout.write("Merged %d riders in %d groups" % (merged, len(groups)))
@@ -20,14 +20,32 @@ Created on August 18, 2015
 @author: steve
 '''
 
+import multiprocessing
+import time
+
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
 from races.apps.cabici.usermodel import PointScore, PointscoreTally, Rider
 
+
+def rescore(pk):
+    """Recalculate one pointscore, return its name, the number
+    of riders in the table and the time taken.
+    Run in a worker process when --workers is given."""
+
+    start = time.time()
+    pointscore = PointScore.objects.get(pk=pk)
+    pointscore.recalculate()
+    return str(pointscore), pointscore.results.count(), time.time() - start
+
+
 class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('name', nargs='?', type=str)
         parser.add_argument('--list', dest='list', action='store_const', const=True, default=False)
+        parser.add_argument('--workers', dest='workers', type=int, default=1,
+                            help="Number of processes to rescore pointscores in parallel")
 
     def handle(self, *args, **options):
 
@@ -35,23 +53,46 @@ class Command(BaseCommand):
             pointscores = PointScore.objects.all()
             for p in pointscores:
                 print(p)
+            return
+
         elif options['name']:
             pointscores = PointScore.objects.filter(name__contains=options['name'])
 
             if pointscores.count() == 0:
                 print("No pointscore matches", options['name'])
-            else:
-                for p in pointscores:
-                    print("Rescoring", p)
-                    p.recalculate()
+                return
 
         else:
-            pointscores = PointScore.objects.all()
-            for p in pointscores:
+            pointscores = []
+            for p in PointScore.objects.all():
                 if p.current():
-                    print("Rescoring", p)
-                    p.recalculate()
+                    pointscores.append(p)
                 else:
                     print("Not rescoring", p)
 
+        pks = [p.pk for p in pointscores]
+        workers = max(1, options['workers'])
+
+        start = time.time()
+        if workers == 1:
+            busy = self.report(map(rescore, pks))
+        else:
+            # each worker has to open its own database connection
+            connections.close_all()
+            with multiprocessing.Pool(min(workers, len(pks) or 1)) as pool:
+                busy = self.report(pool.imap_unordered(rescore, pks))
+        elapsed = time.time() - start
+
+        if pks:
+            print("Rescored %d pointscores in %.2fs with %d workers (%.2fs rescoring), %.2f pointscores/s" %
+                  (len(pks), elapsed, workers, busy, len(pks) / elapsed))
+
+    def report(self, timings):
+        """Print the time taken for each pointscore as it finishes,
+        return the total time spent rescoring"""
 
+        total = 0
+        for name, riders, seconds in timings:
+            print("Rescored %s: %d riders in %.2fs" % (name, riders, seconds))
+            total += seconds
+        return total
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+#
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Worker that runs queued pointscore jobs, several workers can be
+run at once, they will not run two jobs for the same pointscore
+at the same time.
+
+While a job runs the worker updates its heartbeat from a separate
+thread. A running job is only given up as failed, and its pointscore
+freed for other workers, once its heartbeat is older than --stale.
+'''
+
+import datetime
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from races.apps.cabici.usermodel import PointscoreJob
+
+# seconds between heartbeats of a running job
+HEARTBEAT = 60
+
+
+class Heartbeat(threading.Thread):
+    """Update the heartbeat of a job every interval seconds
+    until stopped"""
+
+    def __init__(self, job, interval=HEARTBEAT):
+        super().__init__(daemon=True)
+        self.job = job
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        beats = 0
+        while not self.stopped.wait(self.interval):
+            beats += 1
+            if not self.job.beat():
+                break
+        # this thread has its own database connection
+        if beats:
+            connection.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.join()
+
+
+class Command(BaseCommand):
+    help = "Run queued pointscore recalculations"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', dest='once', action='store_const', const=True, default=False,
+                            help="Exit when there are no more pending jobs")
+        parser.add_argument('--sleep', dest='sleep', type=float, default=5,
+                            help="Seconds to wait between checks for new jobs")
+        parser.add_argument('--heartbeat', dest='heartbeat', type=float, default=HEARTBEAT,
+                            help="Seconds between heartbeats of a running job")
+        parser.add_argument('--stale', dest='stale', type=int, default=5,
+                            help="Minutes without a heartbeat after which a running job is assumed to have failed")
+
+    def handle(self, *args, **options):
+
+        stale = datetime.timedelta(minutes=options['stale'])
+
+        while True:
+            released = PointscoreJob.objects.release_stale(stale)
+            if released:
+                self.stdout.write("Released %d stale jobs" % released)
+
+            job = PointscoreJob.objects.claim()
+            if job is None:
+                if options['once']:
+                    break
+                time.sleep(options['sleep'])
+                continue
+
+            start = time.time()
+            with Heartbeat(job, options['heartbeat']):
+                job.run()
+            self.stdout.write("%s %.2fs" % (job, time.time() - start))
+            if job.status == 'failed':
+                self.stderr.write(job.error)
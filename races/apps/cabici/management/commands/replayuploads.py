@@ -0,0 +1,260 @@
+#!/usr/bin/python
+#
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Replay saved results uploads through the results API.
+
+Uploads are read from a directory of upload archives (see
+races.apps.cabici.archive) or of JSON files saved by older versions,
+and posted in the order they were received to RaceResultList.post.
+Each upload is timed and its queries counted, then a checksum of the
+results of every race is reported so that the final state can be
+compared between runs.
+
+Uploads are replayed against the database named by --database, a
+scratch copy configured in DATABASES. The replay takes locks that
+would hold up live uploads, so it won't run against the default
+database without --allow-default. A serial replay runs inside a
+transaction that is rolled back. A concurrent replay has to commit,
+so it needs --commit.
+'''
+
+import concurrent.futures
+import contextlib
+import datetime
+import glob
+import hashlib
+import json
+import math
+import os
+import statistics
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from races.apps.cabici.api import RaceResultList
+from races.apps.cabici.archive import UploadArchive
+from races.apps.cabici.usermodel import RaceResult
+
+
+def load_uploads(directory):
+    """Read the uploads saved in a directory, oldest first,
+    return a list of (time, payload)"""
+
+    archive = UploadArchive(directory)
+    uploads = [(entry['time'], archive.read(entry)) for entry in archive.entries()]
+
+    # files are named <race>-<time>.json
+    for filename in glob.glob(os.path.join(directory, "*.json")):
+        name = os.path.basename(filename)[:-len(".json")]
+        try:
+            timestamp = float(name.split('-', 1)[1])
+        except (IndexError, ValueError):
+            timestamp = os.path.getmtime(filename)
+        with open(filename) as fd:
+            uploads.append((timestamp, json.load(fd)))
+
+    uploads.sort(key=lambda upload: upload[0])
+    return uploads
+
+
+def percentile(values, percent):
+    """The nearest rank percentile of a list of numbers"""
+
+    values = sorted(values)
+    rank = max(1, math.ceil(percent / 100.0 * len(values)))
+    return values[rank - 1]
+
+
+def checksums(raceids):
+    """A checksum of the stored results of each race"""
+
+    result = {}
+    for raceid in sorted(raceids):
+        rows = RaceResult.objects.filter(race=raceid).order_by('rider_id').values_list(
+            'rider_id', 'grade', 'usual_grade', 'number', 'place', 'dnf')
+        result[raceid] = hashlib.sha256(json.dumps(list(rows)).encode('utf-8')).hexdigest()
+    return result
+
+
+@contextlib.contextmanager
+def use_database(alias):
+    """Point the default connection at another configured database,
+    the API code doesn't take a database alias. Connections opened
+    by any thread in the meantime go to that database."""
+
+    if alias == DEFAULT_DB_ALIAS:
+        yield
+        return
+
+    def reset():
+        connections[DEFAULT_DB_ALIAS].close()
+        del connections[DEFAULT_DB_ALIAS]
+
+    saved = connections.settings[DEFAULT_DB_ALIAS]
+    reset()
+    connections.settings[DEFAULT_DB_ALIAS] = connections.settings[alias]
+    try:
+        yield
+    finally:
+        reset()
+        connections.settings[DEFAULT_DB_ALIAS] = saved
+
+
+class Command(BaseCommand):
+    help = "Replay saved results uploads and report timings"
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help="Directory of saved uploads")
+        parser.add_argument('--user', default=None, help="Username to upload as, default is the first superuser")
+        parser.add_argument('--concurrency', type=int, default=1, help="Number of uploads in flight at once")
+        parser.add_argument('--rate', type=float, default=0, help="Uploads started per second, 0 for no limit")
+        parser.add_argument('--limit', type=int, default=None, help="Only replay this many uploads")
+        parser.add_argument('--commit', action='store_true', help="Keep the changes, needed for concurrent replay")
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS,
+                            help="Alias of the scratch database in DATABASES to replay against")
+        parser.add_argument('--allow-default', action='store_true',
+                            help="Allow replaying against the default database, it locks pointscores that live "
+                                 "uploads need")
+        parser.add_argument('--output', default=None, help="File to write JSON results to")
+
+    def handle(self, *args, **options):
+
+        uploads = load_uploads(options['directory'])[:options['limit']]
+        if not uploads:
+            raise CommandError("No uploads found in %s" % options['directory'])
+
+        if options['concurrency'] > 1 and not options['commit']:
+            raise CommandError("Concurrent replay can't be rolled back, use --commit with a scratch database")
+
+        if options['database'] not in connections.settings:
+            raise CommandError("Unknown database %s" % options['database'])
+        if options['database'] == DEFAULT_DB_ALIAS and not options['allow_default']:
+            raise CommandError("Replay against a scratch database with --database, "
+                               "or use --allow-default to replay against the default database")
+
+        with use_database(options['database']):
+            self.run(uploads, options)
+
+    def run(self, uploads, options):
+        """Replay the uploads and report the results"""
+
+        if options['user']:
+            user = User.objects.filter(username=options['user']).first()
+        else:
+            user = User.objects.filter(is_superuser=True).order_by('id').first()
+        if user is None:
+            raise CommandError("No user to upload as")
+
+        self.stdout.write("Replaying %d uploads as %s" % (len(uploads), user.username))
+
+        # replayed uploads are not saved again
+        with override_settings(SAVE_RESULT_UPLOADS=False):
+            if options['commit']:
+                timings, elapsed = self.replay(uploads, user, options['concurrency'], options['rate'])
+                final = checksums(set(payload['race'] for when, payload in uploads))
+            else:
+                with transaction.atomic():
+                    timings, elapsed = self.replay(uploads, user, 1, options['rate'])
+                    final = checksums(set(payload['race'] for when, payload in uploads))
+                    # leave the database as we found it
+                    transaction.set_rollback(True)
+
+        report = self.report(timings, elapsed)
+        report['checksums'] = final
+        for raceid, checksum in final.items():
+            self.stdout.write("race %s results %s" % (raceid, checksum))
+
+        if options['output']:
+            report['date'] = datetime.datetime.now().isoformat()
+            report['options'] = {'concurrency': options['concurrency'], 'rate': options['rate'],
+                                 'directory': options['directory'], 'database': options['database']}
+            with open(options['output'], 'w') as fd:
+                json.dump(report, fd, indent=2)
+
+    def replay(self, uploads, user, concurrency, rate):
+        """Post the uploads, starting them at the given rate,
+        return a list of (status, seconds, queries) for each
+        and the total time taken"""
+
+        factory = APIRequestFactory()
+        view = RaceResultList.as_view()
+        start = time.perf_counter()
+
+        def post(n, payload):
+            if rate:
+                delay = start + n / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+            request = factory.post('/api/raceresults/', payload, format='json')
+            force_authenticate(request, user=user)
+            try:
+                with CaptureQueriesContext(connection) as queries:
+                    began = time.perf_counter()
+                    try:
+                        # in a serial replay a failed upload mustn't spoil the transaction
+                        with transaction.atomic() if connection.in_atomic_block else contextlib.nullcontext():
+                            status = view(request).status_code
+                    except Exception as error:
+                        status = type(error).__name__
+                    seconds = time.perf_counter() - began
+                return status, seconds, len(queries)
+            finally:
+                if threading.current_thread() is not threading.main_thread():
+                    connection.close()
+
+        if concurrency == 1:
+            timings = [post(n, payload) for n, (when, payload) in enumerate(uploads)]
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+                futures = [executor.submit(post, n, payload) for n, (when, payload) in enumerate(uploads)]
+                timings = [future.result() for future in futures]
+
+        return timings, time.perf_counter() - start
+
+    def report(self, timings, elapsed):
+        """Print a summary of the timings and return it as a dictionary"""
+
+        latencies = [seconds for status, seconds, queries in timings]
+        queries = [count for status, seconds, count in timings]
+        errors = [status for status, seconds, count in timings if status != 200]
+
+        summary = {'uploads': len(timings),
+                   'errors': len(errors),
+                   'seconds': elapsed,
+                   'throughput': len(timings) / elapsed if elapsed else 0,
+                   'latency': {'p50': percentile(latencies, 50),
+                               'p90': percentile(latencies, 90),
+                               'p99': percentile(latencies, 99),
+                               'max': max(latencies),
+                               'mean': statistics.mean(latencies)},
+                   'queries': {'total': sum(queries),
+                               'mean': statistics.mean(queries),
+                               'max': max(queries)}}
+
+        self.stdout.write("%(uploads)d uploads in %(seconds).2fs, %(throughput).1f per second, %(errors)d errors" % summary)
+        self.stdout.write("latency p50 %(p50).4fs p90 %(p90).4fs p99 %(p99).4fs max %(max).4fs" % summary['latency'])
+        self.stdout.write("queries total %(total)d mean %(mean).1f max %(max)d" % summary['queries'])
+        for status in sorted(set(map(str, errors))):
+            self.stdout.write("  %d uploads failed with %s" % ([str(e) for e in errors].count(status), status))
+
+        return summary
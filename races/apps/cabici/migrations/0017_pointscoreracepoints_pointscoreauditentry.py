@@ -0,0 +1,99 @@
+# Generated by Django 4.2.23 on 2026-10-18 02:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+import json
+
+
+def copy_audit_to_entries(apps, schema_editor):
+    """Make a PointscoreAuditEntry for each reason in the JSON audit
+    trail of existing tallies, matching the race named in the reason
+    against the races in the pointscore"""
+
+    PointscoreTally = apps.get_model('cabici', 'PointscoreTally')
+    PointscoreAuditEntry = apps.get_model('cabici', 'PointscoreAuditEntry')
+
+    racenames = {}
+    entries = []
+    for tally in PointscoreTally.objects.all():
+        if tally.pointscore_id not in racenames:
+            races = tally.pointscore.races.all()
+            racenames[tally.pointscore_id] = dict((race.title + ", " + str(race.date), race.id) for race in races)
+
+        for points, reason in json.loads(tally.audit) or []:
+            if " in race: " in reason:
+                reason_type = 'helper'
+                name = reason.split(" in race: ", 1)[1]
+            else:
+                reason_type = 'result'
+                name = reason.rsplit(" : ", 1)[-1]
+
+            entries.append(PointscoreAuditEntry(tally=tally,
+                                                race_id=racenames[tally.pointscore_id].get(name),
+                                                reason_type=reason_type,
+                                                points=points,
+                                                reason=reason[:300]))
+
+    PointscoreAuditEntry.objects.bulk_create(entries, batch_size=1000)
+
+
+def copy_entries_to_audit(apps, schema_editor):
+    """Rebuild the JSON audit trail of each tally from its
+    PointscoreAuditEntry rows"""
+
+    PointscoreTally = apps.get_model('cabici', 'PointscoreTally')
+    PointscoreAuditEntry = apps.get_model('cabici', 'PointscoreAuditEntry')
+
+    audits = {}
+    for tally_id, points, reason in PointscoreAuditEntry.objects.order_by('race__date', 'race_id', 'id') \
+            .values_list('tally_id', 'points', 'reason'):
+        audits.setdefault(tally_id, []).append((points, reason))
+
+    tallies = list(PointscoreTally.objects.filter(id__in=audits))
+    for tally in tallies:
+        tally.audit = json.dumps(audits[tally.id])
+    PointscoreTally.objects.bulk_update(tallies, ['audit'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cabici', '0016_club_auscycling_client_id_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PointscoreRacePoints',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('points', models.IntegerField(default=0)),
+                ('eventcount', models.IntegerField(default=0)),
+                ('pointscore', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='racepoints', to='cabici.pointscore')),
+                ('race', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cabici.race')),
+                ('rider', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cabici.rider')),
+            ],
+            options={
+                'unique_together': {('pointscore', 'race', 'rider')},
+            },
+        ),
+        migrations.CreateModel(
+            name='PointscoreAuditEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reason_type', models.CharField(choices=[('result', 'Race Result'), ('helper', 'Helper')], default='result', max_length=10)),
+                ('points', models.IntegerField()),
+                ('reason', models.CharField(max_length=300)),
+                ('race', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='cabici.race')),
+                ('tally', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='entries', to='cabici.pointscoretally')),
+            ],
+            options={
+                'ordering': ['race__date', 'race_id', 'id'],
+                'indexes': [models.Index(fields=['tally', 'race', 'reason_type'], name='cabici_poin_tally_i_bb0a15_idx')],
+            },
+        ),
+        migrations.RunPython(copy_audit_to_entries, copy_entries_to_audit),
+        migrations.RemoveField(
+            model_name='pointscoretally',
+            name='audit',
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.23 on 2026-10-18 02:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cabici', '0017_pointscoreracepoints_pointscoreauditentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PointscoreJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('requests', models.IntegerField(default=1)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('started', models.DateTimeField(blank=True, null=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, default='')),
+                ('pointscore', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='cabici.pointscore')),
+                ('race', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='cabici.race')),
+            ],
+            options={
+                'ordering': ['-created', '-id'],
+                'indexes': [models.Index(fields=['pointscore', 'status'], name='cabici_poin_pointsc_4f14cf_idx')],
+            },
+        ),
+    ]
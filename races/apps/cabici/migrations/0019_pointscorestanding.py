@@ -0,0 +1,55 @@
+# Generated by Django 4.2.23 on 2026-10-18 02:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_standings(apps, schema_editor):
+    """Fill the standings table from the existing tallies,
+    as PointScore.update_standings"""
+
+    PointScore = apps.get_model('cabici', 'PointScore')
+    PointscoreStanding = apps.get_model('cabici', 'PointscoreStanding')
+
+    for ps in PointScore.objects.all():
+        tallies = ps.results.select_related('rider__user', 'rider__club').order_by('-points', 'eventcount', 'id')
+        PointscoreStanding.objects.bulk_create([
+            PointscoreStanding(pointscore=ps,
+                               rider=tally.rider,
+                               rank=rank,
+                               name=" ".join((tally.rider.user.first_name, tally.rider.user.last_name)),
+                               userid=tally.rider.user_id,
+                               club=tally.rider.club.slug if tally.rider.club else "Unknown",
+                               points=tally.points,
+                               eventcount=tally.eventcount)
+            for rank, tally in enumerate(tallies, 1)
+        ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cabici', '0018_pointscorejob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PointscoreStanding',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('points', models.IntegerField(default=0)),
+                ('eventcount', models.IntegerField(default=0)),
+                ('rank', models.IntegerField()),
+                ('name', models.CharField(max_length=300)),
+                ('userid', models.IntegerField()),
+                ('club', models.CharField(max_length=100)),
+                ('pointscore', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='standings', to='cabici.pointscore')),
+                ('rider', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cabici.rider')),
+            ],
+            options={
+                'ordering': ['rank'],
+                'indexes': [models.Index(fields=['pointscore', 'rank'], name='cabici_poin_pointsc_dbbd6a_idx')],
+            },
+        ),
+        migrations.RunPython(build_standings, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.23 on 2026-10-18 03:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cabici', '0019_pointscorestanding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pointscorejob',
+            name='grades',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='race',
+            name='results_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
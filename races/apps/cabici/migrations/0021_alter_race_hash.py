@@ -0,0 +1,18 @@
+# Generated by Django 4.2.23 on 2026-10-18 04:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cabici', '0020_pointscorejob_grades_race_results_hash'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='race',
+            name='hash',
+            field=models.CharField(blank=True, db_index=True, max_length=100),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.23 on 2026-10-18 04:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cabici', '0021_alter_race_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='club',
+            name='ingested',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.23 on 2026-10-18 04:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cabici', '0022_club_ingested'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pointscorejob',
+            name='heartbeat',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
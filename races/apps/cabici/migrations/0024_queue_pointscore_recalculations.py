@@ -0,0 +1,27 @@
+# Generated by Django 4.2.23 on 2026-10-18 05:10
+
+from django.db import migrations
+
+
+def queue_recalculations(apps, schema_editor):
+    """Queue a recalculation of each pointscore that has tallies but
+    no points per race, so that the standings after each round can
+    be shown for past seasons too"""
+
+    PointScore = apps.get_model('cabici', 'PointScore')
+    PointscoreJob = apps.get_model('cabici', 'PointscoreJob')
+
+    pointscores = PointScore.objects.filter(results__isnull=False, racepoints__isnull=True) \
+                                    .exclude(jobs__status='pending', jobs__race__isnull=True).distinct()
+    PointscoreJob.objects.bulk_create([PointscoreJob(pointscore=pointscore) for pointscore in pointscores])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cabici', '0023_pointscorejob_heartbeat'),
+    ]
+
+    operations = [
+        migrations.RunPython(queue_recalculations, migrations.RunPython.noop),
+    ]
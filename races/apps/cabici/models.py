@@ -15,22 +15,76 @@
 # limitations under the License.
 
 from django.db import models
+from django.db.models import Case, Count, F, Min, Q, Value, When
+from django.db.models.signals import post_save, post_delete
 from geoposition.fields import GeopositionField
 from django.urls import reverse
 from django.core.exceptions import ValidationError
-from django.db import IntegrityError
-from importlib import import_module
-from django.contrib.auth.models import User
-from django.db import transaction
+from races.ingest import registry
+from races.ingest.fetch import fetch, FetchError
+from races.ingest.ical import read_calendar
 from django.utils import timezone
 
 import icalendar
 import pytz
-from urllib.request import urlopen, Request
-from urllib.error import HTTPError, URLError
 import datetime
 import hashlib
 import ngram
+import threading
+import time
+
+
+class FuzzyIndex:
+    """A process wide n-gram index of the names of the instances
+    of a model for approximate matching. It is built when first
+    used and thrown away when the model changes in this process
+    (see connect) or when it is older than maxage seconds, which
+    picks up changes made by other processes"""
+
+    def __init__(self, model, maxage=600):
+        self.model = model
+        self.maxage = maxage
+        self.ngram = None
+        self.built = 0
+        self.lock = threading.Lock()
+
+    def connect(self):
+        """Invalidate the index whenever an instance is saved or deleted"""
+
+        post_save.connect(self.invalidate, sender=self.model, weak=False)
+        post_delete.connect(self.invalidate, sender=self.model, weak=False)
+
+    def invalidate(self, **kwargs):
+        self.ngram = None
+
+    def index(self):
+        """The n-gram index of (name, pk) pairs"""
+
+        with self.lock:
+            if self.ngram is None or time.monotonic() - self.built > self.maxage:
+                items = [(str(obj), obj.pk) for obj in self.model._default_manager.all()]
+                self.ngram = ngram.NGram(items, key=lambda item: item[0])
+                self.built = time.monotonic()
+            return self.ngram
+
+    def find_many(self, names):
+        """Find the best match for each of a list of names, return a
+        dictionary mapping each name to an instance or None"""
+
+        for attempt in range(2):
+            index = self.index()
+            matches = {}
+            for name in set(names):
+                item = index.find(str(name))
+                matches[name] = item[1] if item is not None else None
+
+            instances = self.model._default_manager.in_bulk([pk for pk in matches.values() if pk is not None])
+            if all(pk is None or pk in instances for pk in matches.values()):
+                break
+            # deleted since the index was built, probably by another process
+            self.invalidate()
+
+        return dict((name, instances.get(pk)) for name, pk in matches.items())
 
 
 class ClubManager(models.Manager):
@@ -39,17 +93,25 @@ class ClubManager(models.Manager):
         """Find a Club using an approximate match to
         the given name, return the best matching Club instance"""
 
-        clubs = self.all()
+        return self.closest_many([name])[name]
+
+    def closest_many(self, names):
+        """Find the best matching Club for each of a list of names
+        using the shared n-gram index, return a dictionary mapping
+        each name to a Club instance"""
 
-        ng = ngram.NGram(clubs, key=str)
+        result = {}
+        unknown_club = None
+        for name, club in club_index.find_many(names).items():
 
-        club = ng.finditem(name)
+            if club is None:
+                if unknown_club is None:
+                    unknown_club, created = Club.objects.get_or_create(name="Unknown Club", slug="Unknown")
+                club = unknown_club
 
-        if club is None:
-            unknown_club, created = Club.objects.get_or_create(name="Unknown Club", slug="Unknown")
-            club = unknown_club
+            result[name] = club
 
-        return club
+        return result
 
 
 class Club(models.Model):
@@ -62,6 +124,8 @@ class Club(models.Model):
     contact = models.EmailField(blank=True)
     icalurl = models.URLField(max_length=400, blank=True, default='')
     icalpatterns = models.CharField(max_length=100, blank=True, default='')
+    # when races were last fetched for this club, see races.ingest.registry
+    ingested = models.DateTimeField(null=True, blank=True)
     # flags for club capabilities
     manage_races = models.BooleanField(default=False)
     manage_members = models.BooleanField(default=False)
@@ -194,39 +258,58 @@ class Club(models.Model):
 
         return dd
 
-    def ingest(self):
+    def ingest(self, **options):
         """Try a couple of ingest methods.
         Return a tuple (races, errormsg) where races is a list
-        of Race instances and errormsg is an error message if any."""
+        of Race instances and errormsg is an error message if any.
+        Options are passed on to races.ingest.fetch.fetch."""
 
         if self.icalurl != '':
-            return self.ingest_ical()
+            return self.ingest_ical(**options)
         else:
-            return self.ingest_by_module()
+            return self.ingest_by_module(**options)
 
-    def ingest_by_module(self):
-        """Try to find a module named for the (lowercased) slug field
-        of this club. If found call the ingest procedure
-        to generate a list of races and pass it to ingest_race_list.
-        Return a tuple (races, errormsg) where races is a list
-        of Race instances and errormsg is an error message if any."""
+    def fetch_races(self, window=None, **options):
+        """Fetch the races for this club from its calendar or
+        ingest module without touching the database.
+        window is a pair of dates to limit calendar events to.
+        Return a tuple (racedicts, errormsg) where racedicts is
+        a list of dictionaries for ingest_race_list."""
+
+        if self.icalurl != '':
+            return self.fetch_ical(window=window, **options)
+        else:
+            return self.fetch_by_module(**options)
 
-        modulename = self.slug.lower()
+    def fetch_by_module(self, **options):
+        """Find the ingest source registered for the slug of this
+        club in races.ingest.registry. If found call its parser
+        to generate a list of race dictionaries.
+        Return a tuple (racedicts, errormsg)."""
 
-        # do we have this module inside ingest?
-        try:
+        source = registry.get(self.slug)
+        if source is None:
+            return ([], 'No ingest module for club "' + self.slug.lower() + '"')
 
-            mod = import_module("races.ingest."+modulename)
-            # now invoke the ingest procedure
-            racedict = mod.ingest()
+        try:
+            return (source.ingest(**options), '')
+        except FetchError as e:
+            return ([], "Error reading %s: %s" % (e.url, e))
 
-            (races, error) = self.ingest_race_list(racedict)
+    def ingest_by_module(self, **options):
+        """Fetch races with the ingest module for this club,
+        see fetch_by_module, and pass them to ingest_race_list.
+        Return a tuple (races, errormsg) where races is a list
+        of Race instances and errormsg is an error message if any."""
 
-        except ImportError:
-            races = []
-            error = 'No ingest module for club "' + modulename + '"'
+        (racedicts, error) = self.fetch_by_module(**options)
+        if error:
+            return ([], error)
 
-        return (races, error)
+        (races, errors) = self.ingest_race_list(racedicts)
+        if not errors and options.get('cache') is not None:
+            options['cache'].commit()
+        return (races, errors)
 
     def recent_races(self):
         """Return a list of the most recent races
@@ -355,6 +438,16 @@ class Club(models.Model):
         else:
             return None
 
+    def grades(self):
+        """Return a dictionary of the current grade of every graded
+        rider keyed by rider id, None if a rider has more than one
+        grade, same as Club.grade"""
+
+        grades = {}
+        for rider_id, grade in self.clubgrade_set.values_list('rider_id', 'grade'):
+            grades[rider_id] = None if rider_id in grades else grade
+        return grades
+
     def promotion(self, rider, when=None):
         """Is this rider eligible for promotion according to the
         WaratahCC rules
@@ -367,56 +460,53 @@ class Club(models.Model):
 
         return grade != 'A' and ((perf['wins'] >= 3) or (perf['places'] >= 7))
 
-    def promotable(self):
+    def promotable(self, index=None):
         """Return a list of riders who might be eligible for
-        promotion based on results in races run by this club."""
+        promotion based on results in races run by this club.
+        index is a PromotionIndex for this club covering today,
+        one is loaded if it is not given."""
 
-        from races.apps.cabici.usermodel import RaceResult
+        from races.apps.cabici.usermodel import Rider
+        from races.apps.cabici.scoring import PromotionIndex
 
-        thisyear = datetime.date.today().year
-        oneyearago = datetime.date.today()-datetime.timedelta(days=365)
+        today = datetime.date.today()
+        if index is None:
+            index = PromotionIndex([self.id], today, today)
 
-        winresults = RaceResult.objects.filter(race__club__exact=self, race__date__gt=oneyearago, place=1)
-        riders = set([res.rider for res in winresults])
-        promotable = []
-        for rider in riders:
-            if self.promotion(rider):
-                promotable.append(rider)
+        riderids = [rider_id for rider_id in index.riders(self.id) if index.promotion(self.id, rider_id, today)]
+        promotable = list(Rider.objects.filter(id__in=riderids).select_related('user'))
 
         promotable.sort(key=lambda x: x.user.last_name)
         return promotable
 
-    def ingest_ical(self):
-        """Import races from an icalendar feed
-        Return a tuple (races, errormsg) where races is a list
-        of Race instances and errormsg is an error message if any."""
+    def fetch_ical(self, window=None, **options):
+        """Fetch and parse the icalendar feed for this club, only
+        events starting within window, a pair of dates, are read.
+        Return a tuple (racedicts, errormsg) where racedicts is
+        a list of dictionaries for ingest_race_list."""
 
         if self.icalurl == '':
             return ([], "No icalendar URL")
 
+        # the window is the key so a cached copy is read again when it moves
+        key = [window[0].isoformat(), window[1].isoformat()] if window is not None else None
         try:
-            req = Request(self.icalurl)
-            req.add_header('User-Agent', 'cabici/1.0 event harvester http://cabici.net/')
-            h = urlopen(req)
-            ical_text = h.read()
-            h.close()
-        except HTTPError as e:
-            content = e.read()
-            return ([], "Error reading icalendar URL:" + content)
-        except URLError as e:
+            ical_text = fetch(self.icalurl, key=key, **options)
+        except FetchError as e:
+            if e.status is not None:
+                return ([], "Error reading icalendar URL: " + str(e))
             return ([], "Bad URL: " + self.icalurl)
 
+        patterns = [p.strip() for p in self.icalpatterns.split(',')]
+        tz = pytz.timezone('Australia/Sydney')
 
         try:
-            cal = icalendar.Calendar.from_ical(ical_text)
+            cal = read_calendar(ical_text, window, patterns)
         except ValueError:
             return ([], "Error reading icalendar file")
 
-        patterns = [p.strip() for p in self.icalpatterns.split(',')]
-        tz = pytz.timezone('Australia/Sydney')
-
         races = []
-        for component in cal.walk():
+        for component in cal.walk('VEVENT'):
 
             if 'DTSTART' in component:
                 start = component.decoded('DTSTART')
@@ -436,39 +526,49 @@ class Club(models.Model):
                     calstring = calstring.encode('ascii', errors='replace')
                     racehash = hashlib.sha1(calstring).hexdigest()
 
-                    # do we already have this race?
-                    if Race.objects.filter(hash=racehash).count() == 0:
+                    if type(start) == datetime.datetime:
 
-                        location = RaceCourse.objects.find_location(title)
+                        start = start.astimezone(tz)
 
-                        if type(start) == datetime.datetime:
+                        startdate = start.date().isoformat()
+                        starttime = start.time().isoformat()
+                    elif type(start) == datetime.date:
 
-                            start = start.astimezone(tz)
+                        startdate = start.isoformat()
+                        starttime = "0:0"
+                    else:
 
-                            startdate = start.date().isoformat()
-                            starttime = start.time().isoformat()
-                        elif type(start) == datetime.date:
+                        startdate = start
+                        starttime = "0:0"
 
-                            startdate = start.isoformat()
-                            starttime = "0:0"
-                        else:
+                    # the reader keeps a day either side of the window
+                    if window is not None and not window[0].isoformat() <= str(startdate) <= window[1].isoformat():
+                        continue
 
-                            startdate = start
-                            starttime = "0:0"
-
-                        race = Race(date=startdate,
-                                    time=starttime,
-                                    title=str(title),
-                                    website=website,
-                                    description=str(description),
-                                    location=location,
-                                    club=self,
-                                    hash=racehash)
-                        race.save()
-                        races.append(race)
+                    races.append({'title': str(title),
+                                  'date': startdate,
+                                  'time': starttime,
+                                  'location': str(title),
+                                  'url': str(website),
+                                  'description': str(description),
+                                  'hash': racehash})
 
         return (races, "")
 
+    def ingest_ical(self, window=None, **options):
+        """Import races from an icalendar feed
+        Return a tuple (races, errormsg) where races is a list
+        of Race instances and errormsg is an error message if any."""
+
+        (racedicts, error) = self.fetch_ical(window=window, **options)
+        if error:
+            return ([], error)
+
+        (races, errors) = self.ingest_race_list(racedicts)
+        if not errors and options.get('cache') is not None:
+            options['cache'].commit()
+        return (races, "; ".join(errors))
+
     def ingest_race_list(self, races):
         """Create races from a list of dictionaries containing
         the race properties
@@ -479,6 +579,8 @@ class Club(models.Model):
         location - a string that we can use to guess the race course
         url
         hash - unique has for the race to spot duplicates
+        Optional properties are:
+        description
 
         Return a tuple of (races, errors) where races is a list of
         Race instances and errors is a list of any errors produced
@@ -486,34 +588,48 @@ class Club(models.Model):
 
         """
 
+        # one query for the races we already have
+        hashes = list(set(r['hash'] for r in races))
+        seen = set()
+        for start in range(0, len(hashes), 500):
+            seen.update(Race.objects.filter(hash__in=hashes[start:start+500]).values_list('hash', flat=True))
+
+        new = []
+        for r in races:
+            if r['hash'] not in seen:
+                seen.add(r['hash'])
+                new.append(r)
+
+        locations = RaceCourse.objects.find_locations([r['location'] for r in new])
+
         racelist = []
         errors = []
-        for r in races:
-            # do we already have this race?
-            if Race.objects.filter(hash=r['hash']).count() == 0:
-                location = RaceCourse.objects.find_location(r['location'])
-
-                # title may need truncating
-                if len(r['title']) > 100:
-                    r['title'] = r['title'][:99]
-
-                try:
-                    race = Race(title=r['title'],
-                                date=r['date'],
-                                starttime=r['time'],
-                                club=self,
-                                location=location,
-                                website=r['url'],
-                                hash=r['hash'])
-
-                    race.save()
-                    racelist.append(race)
-                except ValidationError as e:
-                    # report the error?
-                    errors.append(str(e))
-                    #print "Race ingest error: ", e
-           # else:
-                #print "Race duplicate", r['title'], r['date']
+        for r in new:
+            # title may need truncating
+            if len(r['title']) > 100:
+                r['title'] = r['title'][:99]
+
+            race = Race(title=r['title'],
+                        date=r['date'],
+                        signontime=r['time'],
+                        starttime=r['time'],
+                        club=self,
+                        location=locations[r['location']],
+                        website=r['url'],
+                        description=r.get('description', ''),
+                        hash=r['hash'])
+            try:
+                # bulk_create would fail for the whole list on one bad value
+                for name in ('date', 'signontime'):
+                    Race._meta.get_field(name).to_python(getattr(race, name))
+            except ValidationError as e:
+                # report the error?
+                errors.append(str(e))
+                continue
+
+            racelist.append(race)
+
+        Race.objects.bulk_create(racelist)
 
         return (racelist, errors)
 
@@ -524,16 +640,24 @@ class RaceCourseManager(models.Manager):
         """Find a RaceCourse using an approximate match to
         the given name, return the best matching RaceCourse instance"""
 
-        courses = self.all()
+        return self.find_locations([name])[name]
+
+    def find_locations(self, names):
+        """Find the best matching RaceCourse for each of a list of
+        names, return a dictionary mapping each name to a RaceCourse"""
 
-        ng = ngram.NGram(courses, key=str)
+        result = {}
+        unknown = None
+        for name, location in course_index.find_many(names).items():
 
-        location = ng.finditem(name)
+            if location is None:
+                if unknown is None:
+                    unknown, created = self.get_or_create(name="Unknown")
+                location = unknown
 
-        if location == None:
-            location, created = self.get_or_create(name="Unknown")
+            result[name] = location
 
-        return location
+        return result
 
 
 class RaceCourse(models.Model):
@@ -552,6 +676,13 @@ class RaceCourse(models.Model):
         ordering = ['name']
 
 
+# shared indexes for ClubManager.closest and RaceCourseManager.find_location
+club_index = FuzzyIndex(Club)
+club_index.connect()
+course_index = FuzzyIndex(RaceCourse)
+course_index.connect()
+
+
 class RacePrototype(models.Model):
     """A race prototype describes a race that
     happens often - it includes all details except
@@ -617,7 +748,9 @@ class Race(models.Model):
     location = models.ForeignKey(RaceCourse, help_text=" ", on_delete=models.CASCADE)
     status = models.CharField(max_length=1, choices=STATUS_CHOICES, default='p', help_text=" ")
     description = models.TextField(default="", blank=True, help_text=" ")
-    hash = models.CharField(max_length=100, blank=True)
+    hash = models.CharField(max_length=100, blank=True, db_index=True)
+    # digest of the last results upload, an identical upload is ignored
+    results_hash = models.CharField(max_length=64, blank=True, default='')
 
     # Offical category of the race
     category = models.CharField(max_length=10, choices=CATEGORY_CHOICES, default="3")
@@ -646,191 +779,61 @@ class Race(models.Model):
     def load_excel_results(self, fd, extension):
         """Load race results from a file handle pointing to an Excel file"""
 
-        from races.apps.cabici.usermodel import RaceResult, Rider, Membership
-        import pyexcel
-
-        content = fd.read()
-
-        try:
-            rows = pyexcel.get_records(file_content=content, file_type=extension)
-        except:
-            # file format problem
-            raise Exception('Error reading uploaded file, please check the file format.')
-
-        # validate the file format
-        if 'LicenceNo' not in rows[0] or 'LastName' not in rows[0] or 'Grade' not in rows[0]:
-            raise Exception('Error in spreadsheet format, required columns missing.')
-
-        # now that we have new data, delete any existing results for this race
-        # but first count them so we can see if we need to recompute points below
-        previousresults = RaceResult.objects.filter(race=self).count()
-        RaceResult.objects.filter(race=self).delete()
-
-        messages = []
-        for row in rows:
-            message = []
-
-            if type(row['Id']) != int:
-                # this should be a new rider, but it could be someone we know who
-                # wasn't in the spreadsheet
-                username = Rider.objects.make_username(row['FirstName'],
-                                                       row['LastName'],
-                                                       str(row['LicenceNo']))
-
-                # just in case we know them already we use get_or_create
-                user, created = User.objects.get_or_create(first_name=row['FirstName'],
-                                                           last_name=row['LastName'],
-                                                           username=username)
-
-                if row['Email'] != '':
-                    user.email = row['Email']
-                    user.save()
-
-                club = Club.objects.closest(row['Club'])
-                if created:
-                    # make the rider record
-                    rider = Rider(licenceno=row['LicenceNo'], club=club, user=user)
-                    message.append('Added new rider record for %s %s' % (row['FirstName'], row['LastName']))
-                else:
-                    # we didn't find this person by licence number so set it if we have it
-                    rider = user.rider
-                    if row['LicenceNo'] != '':
-                        rider.licenceno = str(row['LicenceNo'])
-                        message.append('Updated Licence Number to %s' % (row['LicenceNo'],))
-                    if club.slug != 'Unknown':
-                        rider.club = club
-                        message.append('Updated Club to %s' % (club.slug,))
-
-                rider.save()
-            else:
-                try:
-                    rider = Rider.objects.get(id=int(row['Id']))
-                except:
-                    messages.append("Rider Id '%s' not found in database " % row['Id'])
-                    continue
-
-                # validate a bit
-                if row['LastName'] != rider.user.last_name:
-                    messages.append("Rider with Id %s has wrong last name, expected %s but found %s." % (row['Id'], rider.user.last_name, row['LastName']))
-                    continue
-
-            # ok, we now have our rider, either existing or new
-
-            # update licenceno if we didn't know it before
-            if rider.licenceno == '0' and row['LicenceNo'] != '0':
-                rider.licenceno = row['LicenceNo']
-                rider.save()
-                message.append("Updated licence number for %s %s to %s" % (rider.user.first_name, rider.user.last_name, rider.licenceno))
-
-
-            # we know that this rider is a current member of their club if the Regd field is R
-            if row['Regd'] == 'R':
-                endofyear = datetime.date(day=31, month=12, year=datetime.date.today().year)
-
-                m,created = Membership.objects.get_or_create(rider=rider,
-                                                             club=rider.club,
-                                                             date=endofyear,
-                                                             category='race')
-                if created:
-                    message.append('Updated membership of rider %s of club %s to %s' % (str(rider), rider.club.slug, endofyear))
-
-            # deal with grades
-            grading, created = rider.clubgrade_set.get_or_create(club=self.club, rider=rider)
-            if created:
-                # allocate the grade they raced this time
-                grading.grade = row['Grade']
-                grading.save()
-
-            usual_grade = grading.grade
-
-            # a grade ending in P means the rider is being permanently re-graded
-            # so we should change their recorded grade
-            if row['Grade'].endswith('P'):
-                # get the real grade for the result
-                row['Grade'] = row['Grade'][0]
-                grading.grade = row['Grade']
-                grading.save()
-                message.append('Updated grade of %s to %s' % (str(rider), grading.grade))
-            elif not row['Grade'] == usual_grade:
-                message.append('%s rode in grade %s but is usually %s grade' % (str(rider), row['Grade'], usual_grade))
-
-            # work out place from points - actually need to account for small grades (E, F)
-            points = int(row['Points'])
-            if points == 2:
-                place = 0
-            elif points > 0:
-                place = 8-points
-            else:
-                place = 0
-
-            if row['ShirtNo'] == '':
-                shirtno = 0
-            else:
-                shirtno = int(row['ShirtNo'])
+        from races.apps.cabici.importers import RaceResultsImport, SpreadsheetReader
 
-            # special case of number 999 indicates a helper, change the 'grade'
-            if shirtno == 999:
-                row['Grade'] = "Helper"
-                message.append('%s recorded as a Helper' % (str(rider),))
-
-            result = RaceResult(rider=rider, race=self, place=place,
-                                usual_grade=usual_grade, grade=row['Grade'],
-                                number=shirtno)
-
-            # check for duplicate race number
-            while RaceResult.objects.filter(race=self, number=result.number).count() == 1:
-                result.number = result.number + 200
-
-            # check for duplicate race/rider
-            if RaceResult.objects.filter(race=self, rider=result.rider).count() == 1:
-                # not much we can do here
-                message.append("Error: duplicate result discarded for rider %s" % (str(rider)))
-            else:
-                try:
-                    with transaction.atomic():
-                        result.save()
-                except IntegrityError as e:
-                    message.append("Error saving result for rider %s: %s" % (str(rider), e,))
+        # rows are read in chunks, the header row is checked straight away
+        reader = SpreadsheetReader(fd, extension, required=('LicenceNo', 'LastName', 'Grade'))
 
-            if message != []:
-                messages.append('\n'.join(message))
+        # replaces any existing results for this race
+        messages = RaceResultsImport(self).load(reader)
 
-        self.fix_small_races()
+        # a repeat of the last JSON upload is no longer the same as what we have
+        Race.objects.filter(pk=self.pk).update(results_hash='')
+        self.results_hash = ''
 
         # once results are in place, we tally the pointscores for this race
-        if previousresults > 0:
-            # need to recalculate pointscores since we've deleted results
-            for ps in self.pointscore_set.all():
-                ps.recalculate()
-        else:
-            # can just tally these results
-            self.tally_pointscores()
+        self.queue_pointscores()
 
         return messages
 
+    def grade_list(self):
+        """The grades configured for this race"""
+
+        return [grade.strip() for grade in self.grading.split(',') if grade.strip()]
+
     def fix_small_races(self):
         """fix up races with small fields after import
         - points/place calculation is incorrect"""
 
-        for grade in ['A', 'B', 'C', 'D', 'E', 'F']:
-            results = self.raceresult_set.filter(grade=grade, place__gt=0)
-            ingrade = self.raceresult_set.filter(grade=grade).count()
+        # size of each grade and the best place given out in it
+        fields = self.raceresult_set.filter(grade__in=self.grade_list()).order_by().values('grade').annotate(
+            ingrade=Count('id'), first=Min('place', filter=Q(place__gt=0)))
+
+        # if the smallest place is not 1, move all places up
+        fudge = dict((field['grade'], field['first'] - 1) for field in fields
+                     if field['ingrade'] < 12 and field['first'] is not None and field['first'] > 1)
 
-            if ingrade < 12:
-                # if the smallest place is not 1
-                places = [r.place for r in results]
-                if places != [] and min(places) > 1:
-                    fudge = min(places)-1
-                    for result in results:
-                        result.place -= fudge
-                        result.save()
+        if fudge:
+            shift = Case(*[When(grade=grade, then=Value(n)) for grade, n in fudge.items()],
+                         output_field=models.IntegerField())
+            self.raceresult_set.filter(grade__in=list(fudge), place__gt=0).update(place=F('place') - shift)
 
     def tally_pointscores(self):
         """Tally all points for this race
         called when all results for this race are loaded
-        so that we know how many riders there were per grade"""
+        so that we know how many riders there were per grade.
+        Any points previously tallied for this race are replaced."""
+
+        for ps in self.pointscore_set.all():
+            ps.rescore_race(self)
+
+    def queue_pointscores(self, grades=None):
+        """Queue background jobs to tally all points for this race,
+        or only for the riders in a list of grades,
+        they are run by the pointscorejobs management command"""
+
+        from .usermodel import PointscoreJob
 
         for ps in self.pointscore_set.all():
-            for result in self.raceresult_set.all():
-                ps.tally(result)
+            PointscoreJob.objects.queue(ps, race=self, grades=grades)
 
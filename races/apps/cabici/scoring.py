@@ -0,0 +1,421 @@
+"""
+Batch calculation of pointscore tallies
+
+PointScore.tally works on one result at a time which is fine when a
+single race is uploaded but far too slow to rescore a whole season.
+PointscoreCalculator loads everything a pointscore needs in a handful
+of queries, works out every rider's points in memory and writes the
+tallies back in one go.
+
+Points are worked out race by race and the points for each race are
+stored alongside the season tally (PointscoreRacePoints) so that when
+the results of one race are uploaded again only that race needs to be
+rescored.
+
+How places turn into points is decided by a ScoringRules class for
+the pointscore's method, set up from the point tables on the
+pointscore, which scores all results in a grade together.
+"""
+
+import bisect
+import datetime
+from collections import Counter, defaultdict
+
+from django.db import transaction
+
+from .usermodel import PointScore, RaceResult, RaceStaff, ClubGrade, PointscoreTally, PointscoreRacePoints, PointscoreAuditEntry
+
+
+class PromotionIndex:
+    """Dated wins and placings of riders in their current grade in
+    club races, loaded in one query and kept as sorted lists of dates
+    so that we can answer Club.promotion for any date without going
+    back to the database"""
+
+    def __init__(self, clubs, start, end):
+        """Load placings that count towards promotion on dates
+        between start and end for races run by any of clubs"""
+
+        self.grades = {}
+        self.wins = defaultdict(list)
+        self.places = defaultdict(list)
+
+        # Club.grade only counts a grade if the rider has exactly one for the club
+        counts = Counter()
+        for club_id, rider_id, grade in ClubGrade.objects.filter(club__in=clubs).values_list('club_id', 'rider_id', 'grade'):
+            counts[(club_id, rider_id)] += 1
+            self.grades[(club_id, rider_id)] = grade
+        for key, count in counts.items():
+            if count > 1:
+                self.grades[key] = None
+
+        # only places 1-3 in the rider's current grade count towards promotion
+        results = RaceResult.objects.filter(race__club__in=clubs,
+                                            place__gte=1,
+                                            place__lte=3,
+                                            race__date__gt=start - datetime.timedelta(days=365),
+                                            race__date__lt=end).order_by('race__date')
+        for club_id, rider_id, date, place, grade in results.values_list('race__club_id', 'rider_id', 'race__date', 'place', 'grade'):
+            if grade == self.grades.get((club_id, rider_id)):
+                self.places[(club_id, rider_id)].append(date)
+                if place == 1:
+                    self.wins[(club_id, rider_id)].append(date)
+
+    def grade(self, club_id, rider_id):
+        """The current grade of the rider in this club, as Club.grade"""
+
+        return self.grades.get((club_id, rider_id))
+
+    def riders(self, club_id):
+        """Ids of riders with placings in this club's races"""
+
+        return [rider_id for club, rider_id in self.places if club == club_id]
+
+    def report(self, club_id, rider_id, when):
+        """Number of wins and places in the year before the given
+        date, as in Club.performancereport"""
+
+        startdate = when - datetime.timedelta(days=365)
+
+        def count(dates):
+            return bisect.bisect_left(dates, when) - bisect.bisect_right(dates, startdate)
+
+        return {'wins': count(self.wins.get((club_id, rider_id), [])),
+                'places': count(self.places.get((club_id, rider_id), []))}
+
+    def promotion(self, club_id, rider_id, when):
+        """Is this rider eligible for promotion in this club on the
+        given date, same rules as Club.promotion"""
+
+        if self.grade(club_id, rider_id) == 'A':
+            return False
+
+        report = self.report(club_id, rider_id, when)
+        return report['wins'] >= 3 or report['places'] >= 7
+
+
+class ScoringRules:
+    """The rules that turn placings in one grade of a race into
+    points, set up from the point tables on the pointscore.
+
+    These are the Waratah Masters CC rules: placegetters get points
+    from the points table, or from the small points table if there
+    are no more than smallthreshold riders in the grade. Everyone
+    else gets participation points, as do placegetters who are
+    eligible for promotion or riding below their usual grade.
+    A method that scores differently has a subclass in RULES."""
+
+    # in very small fields only the winner gets more than participation
+    tinyfield = 6
+    tinywinner = 3
+
+    def __init__(self, pointscore):
+        self.points = pointscore.get_points()
+        self.smallpoints = pointscore.get_smallpoints()
+        self.smallthreshold = pointscore.smallthreshold
+        self.participation = pointscore.participation
+
+    def score_grade(self, places, below, promote, numberriders):
+        """Score all results in one grade of a race.
+        places, below and promote are lists with one entry per result
+        giving the place (0 if unplaced), whether the rider was riding
+        below their usual grade and whether they were eligible for
+        promotion. numberriders is the number of riders in the grade.
+
+        Return a list of (points, reason) tuples, one per result
+        """
+
+        # the same table applies to the whole grade
+        if numberriders < self.tinyfield:
+            table = [self.tinywinner]
+            field = "small race < %d riders" % self.tinyfield
+            unplaced = "Participation, " + field
+        elif numberriders <= self.smallthreshold:
+            table = self.smallpoints
+            field = "race <= %d riders" % self.smallthreshold
+            unplaced = "Participation, " + field
+        else:
+            table = self.points
+            field = "race"
+            unplaced = "Participation"
+
+        scores = []
+        for place, isbelow, ispromote in zip(places, below, promote):
+            if not place:
+                scores.append((self.participation, "Participation"))
+            elif ispromote:
+                scores.append((self.participation, "Rider eligible for promotion"))
+            elif isbelow:
+                scores.append((self.participation, "Riding below normal grade"))
+            elif place <= len(table):
+                scores.append((table[place - 1], "Placed %d in %s" % (place, field)))
+            else:
+                scores.append((self.participation, unplaced))
+        return scores
+
+
+# the rules for each of POINTSCORE_METHODS, Lidcombe Auburn CC
+# pointscores have always been scored with the WMCC rules
+RULES = {
+    'WMCC': ScoringRules,
+    'LACC': ScoringRules,
+}
+
+
+def rules_for(pointscore):
+    """Return the ScoringRules for the method of this pointscore"""
+
+    return RULES.get(pointscore.method, ScoringRules)(pointscore)
+
+
+class RiderTally:
+    """Points accumulated by one rider while a pointscore
+    is being calculated"""
+
+    def __init__(self, rider_id):
+        self.rider_id = rider_id
+        self.points = 0
+        self.eventcount = 0
+        self.audit = []
+
+    def add(self, points, reason, race, reason_type='result'):
+        """Same as PointscoreTally.add but in memory"""
+
+        self.points += points
+        self.eventcount += 1
+        self.audit.append((points, reason, race.id, reason_type))
+
+    def entries(self, tally):
+        """Return PointscoreAuditEntry instances for the audit trail
+        ready to be saved against a stored tally"""
+
+        return [PointscoreAuditEntry(tally=tally, points=points, reason=reason,
+                                     race_id=race_id, reason_type=reason_type)
+                for points, reason, race_id, reason_type in self.audit]
+
+
+class PointscoreCalculator:
+    """Calculate the tallies for a pointscore in memory"""
+
+    def __init__(self, pointscore):
+        self.pointscore = pointscore
+        self.rules = pointscore.get_rules()
+
+    def load(self, races):
+        """Load results and staff for a list of races in date order"""
+
+        self.races = races
+        raceids = [race.id for race in races]
+
+        self.results = defaultdict(list)
+        results = RaceResult.objects.filter(race__in=raceids)
+        for result in results.values_list('race_id', 'rider_id', 'grade', 'usual_grade', 'place', named=True):
+            self.results[result.race_id].append(result)
+
+        self.staff = defaultdict(list)
+        for staff in RaceStaff.objects.filter(race__in=raceids).select_related('role').order_by('id'):
+            self.staff[staff.race_id].append(staff)
+
+        if races:
+            clubs = set(race.club_id for race in races)
+            self.promotion = PromotionIndex(clubs, races[0].date, races[-1].date)
+
+    def score_race(self, race):
+        """Work out the points earned by each rider in one race,
+        return a dictionary of RiderTally instances keyed by rider id"""
+
+        racename = str(race)
+        results = self.results[race.id]
+
+        # score each grade in one go, keeping the scores in result order
+        bygrade = defaultdict(list)
+        for n, result in enumerate(results):
+            bygrade[result.grade].append(n)
+        scores = [None] * len(results)
+        for grade, indices in bygrade.items():
+            graderesults = [results[n] for n in indices]
+            scored = self.rules.score_grade([result.place for result in graderesults],
+                                            [result.grade > result.usual_grade for result in graderesults],
+                                            [self.promotion.promotion(race.club_id, result.rider_id, race.date)
+                                             for result in graderesults],
+                                            len(graderesults))
+            for n, score in zip(indices, scored):
+                scores[n] = score
+
+        tallies = {}
+        for result, (points, reason) in zip(results, scores):
+            if result.rider_id not in tallies:
+                tallies[result.rider_id] = RiderTally(result.rider_id)
+            tallies[result.rider_id].add(points, reason + " : " + racename, race)
+
+        # no points for helpers if there are no results for this race yet
+        if not results:
+            return tallies
+
+        # see PointScore.tally_helpers
+        for staff in self.staff[race.id]:
+            if staff.rider_id not in tallies:
+                tallies[staff.rider_id] = RiderTally(staff.rider_id)
+            tally = tallies[staff.rider_id]
+
+            # if staff also got points for the race, they get a max
+            # of 3 points for helping
+            points = 3 - tally.points
+            if points > 0:
+                tally.add(points, staff.role.name + " in race: " + racename, race, 'helper')
+
+        return tallies
+
+    def calculate(self):
+        """Work out the points for every race in the pointscore,
+        return a list of (race, tallies) in date order where tallies
+        is the result of score_race"""
+
+        self.load(list(self.pointscore.races.all().order_by('date', 'id')))
+
+        return [(race, self.score_race(race)) for race in self.races]
+
+    def lock(self):
+        """Lock the pointscore row until the end of the transaction so
+        that only one calculation at a time writes its tallies, eg. the
+        nightly rescore and a pointscorejobs worker"""
+
+        list(PointScore.objects.select_for_update().filter(pk=self.pointscore.pk))
+
+    def save(self, racetallies):
+        """Replace the stored tallies for the pointscore, called by
+        recalculate in a transaction with the pointscore locked"""
+
+        season = {}
+        racepoints = []
+        for race, tallies in racetallies:
+            for tally in tallies.values():
+                if tally.rider_id not in season:
+                    season[tally.rider_id] = RiderTally(tally.rider_id)
+                total = season[tally.rider_id]
+                total.points += tally.points
+                total.eventcount += tally.eventcount
+                total.audit.extend(tally.audit)
+
+                racepoints.append(PointscoreRacePoints(pointscore=self.pointscore,
+                                                       race=race,
+                                                       rider_id=tally.rider_id,
+                                                       points=tally.points,
+                                                       eventcount=tally.eventcount))
+
+        PointscoreRacePoints.objects.filter(pointscore=self.pointscore).delete()
+        PointscoreRacePoints.objects.bulk_create(racepoints)
+
+        PointscoreTally.objects.filter(pointscore=self.pointscore).delete()
+        stored = PointscoreTally.objects.bulk_create([
+            PointscoreTally(pointscore=self.pointscore,
+                            rider_id=tally.rider_id,
+                            points=tally.points,
+                            eventcount=tally.eventcount)
+            for tally in season.values()
+        ])
+
+        entries = []
+        for tally, total in zip(stored, season.values()):
+            entries.extend(total.entries(tally))
+        PointscoreAuditEntry.objects.bulk_create(entries)
+
+        self.pointscore.update_standings()
+
+    @transaction.atomic
+    def recalculate(self):
+        """Recalculate and store all tallies for the pointscore"""
+
+        # lock before reading so that we calculate from the latest results
+        self.lock()
+        self.save(self.calculate())
+
+    @transaction.atomic
+    def rescore_race(self, race, grades=None):
+        """Replace the points for one race, subtracting the points
+        previously stored for the race from each rider's tally and
+        adding the new ones.
+
+        If grades is given, riders with results in other grades are
+        left alone since their points can't have changed. Riders in
+        those grades, helpers and riders no longer in the race are
+        rescored.
+
+        Only this race is rescored, so if changed placings here make
+        someone eligible for promotion in later races that will only
+        show up when the pointscore is next recalculated in full."""
+
+        ps = self.pointscore
+        self.lock()
+
+        if not ps.races.filter(pk=race.pk).exists():
+            return
+
+        # tallies calculated before points were kept per race can't be
+        # adjusted, so calculate everything once
+        if ps.results.exists() and not ps.racepoints.exists():
+            self.recalculate()
+            return
+
+        self.load([race])
+        new = self.score_race(race)
+
+        keep = set()
+        if grades is not None:
+            keep = set(result.rider_id for result in self.results[race.id] if result.grade not in grades)
+            for rider_id in keep:
+                del new[rider_id]
+
+        previous = PointscoreRacePoints.objects.filter(pointscore=ps, race=race).exclude(rider__in=keep)
+        old = dict((rp.rider_id, rp) for rp in previous)
+        previous.delete()
+        PointscoreRacePoints.objects.bulk_create([
+            PointscoreRacePoints(pointscore=ps,
+                                 race=race,
+                                 rider_id=tally.rider_id,
+                                 points=tally.points,
+                                 eventcount=tally.eventcount)
+            for tally in new.values()
+        ])
+
+        riders = set(old) | set(new)
+        if not riders:
+            return
+
+        PointscoreAuditEntry.objects.filter(tally__pointscore=ps, race=race).exclude(tally__rider__in=keep).delete()
+
+        tallies = dict((t.rider_id, t) for t in PointscoreTally.objects.select_for_update().filter(pointscore=ps, rider__in=riders))
+
+        created = []
+        updated = []
+        emptied = []
+        for rider_id in riders:
+            if rider_id in tallies:
+                tally = tallies[rider_id]
+            else:
+                tally = tallies[rider_id] = PointscoreTally(pointscore=ps, rider_id=rider_id)
+
+            if rider_id in old:
+                tally.points -= old[rider_id].points
+                tally.eventcount -= old[rider_id].eventcount
+            if rider_id in new:
+                tally.points += new[rider_id].points
+                tally.eventcount += new[rider_id].eventcount
+
+            if tally.pk is None:
+                created.append(tally)
+            elif tally.eventcount > 0:
+                updated.append(tally)
+            else:
+                emptied.append(tally.pk)
+
+        PointscoreTally.objects.bulk_create(created)
+        PointscoreTally.objects.bulk_update(updated, ['points', 'eventcount'])
+        PointscoreTally.objects.filter(pk__in=emptied).delete()
+
+        entries = []
+        for rider_id, tally in new.items():
+            entries.extend(tally.entries(tallies[rider_id]))
+        PointscoreAuditEntry.objects.bulk_create(entries)
+
+        ps.update_standings()
@@ -17,6 +17,7 @@
 from django.test import TestCase
 from django.urls import reverse
 from django.contrib.auth.models import User
+from django.db import transaction
 from django_webtest import WebTest
 from webtest import Upload
 import datetime
@@ -107,6 +108,45 @@ class TidyHQTests(TestCase):
             cadel = User.objects.get(first_name="Cadel")
             self.assertEqual(cadel.rider.phone, '0400223141')
 
+    def test_update_from_spreadsheet_batches(self):
+        """Reading the spreadsheet in small batches gives the same
+        riders and memberships as reading it all at once"""
+
+        club = Club.objects.get(slug="MOV")
+
+        def snapshot():
+            return (list(Membership.objects.order_by('rider__user__username', 'date', 'club')
+                         .values_list('rider__user__username', 'club', 'date', 'category', 'add_on')),
+                    list(Rider.objects.order_by('user__username')
+                         .values_list('user__username', 'club', 'gender', 'dob', 'phone')))
+
+        with transaction.atomic():
+            with open(TESTFILE) as fd:
+                Rider.objects.update_from_tidyhq_spreadsheet(club, fd)
+            expected = snapshot()
+            transaction.set_rollback(True)
+
+        with open(TESTFILE) as fd:
+            Rider.objects.update_from_tidyhq_spreadsheet(club, fd, chunksize=1)
+        self.assertEqual(expected, snapshot())
+
+        # the category comes from the first row for a new membership,
+        # even when the next row is read in a later batch
+        header = 'Contact,ID Number,Email,Membership Level,Membership Status,Subscription End Date\n'
+        lines = [header,
+                 'Tom DUMOULIN,NED19901111,tom@example.com,Race - Annual,Active,31 Dec 2030\n',
+                 'Tom DUMOULIN,NED19901111,tom@example.com,Ride - Annual,Active,31 Dec 2030\n']
+        Rider.objects.update_from_tidyhq_spreadsheet(club, lines, chunksize=1)
+        membership = Membership.objects.get(rider__user__last_name='DUMOULIN')
+        self.assertEqual(('race', datetime.date(2030, 12, 31)), (membership.category, membership.date))
+
+    def test_update_from_spreadsheet_missing_field(self):
+        """A spreadsheet without licence numbers is rejected"""
+
+        club = Club.objects.get(slug="MOV")
+        with self.assertRaisesMessage(ValueError, "No field ID Number in uploaded spreadsheet"):
+            Rider.objects.update_from_tidyhq_spreadsheet(club, ['Contact,Email\n', 'Tom DUMOULIN,tom@example.com\n'])
+
 
 
 
@@ -20,6 +20,11 @@ from django.urls import reverse
 from django.contrib.auth.models import User
 from rest_framework.authtoken.models import Token
 from django.db.models import Max
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.test import override_settings
+from django.core.management import call_command, CommandError
+from io import StringIO
 
 from rest_framework.test import APITestCase
 
@@ -27,9 +32,11 @@ from rest_framework.test import APITestCase
 import os
 import json
 import datetime
+import tempfile
 
+from races.apps.cabici.archive import get_archive
 from races.apps.cabici.models import Club, RaceCourse, Race
-from races.apps.cabici.usermodel import Rider, RaceResult, PointScore, ClubRole, UserRole, RaceStaff, ClubGrade
+from races.apps.cabici.usermodel import Rider, RaceResult, PointScore, ClubRole, UserRole, RaceStaff, ClubGrade, PointscoreJob
 
 OGE = {
     "name": "ORICA GREENEDGE",
@@ -790,3 +797,204 @@ class APITests(APITestCase):
                                     HTTP_AUTHORIZATION="Token %s" % token.key)
 
         self.assertEqual(200, response.status_code)
+
+    def test_upload_results_bulk(self):
+        """Uploading a large field takes a fixed number of queries
+        and reports unknown riders as before"""
+
+        url = '/api/raceresults/'
+        token, created = Token.objects.get_or_create(user=self.ogeofficial)
+        race = Race.objects.all()[0]
+
+        riders = list(Rider.objects.exclude(user=self.ogeofficial)[:150])
+        # half the riders already have a grade, one of them is regraded
+        for rider in riders[:75]:
+            ClubGrade(rider=rider, club=race.club, grade='C').save()
+
+        entries = [{'rider': rider.id, 'grade': 'B', 'number': n, 'place': n if n <= 5 else 0}
+                   for n, rider in enumerate(riders, 1)]
+        entries[0]['grade_change'] = 'y'
+        entries.append({'rider': 999999, 'grade': 'B', 'number': 500})
+        entries.append({'rider': 'ID123', 'grade': 'B', 'number': 501})
+        payload = {'race': race.id, 'entries': entries}
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url, json.dumps(payload),
+                                        content_type='application/json',
+                                        HTTP_AUTHORIZATION="Token %s" % token.key)
+        self.assertEqual(200, response.status_code)
+        self.assertLess(len(queries), 30)
+
+        self.assertEqual(["Rider (id=999999) not found for result (B/500)",
+                          "Ignored result record with unknown temporary rider ID (B/501)"],
+                         response.json()['errors'])
+        self.assertEqual(150, race.raceresult_set.count())
+        self.assertEqual('B', race.club.grade(riders[0]))
+        self.assertEqual('C', race.raceresult_set.get(rider=riders[0]).usual_grade)
+        self.assertEqual('C', race.club.grade(riders[1]))
+        self.assertEqual('B', race.club.grade(riders[100]))
+        self.assertEqual('B', race.raceresult_set.get(rider=riders[100]).usual_grade)
+
+    def test_upload_results_new_riders(self):
+        """New rider records are looked up together, not one by one"""
+
+        url = '/api/raceresults/'
+        token, created = Token.objects.get_or_create(user=self.ogeofficial)
+        race = Race.objects.all()[0]
+
+        def payload(numbers):
+            riders = [{'id': 'ID%d' % n, 'first_name': 'New', 'last_name': 'Rider%d' % n,
+                       'licenceno': 'NEW%d' % n, 'clubslug': race.club.slug, 'member_date': '2030-12-31',
+                       'grade': 'C'}
+                      for n in numbers]
+            entries = [{'rider': 'ID%d' % n, 'grade': 'C', 'number': n + 1, 'place': 0} for n in numbers]
+            return {'race': race.id, 'riders': riders, 'entries': entries}
+
+        def lookups(data):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(url, json.dumps(data),
+                                            content_type='application/json',
+                                            HTTP_AUTHORIZATION="Token %s" % token.key)
+            self.assertEqual(200, response.status_code)
+            tables = ('"cabici_club"', '"cabici_membership"', '"cabici_clubgrade"')
+            return len([q for q in queries if q['sql'].startswith('SELECT') and any(t in q['sql'] for t in tables)])
+
+        # all new, then all known already
+        self.assertEqual(lookups(payload(range(2))), lookups(payload(range(10, 16))))
+        self.assertEqual(lookups(payload(range(2))), lookups(payload(range(10, 16))))
+        self.assertEqual(6, race.raceresult_set.count())
+        rider = Rider.objects.get(user__last_name='Rider15')
+        self.assertEqual('C', race.club.grade(rider))
+        self.assertEqual(race.club, rider.current_membership.club)
+
+    def test_upload_results_archive(self):
+        """Uploads are kept in a compressed archive and can be
+        read back for a race"""
+
+        url = '/api/raceresults/'
+        token, created = Token.objects.get_or_create(user=self.ogeofficial)
+        race, other = Race.objects.all()[:2]
+        riders = list(Rider.objects.exclude(user=self.ogeofficial)[:3])
+
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(SAVE_RESULT_UPLOADS=True, SAVE_RESULT_UPLOADS_DIR=directory):
+                payloads = []
+                # the last upload repeats the one before, it is archived
+                # even though there is nothing to change
+                for n, target in enumerate([race, other, race, race]):
+                    payload = {'race': target.id, 'entries': [{'rider': riders[min(n, 2)].id, 'grade': 'A', 'number': 1}]}
+                    payloads.append(payload)
+                    response = self.client.post(url, json.dumps(payload),
+                                                content_type='application/json',
+                                                HTTP_AUTHORIZATION="Token %s" % token.key)
+                    self.assertEqual(200, response.status_code)
+
+                archive = get_archive(directory)
+                archive.flush()
+
+                self.assertEqual([payloads[0], payloads[2], payloads[3]], [data for when, data in archive.history(race.id)])
+                self.assertEqual([payloads[1]], [data for when, data in archive.history(other.id)])
+                # one archive and index for the day
+                self.assertEqual(2, len(os.listdir(directory)))
+
+    def test_replay_uploads(self):
+        """Archived uploads can be replayed through the API and
+        the changes are rolled back"""
+
+        race = Race.objects.all()[0]
+        riders = list(Rider.objects.exclude(user=self.ogeofficial)[:3])
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+
+        with tempfile.TemporaryDirectory() as directory:
+            archive = get_archive(directory)
+            for n in range(1, 4):
+                archive.submit(race.id, {'race': race.id,
+                                         'entries': [{'rider': rider.id, 'grade': 'A', 'number': i, 'place': i}
+                                                     for i, rider in enumerate(riders[:n], 1)]})
+            archive.flush()
+
+            # the default database has to be asked for
+            with self.assertRaises(CommandError):
+                call_command('replayuploads', directory, stdout=StringIO())
+            with self.assertRaises(CommandError):
+                call_command('replayuploads', directory, database='nosuchdb', stdout=StringIO())
+
+            output = os.path.join(directory, 'replay.json')
+            stdout = StringIO()
+            call_command('replayuploads', directory, allow_default=True, output=output, stdout=stdout)
+
+            with open(output) as fd:
+                report = json.load(fd)
+
+        self.assertEqual(3, report['uploads'])
+        self.assertEqual(0, report['errors'])
+        self.assertGreater(report['queries']['total'], 0)
+        self.assertEqual([str(race.id)], list(report['checksums']))
+        self.assertIn('latency p50', stdout.getvalue())
+        self.assertEqual(0, race.raceresult_set.count())
+
+    def test_upload_results_diff(self):
+        """Repeating an upload changes nothing, a changed upload
+        only changes the results that differ and queues a rescore
+        of the grades that changed"""
+
+        url = '/api/raceresults/'
+        token, created = Token.objects.get_or_create(user=self.ogeofficial)
+        race = Race.objects.all()[0]
+        ps = PointScore.objects.create(club=race.club, name="Series")
+        ps.races.add(race)
+
+        riders = list(Rider.objects.exclude(user=self.ogeofficial)[:20])
+        entries = [{'rider': rider.id, 'grade': 'A' if n <= 10 else 'B', 'number': n, 'place': n % 10 if n % 10 <= 3 else 0}
+                   for n, rider in enumerate(riders, 1)]
+        payload = {'race': race.id, 'entries': entries}
+
+        def upload():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(url, json.dumps(payload),
+                                            content_type='application/json',
+                                            HTTP_AUTHORIZATION="Token %s" % token.key)
+            self.assertEqual(200, response.status_code)
+            return response, [q['sql'] for q in queries if not q['sql'].startswith('SELECT')]
+
+        upload()
+        self.assertEqual(20, race.raceresult_set.count())
+        ids = dict(race.raceresult_set.values_list('rider_id', 'id'))
+        PointscoreJob.objects.all().delete()
+
+        # the same upload again writes nothing
+        response, writes = upload()
+        self.assertEqual('race results uploaded', response.json()['message'])
+        self.assertEqual([], [sql for sql in writes if 'cabici_' in sql])
+        self.assertEqual(0, PointscoreJob.objects.count())
+
+        # a result changed some other way, eg. the web form, means the
+        # same upload has to be applied again to put it back
+        result = race.raceresult_set.get(rider=riders[0])
+        response = self.client.patch('/api/raceresults/%d/' % result.id, json.dumps({'place': 5}),
+                                     content_type='application/json',
+                                     HTTP_AUTHORIZATION="Token %s" % token.key)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(5, race.raceresult_set.get(rider=riders[0]).place)
+        self.assertEqual('', Race.objects.get(pk=race.pk).results_hash)
+        upload()
+        self.assertEqual(1, race.raceresult_set.get(rider=riders[0]).place)
+        PointscoreJob.objects.all().delete()
+
+        # change a place in B grade, drop a rider from B grade
+        entries[12]['place'] = 3
+        del entries[19]
+        upload()
+
+        self.assertEqual(19, race.raceresult_set.count())
+        self.assertEqual(3, race.raceresult_set.get(rider=riders[12]).place)
+        # unchanged rows were left alone
+        self.assertEqual(ids, dict(race.raceresult_set.values_list('rider_id', 'id')) | {riders[19].id: ids[riders[19].id]})
+        job = PointscoreJob.objects.get()
+        self.assertEqual(['B'], job.grade_list())
+
+        # a new upload for the race is merged into the pending job
+        entries[0]['place'] = 0
+        upload()
+        job = PointscoreJob.objects.get()
+        self.assertEqual(['A', 'B'], job.grade_list())
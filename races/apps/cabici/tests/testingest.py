@@ -14,12 +14,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from django.conf import settings
 from django.test import TestCase
 from django.urls import reverse
+from django.utils import timezone
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from io import StringIO
+from unittest import mock
+import json
+import os
+import tempfile
+import requests
 import vcr
 
 from races.apps.cabici.models import Club, RaceCourse, Race
-from races.ingest import lacc
+from races.apps.cabici.ingest import ingest_clubs, due_clubs, date_window
+from races.apps.cabici.management.commands.benchscrapers import recorded_page
+from races.ingest import lacc, registry, waratahs
+from races.ingest.fetch import fetch, FetchError, FetchCache, NotModified
+from races.ingest.ical import read_calendar
+from races.ingest.scrape import race_hash
+import datetime as dt
 from datetime import datetime, timedelta
 
 
@@ -234,3 +251,326 @@ class IngestTests():
         self.assertEqual(33, len(races))
 
         self.assertEqual("Seniors Track Training", races[0]['title'])
+
+
+class IngestRunnerTests(TestCase):
+
+    fixtures = ['clubs', 'courses']
+
+    def setUp(self):
+
+        self.manly = Club.objects.create(slug='TESTMWCC', name="Manly Warringah Cycling Club")
+        self.manly.icalurl = "https://www.google.com/calendar/ical/account%40manlywarringahcc.org.au/public/basic.ics"
+        self.manly.icalpatterns = "Race"
+        self.manly.save()
+
+        self.cccc = Club.objects.create(slug='TESTCCCC', name="Central Coast Cycling Club")
+        self.cccc.icalurl = "file:" + os.path.join(os.path.dirname(__file__), "cccc.ical")
+        self.cccc.save()
+
+        self.broken = Club.objects.create(slug='TESTBROKEN', name="Broken Cycling Club")
+        self.broken.icalurl = "file:/does/not/exist.ics"
+        self.broken.save()
+
+    @vcr.use_cassette('fixtures/vcr_cassettes/manly.yaml')
+    def test_ingest_clubs(self):
+        """Clubs are fetched concurrently and a failing source
+        doesn't stop the others"""
+
+        results = dict((result.club.slug, result) for result in
+                       ingest_clubs([self.manly, self.cccc, self.broken], workers=3))
+
+        self.assertEqual(48, len(results['TESTMWCC'].races))
+        self.assertEqual(10, len(results['TESTCCCC'].races))
+        self.assertEqual([], results['TESTBROKEN'].races)
+        self.assertEqual(["Bad URL: file:/does/not/exist.ics"], results['TESTBROKEN'].errors)
+        self.assertEqual(48, Race.objects.filter(club=self.manly).count())
+
+        # a second run finds the same races but doesn't add them again
+        results = list(ingest_clubs([self.cccc], workers=2))
+        self.assertEqual(10, results[0].found)
+        self.assertEqual([], results[0].races)
+
+    @vcr.use_cassette('fixtures/vcr_cassettes/manly.yaml')
+    def test_ingest_command(self):
+        """The ingest command reports races and timings for each club"""
+
+        out = StringIO()
+        call_command('ingest', 'TESTMWCC', 'TESTCCCC', 'TESTBROKEN', '--no-cache', '--all-dates', workers=2, retries=0, stdout=out)
+
+        self.assertIn("Club: TESTMWCC found 48 races, 48 new", out.getvalue())
+        self.assertIn("Club: TESTBROKEN error: Bad URL", out.getvalue())
+        self.assertIn("Ingested 58 new races from 3 clubs in", out.getvalue())
+
+    def test_fetch_retries(self):
+        """Failed fetches are retried with a backoff, client errors aren't"""
+
+        ok = mock.Mock(status_code=200, content=b'calendar')
+        unavailable = mock.Mock(status_code=503, content=b'')
+        with mock.patch('requests.get', side_effect=[requests.ConnectionError(), unavailable, ok]) as get, \
+                mock.patch('time.sleep') as sleep:
+            self.assertEqual(b'calendar', fetch('http://example.com/', connect_timeout=2, read_timeout=7,
+                                                retries=2, backoff=0.5))
+
+        self.assertEqual(3, get.call_count)
+        self.assertEqual((2, 7), get.call_args.kwargs['timeout'])
+        self.assertEqual([mock.call(0.5), mock.call(1.0)], sleep.call_args_list)
+
+        notfound = mock.Mock(status_code=404, content=b'')
+        with mock.patch('requests.get', return_value=notfound) as get, mock.patch('time.sleep'):
+            with self.assertRaises(FetchError) as cm:
+                fetch('http://example.com/', retries=2)
+        self.assertEqual(1, get.call_count)
+        self.assertEqual(404, cm.exception.status)
+
+        with mock.patch('requests.get', side_effect=requests.Timeout()) as get, mock.patch('time.sleep'):
+            with self.assertRaises(FetchError):
+                fetch('http://example.com/', retries=1)
+        self.assertEqual(2, get.call_count)
+
+    def test_fetch_cache(self):
+        """Cached URLs are fetched with conditional requests and
+        unchanged content is reported"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = FetchCache(directory)
+            url = 'http://example.com/calendar.ics'
+
+            first = mock.Mock(status_code=200, content=b'calendar',
+                              headers={'ETag': '"v1"', 'Last-Modified': 'Sat, 02 Mar 2024 10:00:00 GMT'})
+            with mock.patch('requests.get', return_value=first) as get:
+                self.assertEqual(b'calendar', fetch(url, cache=cache, only_changed=True))
+            self.assertNotIn('If-None-Match', get.call_args.kwargs['headers'])
+            # nothing is stored until it is committed
+            self.assertIsNone(cache.get(url))
+            cache.commit()
+            self.assertEqual('"v1"', cache.get(url)['etag'])
+
+            # the server says it hasn't changed
+            notmodified = mock.Mock(status_code=304, content=b'', headers={})
+            with mock.patch('requests.get', return_value=notmodified) as get:
+                with self.assertRaises(NotModified):
+                    fetch(url, cache=cache, only_changed=True)
+                self.assertEqual(b'calendar', fetch(url, cache=cache))
+            self.assertEqual('"v1"', get.call_args.kwargs['headers']['If-None-Match'])
+            self.assertEqual('Sat, 02 Mar 2024 10:00:00 GMT', get.call_args.kwargs['headers']['If-Modified-Since'])
+
+            # no validators but the same body
+            same = mock.Mock(status_code=200, content=b'calendar', headers={})
+            with mock.patch('requests.get', return_value=same):
+                with self.assertRaises(NotModified):
+                    fetch(url, cache=cache, only_changed=True)
+                # read with a different key it has changed
+                self.assertEqual(b'calendar', fetch(url, cache=cache, only_changed=True, key=['2024-03-02']))
+            with mock.patch('requests.get', return_value=notmodified):
+                self.assertEqual(b'calendar', fetch(url, cache=cache, only_changed=True, key=['2024-03-02']))
+            cache.commit()
+            with mock.patch('requests.get', return_value=notmodified):
+                with self.assertRaises(NotModified):
+                    fetch(url, cache=cache, only_changed=True, key=['2024-03-02'])
+
+            changed = mock.Mock(status_code=200, content=b'new calendar', headers={})
+            with mock.patch('requests.get', return_value=changed):
+                self.assertEqual(b'new calendar', fetch(url, cache=cache, only_changed=True))
+            cache.commit()
+
+            # offline uses the cached copy
+            with mock.patch('requests.get') as get:
+                self.assertEqual(b'new calendar', fetch(url, cache=cache, offline=True))
+                with self.assertRaises(FetchError):
+                    fetch('http://example.com/other.ics', cache=cache, offline=True)
+            self.assertEqual(0, get.call_count)
+
+    def test_ingest_clubs_cache(self):
+        """Unchanged sources are skipped and cached ones can
+        be reprocessed offline"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = FetchCache(directory)
+
+            with vcr.use_cassette('fixtures/vcr_cassettes/manly.yaml', allow_playback_repeats=True):
+                result, = ingest_clubs([self.manly], cache=cache, only_changed=True)
+                self.assertEqual(48, len(result.races))
+                self.assertFalse(result.unchanged)
+
+                result, = ingest_clubs([self.manly], cache=cache, only_changed=True)
+                self.assertTrue(result.unchanged)
+                self.assertEqual(0, result.found)
+
+                # a new window of dates reads the same calendar again
+                window = date_window(today=dt.date(2024, 3, 2))
+                result, = ingest_clubs([self.manly], cache=cache, only_changed=True, window=window)
+                self.assertFalse(result.unchanged)
+                result, = ingest_clubs([self.manly], cache=cache, only_changed=True, window=window)
+                self.assertTrue(result.unchanged)
+
+            Race.objects.filter(club=self.manly).delete()
+            with mock.patch('requests.get') as get:
+                result, = ingest_clubs([self.manly], cache=cache, offline=True)
+            self.assertEqual(0, get.call_count)
+            self.assertEqual(48, len(result.races))
+
+    def test_ingest_clubs_cache_errors(self):
+        """A source that fails to parse isn't skipped as unchanged
+        on the next run"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = FetchCache(directory)
+
+            with vcr.use_cassette('fixtures/vcr_cassettes/manly.yaml', allow_playback_repeats=True):
+                with mock.patch('races.apps.cabici.models.read_calendar', side_effect=ValueError):
+                    result, = ingest_clubs([self.manly], cache=cache, only_changed=True)
+                self.assertEqual(["Error reading icalendar file"], result.errors)
+                self.assertIsNone(Club.objects.get(pk=self.manly.pk).ingested)
+
+                result, = ingest_clubs([self.manly], cache=cache, only_changed=True)
+                self.assertFalse(result.unchanged)
+                self.assertEqual(48, len(result.races))
+
+    def test_ingest_race_list_queries(self):
+        """Ingesting a list of races takes a fixed number of queries"""
+
+        racedicts = [{'date': '2024-03-%02d' % (n % 28 + 1),
+                      'time': '08:00',
+                      'title': 'Race %d' % n,
+                      'location': ['Lansdowne Park', 'Heffron Park', 'Sydney Dragway Full'][n % 3],
+                      'url': 'http://example.com/',
+                      'hash': 'hash%d' % n} for n in range(300)]
+        # a repeat within the list and a bad time
+        racedicts.append(dict(racedicts[0]))
+        racedicts.append(dict(racedicts[1], hash='badtime', time="8 o'clock in the morning"))
+
+        RaceCourse.objects.find_location('warm up the index')
+        with CaptureQueriesContext(connection) as queries:
+            (races, errors) = self.cccc.ingest_race_list(racedicts)
+        # sqlite limits the number of rows in each insert
+        # hashes, race courses and the unknown race course
+        self.assertEqual(3, len([q for q in queries if q['sql'].startswith('SELECT')]))
+        self.assertLess(len(queries), 10)
+
+        self.assertEqual(300, len(races))
+        self.assertEqual(1, len(errors))
+        self.assertEqual(300, Race.objects.filter(club=self.cccc).count())
+        self.assertEqual('Lansdowne Park', Race.objects.get(hash='hash0').location.name)
+        self.assertIsNotNone(races[0].pk)
+
+        # nothing new the second time
+        with self.assertNumQueries(1):
+            (races, errors) = self.cccc.ingest_race_list(racedicts[:300])
+        self.assertEqual([], races)
+
+    def test_read_calendar(self):
+        """Only events in the date window that might match
+        the patterns are read from a calendar"""
+
+        with open(os.path.join(os.path.dirname(__file__), "manly.ics"), 'rb') as fd:
+            text = fd.read()
+
+        events = read_calendar(text).walk('VEVENT')
+        self.assertEqual(68, len(events))
+
+        def day(event):
+            start = event.decoded('DTSTART')
+            return start.date() if isinstance(start, dt.datetime) else start
+
+        window = (dt.date(2013, 1, 1), dt.date(2013, 3, 31))
+        inwindow = [e for e in events if dt.date(2012, 12, 31) <= day(e) <= dt.date(2013, 4, 1)]
+        windowed = read_calendar(text, window).walk('VEVENT')
+        self.assertGreater(len(inwindow), 0)
+        self.assertEqual([str(e['UID']) for e in inwindow], [str(e['UID']) for e in windowed])
+        # timezones are kept for the events that use them
+        self.assertEqual(1, len(read_calendar(text, window).walk('VTIMEZONE')))
+
+        races = read_calendar(text, patterns=['Race']).walk('VEVENT')
+        self.assertEqual([e for e in events if 'Race' in e['SUMMARY']], races)
+
+        with self.assertRaises(ValueError):
+            read_calendar(b'<html><body>Not a calendar</body></html>')
+
+    def test_fetch_ical_window(self):
+        """Calendar events outside the window aren't ingested"""
+
+        self.cccc.icalurl = "file:" + os.path.join(os.path.dirname(__file__), "manly.ics")
+        (racedicts, error) = self.cccc.fetch_ical()
+        self.assertEqual(68, len(racedicts))
+
+        window = (dt.date(2013, 1, 1), dt.date(2013, 3, 31))
+        (windowed, error) = self.cccc.fetch_ical(window=window)
+        self.assertEqual([r for r in racedicts if '2013-01-01' <= r['date'] <= '2013-03-31'], windowed)
+
+    def test_scrapers(self):
+        """Scrapers parse the recorded pages with stable hashes"""
+
+        cassettes = os.path.join(settings.PROJECT_DIR, 'fixtures', 'vcr_cassettes')
+        for module, cassette, count in ((lacc, 'lacc.yaml', 33), (waratahs, 'module_waratahs.yaml', 86)):
+            page = recorded_page(os.path.join(cassettes, cassette))
+            with mock.patch('sys.stdout', new_callable=StringIO):
+                races = module.parse_web_text(page)
+                again = module.parse_web_text(page)
+            self.assertEqual(count, len(races))
+            self.assertEqual([r['hash'] for r in races], [r['hash'] for r in again])
+            self.assertEqual(len(races), len(set(r['hash'] for r in races)))
+
+        self.assertEqual(race_hash({'title': 'Critérium', 'date': '2023-01-01'}),
+                         race_hash({'date': '2023-01-01', 'title': 'Critérium'}))
+        self.assertNotEqual(race_hash('a', 'b'), race_hash('ab'))
+
+    def test_benchscrapers_command(self):
+        """benchscrapers reports times for each source"""
+
+        out = StringIO()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output = os.path.join(tmpdir, 'bench.json')
+            call_command('benchscrapers', 'waratahs', repeat=1, output=output, stdout=out)
+            with open(output) as fd:
+                report = json.load(fd)
+        self.assertIn('waratahs', out.getvalue())
+        self.assertEqual(86, report['results']['waratahs']['races'])
+
+    def test_registry(self):
+        """Clubs find their ingest source in the registry and
+        parsers are imported when first used"""
+
+        source = registry.register('TESTLAZY', registry.SCRAPER, 'races.ingest.waratahs')
+        self.addCleanup(registry.unregister, 'TESTLAZY')
+
+        self.assertIs(source, registry.get('testlazy'))
+        self.assertEqual(timedelta(days=1), source.interval)
+        self.assertIsNone(source._parser)
+        self.assertIs(waratahs, source.parser)
+
+        self.assertEqual(registry.SCRAPER, registry.get('LACC').kind)
+        self.assertIsNone(registry.get('TESTNONE'))
+        self.assertEqual(registry.ICAL, registry.source_for(self.manly).kind)
+        nosource = Club.objects.create(slug='TESTNONE', name="No Source Cycling Club")
+        self.assertIsNone(registry.source_for(nosource))
+        self.assertEqual(([], 'No ingest module for club "testnone"'), nosource.fetch_races())
+
+        with self.assertRaises(ValueError):
+            registry.register('TESTBAD', 'carrier-pigeon', 'races.ingest.lacc')
+
+        now = timezone.now()
+        self.assertTrue(source.is_due(None, now))
+        self.assertFalse(source.is_due(now - timedelta(hours=23), now))
+        self.assertTrue(source.is_due(now - timedelta(days=1), now))
+
+    def test_ingest_clubs_due(self):
+        """Only clubs that are due are fetched, clubs with
+        errors are tried again on the next run"""
+
+        nosource = Club.objects.create(slug='TESTNONE', name="No Source Cycling Club")
+        clubs = [self.cccc, self.broken, nosource]
+
+        results = dict((result.club.slug, result) for result in ingest_clubs(clubs, due_only=True))
+        self.assertEqual(['TESTBROKEN', 'TESTCCCC'], sorted(results))
+        self.assertEqual(10, len(results['TESTCCCC'].races))
+
+        clubs = list(Club.objects.filter(slug__in=['TESTCCCC', 'TESTBROKEN', 'TESTNONE']))
+        self.assertIsNotNone(Club.objects.get(slug='TESTCCCC').ingested)
+        self.assertIsNone(Club.objects.get(slug='TESTBROKEN').ingested)
+        self.assertEqual([self.broken], due_clubs(clubs))
+        self.assertEqual(['TESTBROKEN'], [result.club.slug for result in ingest_clubs(clubs, due_only=True)])
+
+        # after the interval the calendar is due again
+        later = timezone.now() + registry.INTERVALS[registry.ICAL]
+        self.assertEqual(['TESTBROKEN', 'TESTCCCC'], sorted(club.slug for club in due_clubs(clubs, later)))
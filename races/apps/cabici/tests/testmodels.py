@@ -59,3 +59,35 @@ class ModelTests(TestCase):
         self.assertTrue(str(race).find(title) >= 0)
 
         self.assertEqual(race.get_absolute_url(), "/races/TEST/1")
+
+    def test_closest(self):
+        """Approximate matching of clubs and race courses uses a
+        shared index that is rebuilt when they change"""
+
+        mov = Club.objects.create(name="Movistar", website="http://example.com/", slug="MOVISTAR")
+        Club.objects.create(name="Orica", website="http://example.com/", slug="ORICA")
+        course = RaceCourse.objects.create(name="Heffron Park", location="-33.9,151.2")
+
+        self.assertEqual(mov, Club.objects.closest("MOVISTR"))
+        # no query to build the index the second time
+        with self.assertNumQueries(1):
+            self.assertEqual({'MOVISTR': mov, 'MOVISTAR': mov}, Club.objects.closest_many(['MOVISTR', 'MOVISTAR']))
+
+        # a new club is found straight away
+        sky = Club.objects.create(name="Sky", website="http://example.com/", slug="TEAMSKY")
+        self.assertEqual(sky, Club.objects.closest("TEAMSKY"))
+
+        # a renamed club is found by its new name
+        mov.slug = "TELEFONICA"
+        mov.save()
+        self.assertEqual(mov, Club.objects.closest("TELEFONICA"))
+
+        # no match gives the unknown club
+        self.assertEqual("Unknown", Club.objects.closest("ZZZZZZ").slug)
+        # spreadsheet cells that aren't strings are matched as strings and keep their key
+        unknown = Club.objects.get(slug="Unknown")
+        self.assertEqual({1234: unknown, None: unknown}, Club.objects.closest_many([1234, None]))
+
+        self.assertEqual(course, RaceCourse.objects.find_location("Heffron Pk"))
+        course.delete()
+        self.assertEqual("Unknown", RaceCourse.objects.find_location("Heffron Pk").name)
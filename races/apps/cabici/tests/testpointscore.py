@@ -15,11 +15,23 @@
 # limitations under the License.
 
 from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+from django.core.management import call_command
+from io import StringIO
+from unittest import mock
+from contextlib import redirect_stdout
+import tempfile
+import json
+import os
 import random
 import time
 
 from races.apps.cabici.models import Club, Race, RaceCourse
 from races.apps.cabici.usermodel import *
+from races.apps.cabici.scoring import PointscoreCalculator
 from datetime import datetime, timedelta
 
 
@@ -72,6 +84,35 @@ class PointscoreTests(TestCase):
         self.assertEqual((3, 'Placed 1 in small race < 6 riders'), ps.score(place(1), 3))
         self.assertEqual((2, 'Participation, small race < 6 riders'), ps.score(place(2), 3))
 
+    def test_scoring_rules(self):
+        """Scoring rules follow the point tables on the pointscore
+        and score a whole grade at once"""
+
+        from races.apps.cabici.scoring import ScoringRules
+
+        club = Club.objects.get(slug='OGE')
+        ps = PointScore(club=club, name="Test", points="10,8,6", smallpoints="4",
+                        smallthreshold=8, participation=1, method='LACC')
+        rules = ps.get_rules()
+        self.assertIsInstance(rules, ScoringRules)
+        self.assertIsInstance(PointScore(club=club, name="Other").get_rules(), ScoringRules)
+
+        places = [1, 2, 3, 4, 0, 1]
+        below = [False, False, False, False, False, True]
+        promote = [False, True, False, False, False, False]
+        self.assertEqual([(10, 'Placed 1 in race'),
+                          (1, 'Rider eligible for promotion'),
+                          (6, 'Placed 3 in race'),
+                          (1, 'Participation'),
+                          (1, 'Participation'),
+                          (1, 'Riding below normal grade')],
+                         rules.score_grade(places, below, promote, 9))
+
+        self.assertEqual([(4, 'Placed 1 in race <= 8 riders'), (1, 'Participation, race <= 8 riders')],
+                         rules.score_grade([1, 2], [False, False], [False, False], 8))
+        self.assertEqual([(3, 'Placed 1 in small race < 6 riders'), (1, 'Participation, small race < 6 riders')],
+                         rules.score_grade([1, 2], [False, False], [False, False], 5))
+
     def test_points(self):
         """Getting points for a race result"""
 
@@ -305,6 +346,48 @@ class PointscoreTests(TestCase):
         self.assertEqual(None, club.grade(rider))
         self.assertFalse(club.promotion(rider))
 
+    def test_promotion_index(self):
+        """PromotionIndex should agree with Club.promotion on any date"""
+
+        from races.apps.cabici.scoring import PromotionIndex
+
+        club = Club.objects.get(slug='OGE')
+        self.generate_races(club, 20)
+        self.generate_results()
+
+        # make sure at least one rider is eligible
+        winner = RaceResult.objects.filter(grade='B', place=1)[0].rider
+        for result in RaceResult.objects.filter(grade='B', place=1).exclude(race__raceresult__rider=winner)[:3]:
+            result.rider = winner
+            result.save()
+
+        # grade the riders with the grade they raced in, with a few
+        # graded differently so their placings don't count
+        for n, result in enumerate(RaceResult.objects.filter(race=Race.objects.all()[0])):
+            grade = result.grade if n % 5 else 'C'
+            ClubGrade.objects.update_or_create(club=club, rider=result.rider, defaults={'grade': grade})
+        ClubGrade.objects.update_or_create(club=club, rider=winner, defaults={'grade': 'B'})
+
+        riders = Rider.objects.filter(raceresult__race__club=club).distinct()
+        dates = [race.date for race in Race.objects.all()[::4]] + [datetime.today().date()]
+
+        index = PromotionIndex([club.id], min(dates), max(dates))
+        for rider in riders:
+            for when in dates:
+                report = club.performancereport(rider, when)
+                self.assertEqual({'wins': report['wins'], 'places': report['places']},
+                                 index.report(club.id, rider.id, when))
+                self.assertEqual(club.promotion(rider, when), index.promotion(club.id, rider.id, when))
+
+        promotable = [rider for rider in riders if club.promotion(rider)]
+        self.assertGreater(len(promotable), 0)
+        self.assertEqual(sorted(promotable, key=lambda r: r.id), sorted(club.promotable(), key=lambda r: r.id))
+
+        # and the promotion page lists them
+        response = self.client.get(reverse('club_riders_promotion', kwargs={'slug': club.slug}))
+        for rider in promotable:
+            self.assertContains(response, reverse('rider', kwargs={'pk': rider.user.id}))
+
     def test_points_promotion(self):
         """A rider who is eligible for promotion shouldn't
         get more than 2 points """
@@ -435,3 +518,458 @@ class PointscoreTests(TestCase):
         # this rider should get winning points for all five races
         pst = PointscoreTally.objects.get(rider=rider)
         self.assertEqual(35, pst.points)
+
+    def recalculate_by_result(self, ps):
+        """Recalculate a pointscore one result at a time, the way
+        recalculate worked before the batch calculation"""
+
+        PointscoreTally.objects.filter(pointscore=ps).delete()
+        PointscoreRacePoints.objects.filter(pointscore=ps).delete()
+        for race in ps.races.all().order_by('date', 'id'):
+            for result in race.raceresult_set.all():
+                ps.tally(result)
+            ps.tally_helpers(race)
+
+        return dict((t.rider, (t.points, t.eventcount, t.audit_trail()))
+                    for t in PointscoreTally.objects.filter(pointscore=ps))
+
+    def test_recalculate_matches_tally(self):
+        """Batch recalculation gives the same tallies as tallying
+        each result in turn"""
+
+        club = Club.objects.get(slug='OGE')
+        ps = PointScore(club=club, name="Test")
+        ps.save()
+
+        self.generate_races(club, 8)
+        ps.races.set(club.races.all())
+        self.generate_results()
+
+        races = list(ps.races.all().order_by('date'))
+        # one rider wins enough B grade races to be eligible for promotion
+        rider = Rider.objects.exclude(pointscoretally__points__gt=0)[0]
+        ClubGrade(rider=rider, club=club, grade='B').save()
+        for race in races[:5]:
+            winner = RaceResult.objects.get(race=race, place=1, grade='B')
+            winner.rider = rider
+            winner.save()
+        # someone rides below their usual grade
+        result = RaceResult.objects.filter(race=races[5], grade='C', place=1)[0]
+        result.usual_grade = 'A'
+        result.save()
+
+        # helpers, some of whom also raced
+        clubrole, created = ClubRole.objects.get_or_create(name="Test Helper")
+        for race in races[:4]:
+            RaceStaff(rider=race.raceresult_set.all()[0].rider, race=race, role=clubrole).save()
+            RaceStaff(rider=rider, race=race, role=clubrole).save()
+
+        expected = self.recalculate_by_result(ps)
+
+        with CaptureQueriesContext(connection) as queries:
+            ps.recalculate()
+        # a handful of queries regardless of the number of results,
+        # bulk inserts are split into batches by the database backend
+        queries = [q for q in queries if not q['sql'].startswith('INSERT')]
+        self.assertLess(len(queries), 20)
+
+        tallies = dict((t.rider, (t.points, t.eventcount, t.audit_trail()))
+                       for t in PointscoreTally.objects.filter(pointscore=ps))
+        self.assertEqual(expected, tallies)
+
+    def tallies(self, ps):
+        """Return the stored tallies for a pointscore as a dictionary"""
+
+        return dict((t.rider, (t.points, t.eventcount, t.audit_trail()))
+                    for t in PointscoreTally.objects.filter(pointscore=ps))
+
+    def test_rescore_race(self):
+        """Uploading new results for one race only rescores that race
+        and gives the same tallies as a full recalculation"""
+
+        club = Club.objects.get(slug='OGE')
+        ps = PointScore(club=club, name="Test")
+        ps.save()
+
+        self.generate_races(club, 6)
+        ps.races.set(club.races.all())
+        self.generate_results()
+        ps.recalculate()
+
+        race = ps.races.all().order_by('date')[2]
+        clubrole, created = ClubRole.objects.get_or_create(name="Test Helper")
+
+        # swap 4th and 5th in D grade, these places don't count for promotion
+        fourth = RaceResult.objects.get(race=race, grade='D', place=4)
+        fifth = RaceResult.objects.get(race=race, grade='D', place=5)
+        fourth.place, fifth.place = 5, 4
+        fourth.save()
+        fifth.save()
+        # remove a rider who didn't place and make them a helper instead
+        unplaced = RaceResult.objects.filter(race=race, grade='C', place=0)[0]
+        unplaced.delete()
+        RaceStaff(rider=unplaced.rider, race=race, role=clubrole).save()
+        # add a rider who hasn't raced before
+        newrider = Rider.objects.exclude(raceresult__isnull=False)[0]
+        RaceResult(race=race, rider=newrider, grade='C', usual_grade='C', number=999, place=0).save()
+
+        with CaptureQueriesContext(connection) as queries:
+            race.tally_pointscores()
+        # a fixed number of queries, including rebuilding the standings
+        queries = [q for q in queries if not q['sql'].startswith('INSERT')]
+        self.assertLess(len(queries), 25)
+
+        rescored = self.tallies(ps)
+        self.assertIn(newrider, rescored)
+        self.assertEqual(3, PointscoreRacePoints.objects.get(pointscore=ps, race=race, rider=unplaced.rider).points)
+
+        ps.recalculate()
+        self.assertEqual(self.tallies(ps), rescored)
+
+    def test_rescore_race_grades(self):
+        """Rescoring only the grades that changed leaves the points
+        of other riders alone and gives the same tallies as a full
+        recalculation"""
+
+        club = Club.objects.get(slug='OGE')
+        ps = PointScore(club=club, name="Test")
+        ps.save()
+
+        self.generate_races(club, 4)
+        ps.races.set(club.races.all())
+        self.generate_results()
+        ps.recalculate()
+
+        race = ps.races.all().order_by('date')[1]
+        clubrole, created = ClubRole.objects.get_or_create(name="Test Helper")
+
+        fourth = RaceResult.objects.get(race=race, grade='D', place=4)
+        fourth.place = 1
+        fourth.save()
+        unplaced = RaceResult.objects.filter(race=race, grade='D', place=0)[0]
+        unplaced.delete()
+        RaceStaff(rider=unplaced.rider, race=race, role=clubrole).save()
+
+        others = dict(PointscoreRacePoints.objects.filter(race=race).exclude(
+            rider__raceresult__race=race, rider__raceresult__grade='D').exclude(
+            rider=unplaced.rider).values_list('rider_id', 'id'))
+
+        ps.rescore_race(race, grades=['D'])
+        rescored = self.tallies(ps)
+
+        # rows for riders in other grades were not replaced
+        self.assertEqual(others, dict(PointscoreRacePoints.objects.filter(rider__in=list(others), race=race).values_list('rider_id', 'id')))
+        self.assertEqual(3, PointscoreRacePoints.objects.get(pointscore=ps, race=race, rider=unplaced.rider).points)
+
+        ps.recalculate()
+        self.assertEqual(self.tallies(ps), rescored)
+
+    def test_rescore_race_remove_rider(self):
+        """A rider whose only result is removed drops out of the pointscore"""
+
+        club = Club.objects.get(slug='OGE')
+        ps = PointScore(club=club, name="Test")
+        ps.save()
+
+        self.generate_races(club, 2)
+        race = club.races.all()[0]
+        ps.races.add(race)
+
+        rider1, rider2 = Rider.objects.all()[:2]
+        RaceResult(race=race, rider=rider1, usual_grade='A', grade='A', number=12, place=1).save()
+        RaceResult(race=race, rider=rider2, usual_grade='A', grade='A', number=13, place=2).save()
+        race.tally_pointscores()
+        self.assertEqual(2, ps.tabulate().count())
+
+        RaceResult.objects.filter(race=race, rider=rider2).delete()
+        race.tally_pointscores()
+
+        table = ps.tabulate()
+        self.assertEqual(1, table.count())
+        self.assertEqual(rider1, table[0].rider)
+        self.assertEqual([[3, 'Placed 1 in small race < 6 riders : ' + str(race)]], ps.audit(rider1))
+        self.assertFalse(PointscoreRacePoints.objects.filter(rider=rider2).exists())
+
+    def test_audit_entries(self):
+        """Audit entries are stored against the race they came from
+        and the audit page shows them a page at a time"""
+
+        club = Club.objects.get(slug='OGE')
+        ps = PointScore(club=club, name="Test")
+        ps.save()
+        self.generate_races(club, 2)
+        race = club.races.all()[0]
+
+        rider = Rider.objects.all()[0]
+        tally = PointscoreTally(pointscore=ps, rider=rider)
+        tally.save()
+        for i in range(120):
+            tally.add(2, "Participation : " + str(race), race=race)
+        tally.add(3, "Helper in race: " + str(race), race=race, reason_type='helper')
+
+        self.assertEqual(243, tally.points)
+        self.assertEqual(121, tally.eventcount)
+        self.assertEqual(121, len(ps.audit(rider)))
+        self.assertEqual(1, tally.entries.filter(race=race, reason_type='helper').count())
+
+        url = reverse('pointscore-audit', kwargs={'slug': club.slug, 'pk': ps.pk, 'rider': rider.user.pk})
+        response = self.client.get(url)
+        self.assertEqual(100, len(response.context['audit']))
+        self.assertContains(response, "Participation : " + str(race))
+
+        response = self.client.get(url, {'page': 2})
+        self.assertEqual(21, len(response.context['audit']))
+        self.assertContains(response, "Helper in race: " + str(race))
+
+    def test_jobs_merge(self):
+        """Pending jobs for the same work are merged and a
+        recalculation replaces pending race jobs"""
+
+        club = Club.objects.get(slug='OGE')
+        ps = PointScore(club=club, name="Test")
+        ps.save()
+        self.generate_races(club, 3)
+        ps.races.set(club.races.all())
+        race1, race2, race3 = ps.races.all()
+
+        job1 = PointscoreJob.objects.queue(ps, race=race1)
+        self.assertEqual(job1, PointscoreJob.objects.queue(ps, race=race1))
+        job2 = PointscoreJob.objects.queue(ps, race=race2)
+        self.assertNotEqual(job1, job2)
+        self.assertEqual(2, PointscoreJob.objects.get(pk=job1.pk).requests)
+
+        # a recalculation takes over the pending races
+        full = PointscoreJob.objects.queue(ps)
+        self.assertEqual([full], list(PointscoreJob.objects.filter(pointscore=ps)))
+        self.assertEqual(4, full.requests)
+        self.assertEqual(full, PointscoreJob.objects.queue(ps, race=race3))
+
+        # once it is running, new requests make a new job
+        self.assertEqual(full, PointscoreJob.objects.claim())
+        self.assertNotEqual(full, PointscoreJob.objects.queue(ps, race=race3))
+
+    def test_jobs_claim(self):
+        """Only one job runs at a time for a pointscore"""
+
+        club = Club.objects.get(slug='OGE')
+        ps = PointScore(club=club, name="Test")
+        ps.save()
+        ps2 = PointScore(club=club, name="Test 2")
+        ps2.save()
+        self.generate_races(club, 2)
+        race = club.races.all()[0]
+        ps.races.add(race)
+        ps2.races.add(race)
+
+        first = PointscoreJob.objects.queue(ps)
+        other = PointscoreJob.objects.queue(ps2)
+
+        self.assertEqual(first, PointscoreJob.objects.claim())
+        PointscoreJob.objects.queue(ps, race=race)
+        # the race job for ps has to wait
+        self.assertEqual(other, PointscoreJob.objects.claim())
+        self.assertIsNone(PointscoreJob.objects.claim())
+
+        first.run()
+        self.assertEqual('done', first.status)
+        self.assertEqual(race, PointscoreJob.objects.claim().race)
+
+    def test_jobs_release_stale(self):
+        """Running jobs are only released when their heartbeat stops"""
+
+        club = Club.objects.get(slug='OGE')
+        ps = PointScore(club=club, name="Test")
+        ps.save()
+        ps2 = PointScore(club=club, name="Test 2")
+        ps2.save()
+
+        PointscoreJob.objects.queue(ps)
+        PointscoreJob.objects.queue(ps2)
+        alive = PointscoreJob.objects.claim()
+        dead = PointscoreJob.objects.claim()
+
+        # both started long ago, only one is still sending heartbeats
+        old = timezone.now() - timedelta(hours=2)
+        PointscoreJob.objects.filter(pk__in=[alive.pk, dead.pk]).update(started=old, heartbeat=old)
+        self.assertTrue(alive.beat())
+
+        self.assertEqual(1, PointscoreJob.objects.release_stale(timedelta(minutes=5)))
+        self.assertEqual('running', PointscoreJob.objects.get(pk=alive.pk).status)
+        self.assertEqual('failed', PointscoreJob.objects.get(pk=dead.pk).status)
+        self.assertFalse(dead.beat())
+
+    def test_results_upload_queues_job(self):
+        """Uploading results queues a job that the worker runs"""
+
+        club = Club.objects.get(slug='OGE')
+        ps = PointScore(club=club, name="Test")
+        ps.save()
+        self.generate_races(club, 2)
+        race = club.races.all()[0]
+        ps.races.add(race)
+
+        rider1, rider2 = Rider.objects.all()[:2]
+        RaceResult(race=race, rider=rider1, usual_grade='A', grade='A', number=12, place=1).save()
+        RaceResult(race=race, rider=rider2, usual_grade='A', grade='A', number=13, place=2).save()
+        race.queue_pointscores()
+        race.queue_pointscores()
+
+        self.assertEqual(0, ps.tabulate().count())
+        job = ps.jobs.get()
+        self.assertEqual(('pending', 2), (job.status, job.requests))
+
+        url = reverse('pointscore', kwargs={'slug': club.slug, 'pk': ps.pk})
+        self.assertContains(self.client.get(url), "Pending")
+
+        call_command('pointscorejobs', once=True, stdout=StringIO())
+
+        self.assertEqual('done', ps.jobs.get().status)
+        self.assertEqual(2, ps.tabulate().count())
+        self.assertContains(self.client.get(url), "Done")
+
+    def test_calculator_locks_pointscore(self):
+        """Recalculating or rescoring a race locks the pointscore first
+        so that the nightly rescore and a worker can't both write it"""
+
+        club = Club.objects.get(slug='OGE')
+        ps = PointScore(club=club, name="Test")
+        ps.save()
+        self.generate_races(club, 3)
+        ps.races.set(club.races.all())
+        self.generate_results()
+
+        with mock.patch.object(PointscoreCalculator, 'lock', autospec=True) as lock:
+            ps.recalculate()
+            self.assertTrue(lock.called)
+            lock.reset_mock()
+            ps.rescore_race(ps.races.all()[0])
+            self.assertTrue(lock.called)
+
+    def test_pointscore_command(self):
+        """The pointscore command rescores matching pointscores and
+        reports how long each one took"""
+
+        club = Club.objects.get(slug='OGE')
+        ps = PointScore(club=club, name="Test")
+        ps.save()
+        self.generate_races(club, 3)
+        ps.races.set(club.races.all())
+        self.generate_results()
+
+        out = StringIO()
+        with redirect_stdout(out):
+            call_command('pointscore', 'Test', workers=1)
+
+        self.assertGreater(ps.tabulate().count(), 0)
+        self.assertIn("Rescored " + str(ps), out.getvalue())
+        self.assertIn("Rescored 1 pointscores", out.getvalue())
+
+    def test_standings(self):
+        """The standings table follows the tallies and is served
+        by the API and the pointscore page in a few queries"""
+
+        club = Club.objects.get(slug='OGE')
+        ps = PointScore(club=club, name="Test")
+        ps.save()
+        self.generate_races(club, 4)
+        ps.races.set(club.races.all())
+        self.generate_results()
+        ps.recalculate()
+
+        def check():
+            tallies = list(ps.tabulate().order_by('-points', 'eventcount', 'id'))
+            standings = list(ps.standings.all())
+            self.assertEqual([(t.rider, t.points, t.eventcount) for t in tallies],
+                             [(s.rider, s.points, s.eventcount) for s in standings])
+            self.assertEqual(list(range(1, len(tallies) + 1)), [s.rank for s in standings])
+
+        check()
+        first = ps.standings.all()[0]
+        self.assertEqual(str(first.rider), first.name)
+        self.assertEqual(first.rider.user.id, first.userid)
+
+        # grades come from the club as they are now, without a rescore
+        ClubGrade.objects.update_or_create(club=club, rider=first.rider, defaults={'grade': 'B'})
+        self.assertEqual('B', ps.table().get(rider=first.rider).grade)
+        ClubGrade.objects.filter(club=club, rider=first.rider).update(grade='A')
+        self.assertEqual('A', ps.table().get(rider=first.rider).grade)
+
+        # rescoring one race updates the standings
+        race = ps.races.all()[0]
+        RaceResult.objects.filter(race=race, place=1).delete()
+        race.tally_pointscores()
+        check()
+        self.assertEqual('A', ps.table().get(rider=first.rider).grade)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/pointscores/%d/' % ps.pk)
+        self.assertLess(len(queries), 10)
+        results = response.json()['results']
+        self.assertEqual(ps.standings.count(), len(results))
+        self.assertEqual(1, results[0]['rank'])
+        self.assertEqual('A', [r for r in results if r['riderid'] == first.userid][0]['grade'])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('pointscore', kwargs={'slug': club.slug, 'pk': ps.pk}))
+        self.assertLess(len(queries), 15)
+        self.assertContains(response, ps.standings.all()[0].name)
+
+    def test_standings_after_race(self):
+        """Standings after a race come from the points stored for
+        each race up to that one"""
+
+        club = Club.objects.get(slug='OGE')
+        ps = PointScore(club=club, name="Test")
+        ps.save()
+        self.generate_races(club, 4)
+        ps.races.set(club.races.all())
+        self.generate_results()
+        ps.recalculate()
+
+        def points(standings):
+            return dict((s.rider_id, (s.points, s.eventcount)) for s in standings)
+
+        rounds = list(ps.rounds())
+        # after the last race we have the current standings
+        self.assertEqual(points(ps.standings.all()), points(ps.standings_after(rounds[-1])))
+
+        # after the first race we have the points for that race alone
+        first = ps.standings_after(rounds[0])
+        self.assertEqual(points(PointscoreRacePoints.objects.filter(pointscore=ps, race=rounds[0])), points(first))
+        self.assertEqual(list(range(1, len(first) + 1)), [s.rank for s in first])
+        self.assertEqual(sorted(first, key=lambda s: -s.points)[0].points, first[0].points)
+
+        # nothing is changed by asking
+        self.assertEqual(points(ps.standings.all()), points(ps.standings_after(rounds[-1])))
+
+        url = '/api/pointscores/%d/' % ps.pk
+        results = self.client.get(url, {'after_race': rounds[1].pk}).json()['results']
+        self.assertEqual([(s.userid, s.points, s.eventcount, s.rank) for s in ps.standings_after(rounds[1])],
+                         [(r['riderid'], r['points'], r['eventcount'], r['rank']) for r in results])
+        self.assertEqual(400, self.client.get(url, {'after_race': 'x'}).status_code)
+        self.assertEqual(400, self.client.get(url, {'after_race': 99999}).status_code)
+
+        page = reverse('pointscore', kwargs={'slug': club.slug, 'pk': ps.pk})
+        response = self.client.get(page, {'after_race': rounds[0].pk})
+        self.assertEqual(rounds[0], response.context['after_race'])
+        self.assertContains(response, first[0].name)
+        self.assertContains(response, "Round 4")
+
+    def test_benchmark_command(self):
+        """The benchmark writes its results and leaves no data behind"""
+
+        races = Race.objects.count()
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'bench.json')
+            call_command('benchpointscore', clubs=1, riders=40, races=3, repeat=1, seed=1,
+                         output=output, stdout=StringIO())
+            with open(output) as fd:
+                report = json.load(fd)
+
+        self.assertEqual(3, report['dataset']['races'])
+        self.assertEqual({'recalculate', 'rescore_race', 'standings', 'audit'}, set(report['results']))
+        for result in report['results'].values():
+            self.assertEqual(1, result['runs'])
+            self.assertGreater(result['queries'], 0)
+        self.assertEqual(races, Race.objects.count())
+        self.assertFalse(Club.objects.filter(name__startswith="Benchmark").exists())
@@ -18,13 +18,21 @@ from django.test import TestCase
 from django.contrib.auth.models import User
 from django.db import IntegrityError
 from django.core.exceptions import ValidationError
-from django.db import transaction
+from django.db import transaction, connection
+from django.test.utils import CaptureQueriesContext
 
 import os
 import datetime
+import tempfile
+from io import StringIO
 
-from races.apps.cabici.usermodel import Rider, RaceResult, ClubGrade, Membership
+from django.core.management import call_command
+
+from races.apps.cabici.usermodel import Rider, RaceResult, ClubGrade, Membership, UserRole, ClubRole, \
+    PointScore, PointscoreJob, PointscoreTally
+from races.apps.cabici.duplicates import find_duplicates, merge_riders
 from races.apps.cabici.models import Club, Race
+from races.apps.cabici.importers import SpreadsheetReader, SpreadsheetError, RaceResultsImport
 
 
 class UserModelTests(TestCase):
@@ -218,6 +226,33 @@ class UserModelTests(TestCase):
             result2 = RaceResult(race=race, rider=rider2, grade='A', number=21, place=3)
             result2.save()
 
+    def test_fix_small_races(self):
+        """Places in small grades are moved up so that the winner is
+        first, using the grades configured for the race"""
+
+        race = Race.objects.get(pk=1)
+        race.grading = "A,A2,B"
+        race.save()
+        riders = list(Rider.objects.all()[:30])
+
+        # a small A2 grade placed from 3, a big B grade placed from 2, C is not in the grading
+        for n, rider in enumerate(riders[:4]):
+            RaceResult(race=race, rider=rider, grade='A2', number=n, place=n + 3 if n < 3 else 0).save()
+        for n, rider in enumerate(riders[4:20]):
+            RaceResult(race=race, rider=rider, grade='B', number=n, place=n + 2 if n < 3 else 0).save()
+        for n, rider in enumerate(riders[20:25]):
+            RaceResult(race=race, rider=rider, grade='C', number=n, place=n + 2 if n < 3 else 0).save()
+
+        with self.assertNumQueries(2):
+            race.fix_small_races()
+
+        def places(grade):
+            return sorted(race.raceresult_set.filter(grade=grade).values_list('place', flat=True))
+
+        self.assertEqual([0, 1, 2, 3], places('A2'))
+        self.assertEqual([0] * 13 + [2, 3, 4], places('B'))
+        self.assertEqual([0, 0, 2, 3, 4], places('C'))
+
     def test_load_results_excel(self):
         """Load results from Excel creates riders and results"""
 
@@ -261,6 +296,78 @@ class UserModelTests(TestCase):
         self.assertIn('Added new rider record for Trisma Allan', messages)
         self.assertIn('Added new rider record for Stanisic Igor\nUpdated membership of rider Stanisic Igor of club AST to %d-12-31' % thisyear, messages)
 
+    def test_load_results_excel_queries(self):
+        """Loading results from Excel uses a bounded number of queries
+        however many rows are in the spreadsheet"""
+
+        race = Race.objects.get(pk=1)
+
+        with open(os.path.join(os.path.dirname(__file__), 'Waratahresults201536.xls'), 'rb') as fd:
+            with CaptureQueriesContext(connection) as captured:
+                race.load_excel_results(fd, "xls")
+
+        self.assertEqual(race.raceresult_set.all().count(), 116)
+        self.assertLess(len(captured), 40)
+
+    def test_spreadsheet_reader(self):
+        """SpreadsheetReader gives the rows in chunks and checks
+        the header row"""
+
+        filename = os.path.join(os.path.dirname(__file__), 'Waratahresults201536.xls')
+
+        with open(filename, 'rb') as fd:
+            chunks = list(SpreadsheetReader(fd, 'xls', required=('LicenceNo', 'Grade'), chunksize=50))
+
+        self.assertEqual([50, 50, 16], [len(chunk) for chunk in chunks])
+        self.assertEqual('VALVERDE BELMONTE', chunks[0][0]['LastName'])
+
+        with open(filename, 'rb') as fd:
+            with self.assertRaises(SpreadsheetError) as context:
+                SpreadsheetReader(fd, 'xls', required=('LicenceNo', 'Category'))
+        self.assertEqual(['Category'], context.exception.missing)
+
+        # csv values stay as strings, bytes are decoded
+        lines = [b'Name,Number\n', b'Anna,12\n', b'Bob,13\n']
+        chunks = list(SpreadsheetReader(lines, 'csv', required=('Name',), chunksize=1))
+        self.assertEqual([[{'Name': 'Anna', 'Number': '12'}], [{'Name': 'Bob', 'Number': '13'}]], chunks)
+
+    def test_load_results_excel_batches(self):
+        """Loading results in small batches gives the same results
+        as loading them all at once"""
+
+        filename = os.path.join(os.path.dirname(__file__), 'Waratahresults201536-dup.xls')
+        race = Race.objects.get(pk=1)
+
+        with open(filename, 'rb') as fd:
+            importer = RaceResultsImport(race)
+            messages = importer.load(SpreadsheetReader(fd, 'xls', chunksize=7))
+        # memberships of new riders are known by their id for later batches
+        memberships = Membership.objects.filter(date=importer.endofyear, category='race',
+                                                rider__raceresult__race=race)
+        self.assertGreater(len(importer.memberships), 7)
+        self.assertEqual(set(memberships.values_list('rider_id', 'club_id')), importer.memberships)
+        expected = list(race.raceresult_set.order_by('number').values_list('rider__licenceno', 'grade', 'number', 'place'))
+
+        # a second race so that riders are not new the second time
+        other = Race.objects.create(club=race.club, title="Other", date=race.date, signontime="08:00", location=race.location)
+        with open(filename, 'rb') as fd:
+            RaceResultsImport(other).load(SpreadsheetReader(fd, 'xls', chunksize=7))
+        self.assertEqual(expected, list(other.raceresult_set.order_by('number').values_list('rider__licenceno', 'grade', 'number', 'place')))
+        self.assertIn('Error: duplicate result discarded for rider Ryder HESJEDAL', messages)
+
+    def test_load_results_excel_bad_header(self):
+        """A spreadsheet without the required columns is rejected
+        before existing results are removed"""
+
+        race = Race.objects.get(pk=1)
+        with open(os.path.join(os.path.dirname(__file__), 'Waratahresults201536.xls'), 'rb') as fd:
+            race.load_excel_results(fd, "xls")
+
+        with self.assertRaises(SpreadsheetError):
+            race.load_excel_results([b'FirstName,LastName\n', b'Anna,Smith\n'], "csv")
+
+        self.assertEqual(race.raceresult_set.all().count(), 116)
+
     def test_load_results_excel_duplicates(self):
         """Load results from Excel creates riders and results
         check handling of duplicate entries"""
@@ -337,3 +444,132 @@ class UserModelTests(TestCase):
 
         result1 = race.raceresult_set.get(rider=rider1)
         self.assertEqual("Helper", result1.grade)
+
+
+    def make_duplicate(self, rider, first_name=None, **kwargs):
+        """A new rider record for the same person, like those
+        created by the desktop app"""
+
+        user = User.objects.create(username="dup%d" % User.objects.count(),
+                                   first_name=first_name or rider.user.first_name,
+                                   last_name=rider.user.last_name)
+        return Rider.objects.create(user=user, club=rider.club, **kwargs)
+
+    def test_find_duplicates(self):
+        """Duplicate riders are found and grouped with the rider to keep"""
+
+        rider = Rider.objects.get(licenceno='ESP19870625')
+        rider.dob = datetime.date(1987, 6, 25)
+        rider.save()
+        RaceResult.objects.create(race=Race.objects.get(pk=1), rider=rider, grade='A', number=1, place=1)
+
+        dup1 = self.make_duplicate(rider)
+        dup2 = self.make_duplicate(rider, first_name=rider.user.first_name.upper() + "X",
+                                   licenceno='ESP19870625', dob=datetime.date(1987, 6, 25))
+        # same surname but different licence and dob isn't a duplicate
+        other = self.make_duplicate(rider, first_name="Zebedee", licenceno='AUS1234', dob=datetime.date(2001, 1, 1))
+
+        groups, skipped = find_duplicates()
+        self.assertEqual([], skipped)
+
+        group = [g for g in groups if rider.id in [r.id for r in g.riders]]
+        self.assertEqual(1, len(group))
+        group = group[0]
+        self.assertEqual(rider.id, group.keep.id)
+        self.assertEqual({rider.id, dup1.id, dup2.id}, set(r.id for r in group.riders))
+        self.assertNotIn(other.id, [r.id for g in groups for r in g.riders])
+
+        points, reasons = group.pairs[(rider.id, dup2.id)]
+        self.assertIn('licence', reasons)
+        self.assertIn('dob', reasons)
+
+    def test_merge_riders(self):
+        """Merging riders moves everything that refers to them"""
+
+        rider = Rider.objects.get(licenceno='ESP19870625')
+        dup = self.make_duplicate(rider, dob=datetime.date(1987, 6, 25))
+        race1 = Race.objects.get(pk=1)
+        race2 = Race.objects.get(pk=2)
+
+        RaceResult.objects.create(race=race1, rider=rider, grade='A', number=1, place=1)
+        # duplicate result in race1 is dropped, the result in race2 is moved
+        RaceResult.objects.create(race=race1, rider=dup, grade='B', number=2, place=1)
+        RaceResult.objects.create(race=race2, rider=dup, grade='B', number=2, place=3)
+        ClubGrade.objects.create(rider=rider, club=self.oge, grade='A')
+        ClubGrade.objects.create(rider=dup, club=self.oge, grade='B')
+        ClubGrade.objects.create(rider=dup, club=self.mov, grade='C')
+        Membership.objects.create(rider=dup, club=self.mov, date=self.memberdate, category='race')
+        UserRole.objects.create(user=dup.user, club=self.mov, role=ClubRole.objects.create(name='Official'))
+
+        pointscore = PointScore.objects.create(club=self.oge, name="Test")
+        PointscoreTally.objects.create(pointscore=pointscore, rider=dup, points=5)
+
+        # the number of queries doesn't depend on the number of rows moved
+        with CaptureQueriesContext(connection) as queries:
+            merge_riders(rider, [dup])
+        self.assertLess(len(queries), 50)
+
+        self.assertFalse(Rider.objects.filter(pk=dup.pk).exists())
+        self.assertFalse(User.objects.filter(pk=dup.user.pk).exists())
+
+        self.assertEqual('A', RaceResult.objects.get(race=race1, rider=rider).grade)
+        self.assertEqual(3, RaceResult.objects.get(race=race2, rider=rider).place)
+        self.assertEqual('A', ClubGrade.objects.get(rider=rider, club=self.oge).grade)
+        self.assertEqual('C', ClubGrade.objects.get(rider=rider, club=self.mov).grade)
+        self.assertEqual(1, UserRole.objects.filter(user=rider.user, club=self.mov).count())
+        # membership from setUp was moved as well
+        self.assertEqual(2, Membership.objects.filter(rider=rider).count())
+
+        rider.refresh_from_db()
+        self.assertEqual(datetime.date(1987, 6, 25), rider.dob)
+
+        # the pointscore is recalculated
+        self.assertFalse(PointscoreTally.objects.filter(pointscore=pointscore).exists())
+        self.assertTrue(PointscoreJob.objects.filter(pointscore=pointscore, status='pending').exists())
+
+    def test_merge_riders_many(self):
+        """Merging more riders doesn't take more queries, rows that
+        clash between them are only moved once"""
+
+        race = Race.objects.get(pk=2)
+
+        def merge(rider, count, first):
+            dups = [self.make_duplicate(rider) for n in range(count)]
+            for n, dup in enumerate(dups):
+                RaceResult.objects.create(race=race, rider=dup, grade='B', number=first + n, place=n + 1)
+                ClubGrade.objects.create(rider=dup, club=self.mov, grade='C')
+            with CaptureQueriesContext(connection) as queries:
+                merge_riders(rider, dups)
+            # deleting a clashing result clears the race's upload hash from a signal
+            return dups, [q['sql'] for q in queries if not q['sql'].startswith('UPDATE "cabici_race" ')]
+
+        fewer = merge(Rider.objects.get(licenceno='ESP19870625'), 2, 10)[1]
+        rider = Rider.objects.get(licenceno='ESP19800425')
+        dups, many = merge(rider, 4, 20)
+
+        self.assertEqual(len(fewer), len(many))
+        self.assertFalse(Rider.objects.filter(pk__in=[dup.pk for dup in dups]).exists())
+        # the result of the first duplicate is kept
+        self.assertEqual(1, RaceResult.objects.get(race=race, rider=rider).place)
+        self.assertEqual(1, ClubGrade.objects.filter(rider=rider, club=self.mov).count())
+
+    def test_mergeriders_report(self):
+        """Duplicates found by mergeriders can be reviewed and merged"""
+
+        rider = Rider.objects.get(licenceno='ESP19870625')
+        dup = self.make_duplicate(rider)
+
+        with tempfile.TemporaryDirectory() as directory:
+            report = os.path.join(directory, 'duplicates.csv')
+            call_command('mergeriders', '--find-duplicates', '--report', report, stdout=StringIO(), stderr=StringIO())
+
+            with open(report) as fd:
+                rows = [line.split(',') for line in fd.read().splitlines()]
+            self.assertIn(str(dup.id), [row[2] for row in rows if row[1] == 'merge'])
+
+            out = StringIO()
+            call_command('mergeriders', '--apply', report, '--yes', stdout=out, stderr=StringIO())
+
+        self.assertIn('Merged', out.getvalue())
+        self.assertTrue(Rider.objects.filter(pk=rider.pk).exists())
+        self.assertFalse(Rider.objects.filter(pk=dup.pk).exists())
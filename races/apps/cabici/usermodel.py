@@ -15,15 +15,17 @@
 # limitations under the License.
 
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, Max, OuterRef, Q, Subquery, Sum
+from django.utils import timezone
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.urls import reverse
 from django.utils.text import slugify
 from django.utils.functional import cached_property
 
-import json
 import datetime
-import csv
+import itertools
+import traceback
 
 from races.apps.cabici.models import Club, Race
 from bs4 import BeautifulSoup
@@ -131,9 +133,12 @@ class RiderManager(models.Manager):
         else:
             return None
 
-    def update_from_tidyhq_spreadsheet(self, club, csvfile):
+    def update_from_tidyhq_spreadsheet(self, club, csvfile, chunksize=None):
         """Update the membership list for a club, from a spreadsheet
-        downloaded from TidyHQ return a list of updated riders"""
+        downloaded from TidyHQ return a list of updated riders.
+        Rows are read chunksize at a time."""
+
+        from races.apps.cabici.importers import SpreadsheetReader, SpreadsheetError
 
         updated = []
         added = []
@@ -154,9 +159,19 @@ class RiderManager(models.Manager):
         today = datetime.date.today()
         currentmembers = list(User.objects.filter(rider__club__exact=club, rider__membership__date__gte=today).distinct())
 
+        try:
+            reader = SpreadsheetReader(csvfile, 'csv', required=[fields['licence']], chunksize=chunksize)
+        except SpreadsheetError as e:
+            if e.missing:
+                raise ValueError("No field %s in uploaded spreadsheet" % fields['licence']) from e
+            raise
+
+        # rows are read a chunk at a time, only the properties to change
+        # are kept for each rider. A rider can have rows in different
+        # chunks, so the changes are made once all the rows are read.
         rider_updates = {}
 
-        for row in csv.DictReader(csvfile):
+        for row in itertools.chain.from_iterable(reader):
 
             if fields['end_date'] not in row or \
                     row[fields['end_date']] is None or \
@@ -174,13 +189,8 @@ class RiderManager(models.Manager):
             else:
                 continue
 
-            # remove 'CA' from the licence number but check that it's there
-            # first
-            if fields['licence'] in row:
-                licenceno = row[fields['licence']][2:]
-            else:
-                # really want to throw an error here
-                raise ValueError("No field %s in uploaded spreadsheet" % fields['licence'])
+            # remove 'CA' from the licence number, the reader checked that it's there
+            licenceno = row[fields['licence']][2:]
 
             user = self.find_user(row[fields['email']], licenceno)
 
@@ -712,37 +722,35 @@ class PointScore(models.Model):
 
     def score(self, result, numberriders):
         """Calculate the points for this placing
-        according to the Waratah CC pointscore rules
+        according to the rules for this pointscore
 
         Return a tuple: (points, reason)
         where reason is a string explaining the score
         """
 
-        points = [7, 6, 5, 4, 3]
-        smallpoints = [5, 4]
-        participation = 2
         # is the rider eligible for promotion or riding down a grade
         promote = result.race.club.promotion(result.rider, when=result.race.date)
 
-        if not result.place:
-            return participation, "Participation"
-        if promote:
-            return participation, "Rider eligible for promotion"
-        if result.grade > result.usual_grade:
-            return participation, "Riding below normal grade"
-        if numberriders < 6:
-            # only 3 points to the winner
-            if result.place == 1:
-                return 3, "Placed 1 in small race < 6 riders"
-            return participation, "Participation, small race < 6 riders"
-        if numberriders <= 12:
-            if result.place - 1 < len(smallpoints):
-                return smallpoints[result.place - 1], "Placed %s in race <= 12 riders" % result.place
-            return participation, "Participation, race <= 12 riders"
-        else:
-            if result.place - 1 < len(points):
-                return points[result.place - 1], "Placed %s in race" % result.place
-            return participation, "Participation"
+        return self.points_for(result.place, result.grade, result.usual_grade, numberriders, promote)
+
+    def points_for(self, place, grade, usual_grade, numberriders, promote):
+        """Calculate the points for a placing given the details
+        of the result using the rules for this pointscore's method
+
+        Return a tuple: (points, reason)
+        """
+
+        return self.get_rules().score_grade([place], [grade > usual_grade], [promote], numberriders)[0]
+
+    def get_rules(self):
+        "Return the ScoringRules for the method of this pointscore"
+
+        from .scoring import rules_for
+
+        if not hasattr(self, 'ruleset'):
+            self.ruleset = rules_for(self)
+
+        return self.ruleset
 
     def get_points(self):
         "Return a list of integers from the points field"
@@ -771,10 +779,12 @@ class PointScore(models.Model):
         points, reason = self.score(result, number_in_grade)
 
         tally, created = PointscoreTally.objects.get_or_create(rider=result.rider, pointscore=self)
+        racepoints, created = PointscoreRacePoints.objects.get_or_create(rider=result.rider, pointscore=self, race=result.race)
 
         reason += " : " + str(result.race)
 
-        tally.add(points, reason)
+        tally.add(points, reason, race=result.race)
+        racepoints.add(points)
 
     def tally_helpers(self, race):
         """Add points for helpers in this race to the pointscore"""
@@ -786,41 +796,107 @@ class PointScore(models.Model):
 
         for staff in RaceStaff.objects.filter(race=race):
             tally, created = PointscoreTally.objects.get_or_create(rider=staff.rider, pointscore=self)
-            
-            in_this_race = False
-            if not created:
-                # staff has some results already, check if they are in this race
-                for reason in tally.audit_trail():
-                    if str(race) in reason[1]:
-                        in_this_race = True
+            racepoints, created = PointscoreRacePoints.objects.get_or_create(rider=staff.rider, pointscore=self, race=race)
+
             # if staff also got points for the race, they get a max
             # of 3 points for helping
-            if in_this_race:
-                points = 3 - tally.points
-            else:
-                points = 3
+            points = 3 - racepoints.points
 
             if points > 0:
                 reason = staff.role.name + " in race: " + str(race)
-                tally.add(points, reason)
+                tally.add(points, reason, race=race, reason_type='helper')
+                racepoints.add(points)
+
+        self.update_standings()
 
+    def rescore_race(self, race, grades=None):
+        """Replace the points tallied for one race with points
+        calculated from the current results for that race, leaving
+        the points from other races alone. If grades is given only
+        riders in those grades and helpers are rescored."""
+
+        from .scoring import PointscoreCalculator
+
+        PointscoreCalculator(self).rescore_race(race, grades)
 
     def recalculate(self):
-        """Recalculate all points from scratch"""
+        """Recalculate all points from scratch, this gives the same
+        tallies as calling tally and tally_helpers for every race in
+        date order but only needs a few queries"""
 
-        PointscoreTally.objects.filter(pointscore=self).delete()
+        from .scoring import PointscoreCalculator
 
-        for race in self.races.all().order_by('date'):
-            for result in race.raceresult_set.all():
-                self.tally(result)
-            # add points for helpers in this race
-            self.tally_helpers(race)
+        PointscoreCalculator(self).recalculate()
 
     def tabulate(self):
         """Generate a queryset of point tallys in order"""
 
         return self.results.all()
 
+    def update_standings(self):
+        """Rebuild the standings table from the current tallies,
+        needs to be called whenever the tallies change"""
+
+        tallies = self.results.select_related('rider__user', 'rider__club').order_by('-points', 'eventcount', 'id')
+
+        standings = []
+        for rank, tally in enumerate(tallies, 1):
+            rider = tally.rider
+            standings.append(PointscoreStanding(pointscore=self,
+                                                rider=rider,
+                                                rank=rank,
+                                                name=" ".join((rider.user.first_name, rider.user.last_name)),
+                                                userid=rider.user_id,
+                                                club=rider.club.slug if rider.club else "Unknown",
+                                                points=tally.points,
+                                                eventcount=tally.eventcount))
+
+        with transaction.atomic():
+            self.standings.all().delete()
+            PointscoreStanding.objects.bulk_create(standings)
+
+    def table(self):
+        """The standings with the current grade of each rider with
+        the club, looked up in the same query so that a regrade
+        shows straight away. The grade is None if a rider has more
+        than one, same as Club.grade"""
+
+        grades = ClubGrade.objects.filter(club=self.club_id, rider=OuterRef('rider_id')).values('rider') \
+                                  .annotate(count=Count('id'), only=Max('grade')).filter(count=1).values('only')
+        return self.standings.annotate(grade=Subquery(grades))
+
+    def rounds(self):
+        """The races in this pointscore in the order they are scored"""
+
+        return self.races.all().order_by('date', 'id')
+
+    def standings_after(self, race):
+        """Return the standings as they were after the given race,
+        summing the points stored for each race up to and including
+        this one. Rows are unsaved PointscoreStanding instances
+        with the current grade of each rider, as table."""
+
+        grades = self.club.grades()
+        rounds = self.racepoints.filter(Q(race__date__lt=race.date) | Q(race__date=race.date, race__id__lte=race.id))
+        totals = rounds.values('rider_id', 'rider__user_id', 'rider__user__first_name', 'rider__user__last_name',
+                               'rider__club__slug') \
+                       .annotate(total=Sum('points'), events=Sum('eventcount')) \
+                       .order_by('-total', 'events', 'rider_id')
+
+        standings = []
+        for rank, row in enumerate(totals, 1):
+            standing = PointscoreStanding(pointscore=self,
+                                          rider_id=row['rider_id'],
+                                          rank=rank,
+                                          name=" ".join((row['rider__user__first_name'], row['rider__user__last_name'])),
+                                          userid=row['rider__user_id'],
+                                          club=row['rider__club__slug'] or "Unknown",
+                                          points=row['total'],
+                                          eventcount=row['events'])
+            standing.grade = grades.get(row['rider_id'])
+            standings.append(standing)
+        return standings
+
     def audit(self, rider):
         """Generate an audit report for this rider on this pointscore"""
 
@@ -831,7 +907,21 @@ class PointScore(models.Model):
             return []
 
 
-class PointscoreTally(models.Model):
+AUDIT_REASON_CHOICES = (('result', 'Race Result'), ('helper', 'Helper'))
+
+
+class TallyBase(models.Model):
+    """Points and number of events, common to the season
+    tally and the points for a single race"""
+
+    class Meta:
+        abstract = True
+
+    points = models.IntegerField(default=0)
+    eventcount = models.IntegerField(default=0)
+
+
+class PointscoreTally(TallyBase):
     """An entry in the pointscore table for a rider"""
 
     class Meta:
@@ -839,35 +929,235 @@ class PointscoreTally(models.Model):
 
     rider = models.ForeignKey(Rider, on_delete=models.CASCADE)
     pointscore = models.ForeignKey(PointScore, related_name='results', on_delete=models.CASCADE)
-    points = models.IntegerField(default=0)
-    eventcount = models.IntegerField(default=0)
-    audit = models.TextField(default='[]')
 
     def __str__(self):
         return str(self.rider) + " " + str(self.points)
 
-    def _add_reason(self, points, reason):
-        """Add a new reason to the audit trail"""
+    def audit_trail(self):
+        """Return a list of reasons justifying the
+        points for this tally"""
+
+        return [[entry.points, entry.reason] for entry in self.entries.all()]
 
-        reasons = self.audit_trail()
+    def add(self, points, reason, race=None, reason_type='result'):
+        """Add points to the tally for a rider and record the reason"""
 
-        reasons.append((points, reason))
-        self.audit = json.dumps(reasons)
+        self.points += points
+        self.eventcount += 1
         self.save()
 
+        PointscoreAuditEntry.objects.create(tally=self, race=race, reason_type=reason_type,
+                                            points=points, reason=reason)
+
+
+class PointscoreStanding(TallyBase):
+    """A row of the pointscore table as shown to users, copied from
+    the tallies by PointScore.update_standings so that the table
+    can be shown without looking up riders and users. Grades change
+    without a rescore so PointScore.table adds them when reading."""
+
+    class Meta:
+        ordering = ['rank']
+        indexes = [models.Index(fields=['pointscore', 'rank'])]
+
+    pointscore = models.ForeignKey(PointScore, related_name='standings', on_delete=models.CASCADE)
+    rider = models.ForeignKey(Rider, on_delete=models.CASCADE)
+    rank = models.IntegerField()
+    name = models.CharField(max_length=300)
+    userid = models.IntegerField()
+    club = models.CharField(max_length=100)
+
+    def __str__(self):
+        return "%d %s %s" % (self.rank, self.name, str(self.points))
+
+
+class PointscoreRacePoints(TallyBase):
+    """The points a rider earned in one race of a pointscore,
+    the PointscoreTally for the rider is the sum of these over
+    all races.  Keeping them separately means that re-uploading
+    the results for a race only needs that race to be rescored."""
+
+    class Meta:
+        unique_together = (('pointscore', 'race', 'rider'),)
+
+    rider = models.ForeignKey(Rider, on_delete=models.CASCADE)
+    pointscore = models.ForeignKey(PointScore, related_name='racepoints', on_delete=models.CASCADE)
+    race = models.ForeignKey(Race, on_delete=models.CASCADE)
+
+    def __str__(self):
+        return "%s: %s %s" % (str(self.race), str(self.rider), str(self.points))
+
     def audit_trail(self):
         """Return a list of reasons justifying the
-        points for this tally"""
+        points for this race"""
 
-        reasons = json.loads(self.audit)
-        if reasons is None:
-            reasons = []
-        return reasons
+        entries = PointscoreAuditEntry.objects.filter(tally__pointscore=self.pointscore,
+                                                      tally__rider=self.rider,
+                                                      race=self.race)
+        return [[entry.points, entry.reason] for entry in entries]
 
-    def add(self, points, reason):
-        """Add points to the tally for a rider and record the reason"""
+    def add(self, points):
+        """Add points earned in this race"""
 
         self.points += points
-        self._add_reason(points, reason)
         self.eventcount += 1
         self.save()
+
+
+class PointscoreAuditEntry(models.Model):
+    """One reason for points in a rider's pointscore tally"""
+
+    class Meta:
+        ordering = ['race__date', 'race_id', 'id']
+        indexes = [models.Index(fields=['tally', 'race', 'reason_type'])]
+
+    tally = models.ForeignKey(PointscoreTally, related_name='entries', on_delete=models.CASCADE)
+    # null for entries carried over from the old audit trail that couldn't be matched to a race
+    race = models.ForeignKey(Race, null=True, blank=True, on_delete=models.CASCADE)
+    reason_type = models.CharField(max_length=10, choices=AUDIT_REASON_CHOICES, default='result')
+    points = models.IntegerField()
+    reason = models.CharField(max_length=300)
+
+    def __str__(self):
+        return "%s: %s" % (str(self.points), self.reason)
+
+
+JOB_STATUS_CHOICES = (('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed'))
+
+
+class PointscoreJobManager(models.Manager):
+    """Manager for pointscore jobs"""
+
+    @transaction.atomic
+    def queue(self, pointscore, race=None, grades=None):
+        """Queue a job to rescore one race in a pointscore, or to
+        recalculate the whole pointscore if race is None.
+        grades limits a race job to the riders in those grades.
+        If a pending job would already do the work, the request
+        is merged into it. Return the job that will do the work."""
+
+        # lock the pointscore so that concurrent requests merge properly
+        list(PointScore.objects.select_for_update().filter(pk=pointscore.pk))
+
+        pending = self.filter(pointscore=pointscore, status='pending')
+
+        # a pending recalculation covers any race
+        job = pending.filter(race__isnull=True).first()
+        if job is None and race is not None:
+            job = pending.filter(race=race).first()
+
+        if job is not None:
+            job.requests += 1
+            if job.race is not None:
+                if job.grades and grades:
+                    job.grades = ','.join(sorted(set(job.grades.split(',')) | set(grades)))
+                else:
+                    # one of them is for all grades
+                    job.grades = ''
+            job.save(update_fields=['requests', 'grades'])
+            return job
+
+        requests = 1
+        if race is None:
+            # a recalculation replaces any races waiting to be rescored
+            merged = pending.filter(race__isnull=False)
+            requests += sum(merged.values_list('requests', flat=True))
+            merged.delete()
+            grades = None
+
+        return self.create(pointscore=pointscore, race=race, requests=requests,
+                           grades=','.join(sorted(grades)) if grades else '')
+
+    def claim(self):
+        """Find the oldest pending job for a pointscore that doesn't
+        have a job running, mark it as running and return it.
+        Return None if there is nothing to do."""
+
+        for job in self.filter(status='pending').order_by('created', 'id'):
+            with transaction.atomic():
+                list(PointScore.objects.select_for_update().filter(pk=job.pointscore_id))
+
+                if self.filter(pointscore=job.pointscore_id, status='running').exists():
+                    continue
+
+                # another worker may have got here first
+                now = timezone.now()
+                if self.filter(pk=job.pk, status='pending').update(status='running', started=now, heartbeat=now):
+                    job.refresh_from_db()
+                    return job
+
+        return None
+
+    def release_stale(self, age):
+        """Mark running jobs whose worker hasn't sent a heartbeat
+        for longer than age (a timedelta) as failed, their worker
+        has probably died. Jobs that are still running keep sending
+        heartbeats however long they take."""
+
+        cutoff = timezone.now() - age
+        return self.filter(status='running').filter(
+            Q(heartbeat__lt=cutoff) | Q(heartbeat__isnull=True, started__lt=cutoff)).update(
+            status='failed', finished=timezone.now(), error='Worker stopped sending heartbeats')
+
+
+class PointscoreJob(models.Model):
+    """A request to rescore a pointscore, run in the background
+    by the pointscorejobs management command"""
+
+    objects = PointscoreJobManager()
+
+    class Meta:
+        ordering = ['-created', '-id']
+        indexes = [models.Index(fields=['pointscore', 'status'])]
+
+    pointscore = models.ForeignKey(PointScore, related_name='jobs', on_delete=models.CASCADE)
+    # the race to rescore, or None to recalculate the whole pointscore
+    race = models.ForeignKey(Race, null=True, blank=True, on_delete=models.CASCADE)
+    # comma separated grades to rescore in the race, blank for all of them
+    grades = models.CharField(max_length=100, blank=True, default='')
+    status = models.CharField(max_length=10, choices=JOB_STATUS_CHOICES, default='pending')
+    # number of requests merged into this job
+    requests = models.IntegerField(default=1)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    # updated regularly by the worker while the job is running
+    heartbeat = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True, default='')
+
+    def __str__(self):
+        if self.race is None:
+            return "Recalculate %s (%s)" % (str(self.pointscore), self.status)
+        else:
+            return "Rescore %s in %s (%s)" % (str(self.race), str(self.pointscore), self.status)
+
+    def grade_list(self):
+        """The grades to rescore, None for all of them"""
+
+        if self.grades:
+            return self.grades.split(',')
+        return None
+
+    def beat(self):
+        """Record that the worker running this job is still alive,
+        return False if the job is no longer running"""
+
+        return bool(PointscoreJob.objects.filter(pk=self.pk, status='running').update(heartbeat=timezone.now()))
+
+    def run(self):
+        """Do the work for this job, it should have been claimed
+        by PointscoreJob.objects.claim first"""
+
+        try:
+            if self.race is None:
+                self.pointscore.recalculate()
+            else:
+                self.pointscore.rescore_race(self.race, grades=self.grade_list())
+        except Exception:
+            self.status = 'failed'
+            self.error = traceback.format_exc()
+        else:
+            self.status = 'done'
+
+        self.finished = timezone.now()
+        self.save()
@@ -26,13 +26,15 @@ from django.contrib.auth.mixins import AccessMixin
 from django.core.mail import EmailMessage, BadHeaderError, get_connection
 from django.core.exceptions import ValidationError
 from django.contrib import messages
+from django.core.paginator import Paginator
 from anymail.exceptions import AnymailInvalidAddress
 from django.conf import settings
 
 from django.contrib.auth.models import User
 from races.apps.cabici.models import Race, Club
 from races.apps.cabici.usermodel import PointScore, Rider, RaceResult, ClubRole, RaceStaff, parse_img_members, UserRole, \
-    ClubGrade, PointscoreTally
+    ClubGrade, PointscoreTally, PointscoreAuditEntry, PointscoreJob
+from races.apps.cabici.scoring import PromotionIndex
 from races.apps.cabici.forms import RaceCreateForm, RaceCSVForm, RaceRiderForm, MembershipUploadForm, RiderSearchForm, \
     RiderUpdateForm, RiderUpdateFormOfficial, RacePublishDraftForm, ClubMemberEmailForm, RaceResultUpdateForm, \
     RaceResultAddForm, PointScoreAddForm
@@ -157,7 +159,13 @@ class ClubRidersPromotionView(ListView):
         slug = self.kwargs['slug']
         club = Club.objects.get(slug=slug)
         context['club'] = club
-        context['riders'] = club.promotable()
+
+        # one index gives us eligibility, grades and counts for every rider
+        today = datetime.date.today()
+        index = PromotionIndex([club.id], today, today)
+        context['riders'] = club.promotable(index=index)
+        context['promotion'] = [(rider, index.grade(club.id, rider.id), index.report(club.id, rider.id, today))
+                                for rider in context['riders']]
 
         return context
 
@@ -282,7 +290,16 @@ class ClubPointscoreView(DetailView):
         club = self.kwargs['slug']
 
         context['club'] = get_object_or_404(Club, slug=club)
-        context['races'] = Race.objects.filter(pointscore=self.object)
+        context['races'] = self.object.rounds().select_related('club', 'location')
+        context['jobs'] = self.object.jobs.select_related('race')[:5]
+
+        # ?after_race=<id> shows the standings as they were after that race
+        after_race = self.request.GET.get('after_race')
+        if after_race and after_race.isdigit():
+            context['after_race'] = get_object_or_404(context['races'], pk=after_race)
+            context['standings'] = self.object.standings_after(context['after_race'])[:100]
+        else:
+            context['standings'] = self.object.table()[:100]
 
         return context
 
@@ -294,7 +311,7 @@ class ClubPointscoreView(DetailView):
 
         pointscore = get_object_or_404(PointScore, pk=pk)
 
-        pointscore.recalculate()
+        PointscoreJob.objects.queue(pointscore)
 
         return HttpResponseRedirect(reverse('pointscore', kwargs={'slug': clubslug, 'pk': pk}))
 
@@ -302,6 +319,7 @@ class ClubPointscoreView(DetailView):
 class ClubPointscoreAuditView(DetailView):
     model = PointScore
     template_name = "pointscore_audit.html"
+    paginate_by = 100
 
     def get_context_data(self, **kwargs):
 
@@ -311,14 +329,23 @@ class ClubPointscoreAuditView(DetailView):
         rider = get_object_or_404(Rider, user__id__exact=self.kwargs['rider'])
         try:
             tally = PointscoreTally.objects.get(pointscore=self.object, rider=rider)
+            entries = tally.entries.all()
         except Exception as e:
             # print(e)
             tally = None
+            entries = PointscoreAuditEntry.objects.none()
+
+        # long audit trails are shown a page at a time
+        paginator = Paginator(entries, self.paginate_by)
+        page = paginator.get_page(self.request.GET.get('page'))
 
         context['club'] = Club.objects.get(slug=club)
         context['rider'] = rider
         context['tally'] = tally
-        context['audit'] = self.object.audit(rider)
+        context['audit'] = page.object_list
+        context['paginator'] = paginator
+        context['page_obj'] = page
+        context['is_paginated'] = page.has_other_pages()
 
         return context
 
@@ -643,6 +670,8 @@ class RaceDetailView(DetailView):
             if result.race.club.slug in result.rider.grades:
                 result.usual_grade = result.rider.grades[result.race.club.slug]
                 result.save()
+            # a repeat of the last upload is no longer the same as what we have
+            Race.objects.filter(pk=result.race_id).update(results_hash='')
             messages.add_message(self.request, messages.SUCCESS, "Result added", extra_tags='safe')
         else:
             # print(form.errors.as_data())
@@ -826,7 +855,7 @@ class RaceUploadExcelView(FormView):
 
         name, filetype = os.path.splitext(self.request.FILES['excelfile'].name)
 
-        if filetype not in ['.xls', 'xlsx']:
+        if filetype not in ['.xls', '.xlsx']:
             msgtext = 'Error: Unknown file type, please use .xls or .xlsx'
             messages.add_message(self.request, messages.ERROR, msgtext, extra_tags='safe')
         else:
@@ -903,6 +932,8 @@ class RaceRidersView(ListView):
             except IntegrityError:
                 # rider/number or number/grade already registered
                 pass
+            else:
+                Race.objects.filter(pk=entry.race_id).update(results_hash='')
 
         return HttpResponseRedirect(reverse('race_riders', kwargs=kwargs))
 
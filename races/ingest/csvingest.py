@@ -23,13 +23,14 @@ Created on Apr 15, 2013
 import datetime
 import re
 import csv
-import hashlib
+
+from races.ingest.scrape import race_hash
 
 def ingest(csvfile):
     """Return a list of dictionaries, one for each race"""
 
     races = []
-    h = open(csvfile, 'rU')
+    h = open(csvfile, newline='')
     reader = csv.DictReader(h)
 
     for row in reader:
@@ -42,7 +43,7 @@ def ingest(csvfile):
         race['location'] = row['Location']
         race['url'] = row['url']
         race['club'] = row['Club']
-        race['hash'] = hashlib.sha1(str(race)).hexdigest()
+        race['hash'] = race_hash(race)
         
         races.append(race)
     return races
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+#
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Fetch a page or calendar for race ingest with timeouts and retries.
+
+Every request has a connect and a read timeout so that one slow site
+can't hold up an ingest run. Connection errors, timeouts and server
+errors are retried with an exponential backoff, other errors are not.
+
+With a FetchCache the body, ETag, Last-Modified and a digest of the
+body of each URL are kept on disk. Requests are made conditional on
+the stored ETag and Last-Modified, and with only_changed fetch raises
+NotModified when the server answers 304 or sends the same body again
+so that the caller can skip parsing it. With offline the cached body
+is returned without going to the network at all.
+
+A fetched body is only staged in the cache, the caller commits it
+once the body has been parsed and saved. If that fails the old copy
+stays, so the next run fetches and parses it again rather than
+skipping it as unchanged. A body cached with a different key, eg.
+a different window of dates, is not treated as unchanged either.
+'''
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import requests
+
+USER_AGENT = 'cabici/1.0 event harvester http://cabici.net/'
+
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+RETRIES = 2
+BACKOFF = 1.0
+
+# responses worth trying again
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+class FetchError(Exception):
+    """A URL could not be fetched, status and content are the
+    HTTP status code and body if the server responded"""
+
+    def __init__(self, url, message, status=None, content=None):
+        super().__init__(message)
+        self.url = url
+        self.status = status
+        self.content = content
+
+
+class NotModified(Exception):
+    """The content of a URL hasn't changed since it was cached"""
+
+    def __init__(self, url):
+        super().__init__("Not modified: " + url)
+        self.url = url
+
+
+class FetchCache:
+    """Cache of fetched URLs in a directory, each URL has a
+    JSON file with its validators and a file with its body.
+    fetch stages what it fetches, commit writes it to disk."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.pending = {}
+
+    def session(self):
+        """A cache on the same directory with its own staged
+        changes, eg. for the fetches for one club"""
+
+        return FetchCache(self.directory)
+
+    def paths(self, url):
+        """The metadata and body file names for a URL"""
+
+        name = os.path.join(self.directory, hashlib.sha1(url.encode('utf-8')).hexdigest())
+        return name + ".json", name + ".body"
+
+    def get(self, url):
+        """The stored metadata for a URL or None"""
+
+        metaname, bodyname = self.paths(url)
+        try:
+            with open(metaname) as fd:
+                meta = json.load(fd)
+        except (OSError, ValueError):
+            return None
+        return meta if os.path.exists(bodyname) else None
+
+    def body(self, url):
+        """The stored body of a URL"""
+
+        with open(self.paths(url)[1], 'rb') as fd:
+            return fd.read()
+
+    def stage(self, url, content, etag=None, last_modified=None, key=None):
+        """Keep the body and validators for a URL until commit,
+        return the metadata that will be stored"""
+
+        meta = {'url': url,
+                'etag': etag,
+                'last_modified': last_modified,
+                'digest': hashlib.sha256(content).hexdigest(),
+                'key': key,
+                'fetched': time.time()}
+        self.pending[url] = (content, meta)
+        return meta
+
+    def commit(self):
+        """Write everything staged since the last commit"""
+
+        if self.pending:
+            os.makedirs(self.directory, exist_ok=True)
+        for url, (content, meta) in self.pending.items():
+            metaname, bodyname = self.paths(url)
+            # write then rename so that a reader never sees part of a file
+            for name, data in ((bodyname, content), (metaname, json.dumps(meta).encode('utf-8'))):
+                fd, tmpname = tempfile.mkstemp(dir=self.directory)
+                with os.fdopen(fd, 'wb') as tmp:
+                    tmp.write(data)
+                os.replace(tmpname, name)
+        self.pending = {}
+
+
+def fetch(url, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, retries=RETRIES, backoff=BACKOFF,
+          cache=None, only_changed=False, offline=False, key=None):
+    """Return the content of a URL as bytes, file: URLs are read
+    from the local filesystem. Raise FetchError if it can't be read.
+    cache is a FetchCache to make conditional requests with and to
+    stage the content in, raise NotModified if only_changed and the
+    content and key are the same as the cached copy. key is a list
+    or string saying how the content will be read, eg. a window of
+    dates. If offline return the cached copy without a request."""
+
+    if url.startswith('file:'):
+        try:
+            with open(url[len('file:'):], 'rb') as fd:
+                return fd.read()
+        except OSError as e:
+            raise FetchError(url, str(e)) from e
+
+    cached = cache.get(url) if cache is not None else None
+    if offline:
+        if cached is None:
+            raise FetchError(url, "Not in the cache")
+        return cache.body(url)
+
+    headers = {'User-Agent': USER_AGENT}
+    if cached is not None:
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+    same_key = cached is not None and cached.get('key') == key
+
+    attempt = 0
+    while True:
+        try:
+            response = requests.get(url, headers=headers, timeout=(connect_timeout, read_timeout))
+            if response.status_code == 304 and cached is not None:
+                if only_changed and same_key:
+                    raise NotModified(url)
+                content = cache.body(url)
+                cache.stage(url, content, cached['etag'], cached['last_modified'], key)
+                return content
+            if response.status_code < 400:
+                if cache is not None:
+                    meta = cache.stage(url, response.content, response.headers.get('ETag'),
+                                       response.headers.get('Last-Modified'), key)
+                    if only_changed and same_key and cached['digest'] == meta['digest']:
+                        raise NotModified(url)
+                return response.content
+            if response.status_code not in RETRY_STATUS or attempt >= retries:
+                raise FetchError(url, "HTTP error %d" % response.status_code,
+                                 response.status_code, response.content)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt >= retries:
+                raise FetchError(url, str(e)) from e
+        except requests.RequestException as e:
+            raise FetchError(url, str(e)) from e
+
+        time.sleep(backoff * 2 ** attempt)
+        attempt += 1
@@ -0,0 +1,148 @@
+#!/usr/bin/python
+#
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Read only the events we want from an icalendar feed.
+
+Some feeds carry years of history and hundreds of events, parsing all
+of them into icalendar components is most of the cost of ingesting
+them. read_calendar goes through the feed a VEVENT block at a time and
+looks at the raw DTSTART and SUMMARY lines to drop events outside a
+date window or that can't match the title patterns. Only the events
+kept, with the timezones they need, are parsed by icalendar.
+'''
+
+import datetime
+import io
+
+import icalendar
+
+# times in a feed may be UTC or in any timezone, so events a day
+# either side of the window are kept for the caller to check
+SLACK = datetime.timedelta(days=1)
+
+
+def logical_lines(text):
+    """The lines of an icalendar file with folded lines joined"""
+
+    line = None
+    for raw in io.BytesIO(text):
+        raw = raw.rstrip(b'\r\n')
+        if raw[:1] in (b' ', b'\t') and line is not None:
+            line += raw[1:]
+            continue
+        if line is not None:
+            yield line
+        line = raw
+    if line:
+        yield line
+
+
+def split_property(line):
+    """Split a content line into its upper case name, including
+    any parameters, and its value"""
+
+    quoted = False
+    for i, c in enumerate(line):
+        if c == ord('"'):
+            quoted = not quoted
+        elif c == ord(':') and not quoted:
+            return line[:i].upper(), line[i+1:]
+    return line.upper(), b''
+
+
+def blocks(text):
+    """Yield (name, lines) for each top level component in a
+    calendar, name is eg. b'VEVENT' or b'VTIMEZONE'. Raise
+    ValueError if the text isn't a calendar."""
+
+    lines = logical_lines(text)
+    for line in lines:
+        if line.strip():
+            if line.strip().upper() != b'BEGIN:VCALENDAR':
+                raise ValueError("Not an icalendar file")
+            break
+    else:
+        raise ValueError("Empty icalendar file")
+
+    block = None
+    depth = 0
+    for line in lines:
+        name, value = split_property(line)
+        if name == b'BEGIN':
+            depth += 1
+            if depth == 1:
+                block = []
+        if block is not None:
+            block.append(line)
+        if name == b'END':
+            depth -= 1
+            if depth == 0 and block is not None:
+                yield block[0][len(b'BEGIN:'):].strip().upper(), block
+                block = None
+
+
+def event_date(block):
+    """The date of the DTSTART of an event block or None"""
+
+    for line in block:
+        name, value = split_property(line)
+        if name.split(b';')[0] == b'DTSTART':
+            try:
+                return datetime.date(int(value[0:4]), int(value[4:6]), int(value[6:8]))
+            except ValueError:
+                return None
+    return None
+
+
+def event_summary(block):
+    """The raw SUMMARY of an event block"""
+
+    for line in block:
+        name, value = split_property(line)
+        if name.split(b';')[0] == b'SUMMARY':
+            return value.decode('utf-8', errors='replace')
+    return ''
+
+
+def read_calendar(text, window=None, patterns=None):
+    """Parse the events in a calendar that start within window, a
+    pair of dates (first, last), give or take a day, and whose title
+    contains one of patterns. Either may be None to keep everything.
+    Return an icalendar.Calendar with just those events."""
+
+    patterns = [p for p in patterns or [] if p]
+    timezones = []
+    events = []
+
+    for name, block in blocks(text):
+        if name == b'VTIMEZONE':
+            timezones.append(block)
+        elif name == b'VEVENT':
+            if window is not None:
+                start = event_date(block)
+                if start is not None and not window[0] - SLACK <= start <= window[1] + SLACK:
+                    continue
+            if patterns and not any(p in event_summary(block) for p in patterns):
+                continue
+            events.append(block)
+
+    lines = [b'BEGIN:VCALENDAR']
+    for block in timezones + events:
+        lines.extend(block)
+    lines.append(b'END:VCALENDAR')
+
+    return icalendar.Calendar.from_ical(b'\r\n'.join(lines))
@@ -25,36 +25,36 @@ import datetime, time
 year = datetime.date.fromtimestamp(time.time()).year
 LACC_URL = 'http://lacc.org.au/index.php?option=com_jevents&task=year.listevents&year=%s' % year
 
-import urllib.request, urllib.error, urllib.parse
 from urllib.parse import urljoin
-from bs4 import BeautifulSoup
 import re
-import hashlib
 
+from races.ingest.fetch import fetch, FetchError
+from races.ingest.scrape import select, race_hash
 
-def ingest():
-    """Return a list of dictionaries, one for each race"""
+
+def ingest(**options):
+    """Return a list of dictionaries, one for each race,
+    options are passed on to fetch"""
 
     #(lacc, created) = Club.objects.get_or_create(name="Lidcombe Auburn Cycling Club", slug='LACC', url="http://www.lacc.org.au/")
     
     try:
-        req = urllib.request.Request(LACC_URL)
-        req.add_header('User-Agent', 'cabici/1.0 event harvester http://cabici.net/')
-        h = urllib.request.urlopen(req)
-        webtext = h.read()
-        h.close()
-    except urllib.error.HTTPError as e:
-        content = e.read()
-        if e.code == 418:
-            webtext = content
-        else:  
-            return ([], "Error reading icalendar URL:" + content[1:20])
-    except urllib.error.URLError as e:
-        return ([], "Bad URL: " + self.icalurl)
-        
+        webtext = fetch(LACC_URL, **options)
+    except FetchError as e:
+        # the site responds "I'm a teapot" but still sends the page
+        if e.status == 418:
+            webtext = e.content
+        else:
+            raise
+
+    return parse_web_text(webtext)
+
+
+def parse_web_text(webtext):
+    """Parse the LACC events page and return a list of
+    dictionaries, one for each race"""
 
-    soup = BeautifulSoup(webtext, "lxml")
-    events = soup.find_all('li', class_='ev_td_li')
+    events = select(webtext, 'li', class_='ev_td_li').find_all('li', class_='ev_td_li')
     
     
     if len(events) == 0:
@@ -96,7 +96,7 @@ def ingest():
         # use title for location since it's generally in there
         race['location'] = race['title']
         
-        race['hash'] = hashlib.sha1(str(race)).hexdigest()
+        race['hash'] = race_hash(race)
         
         if race['type'] != 'Meeting' and not 'Training' in race['type']:
             races.append(race)
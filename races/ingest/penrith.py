@@ -22,19 +22,26 @@ Created on Apr 15, 2013
 CALENDAR_URL = 'http://penrithp.ipower.com/calendar.php'
 LOCATION = "Penrith Regatta Centre"
 
-import urllib.request, urllib.error, urllib.parse
-from bs4 import BeautifulSoup
 import datetime
 import re
-import hashlib
 
+from races.ingest.fetch import fetch
+from races.ingest.scrape import select, race_hash
 
-def ingest():
-    """Return a list of dictionaries, one for each race"""
 
-    webtext = urllib.request.urlopen(CALENDAR_URL).read()
-    soup = BeautifulSoup(webtext, "lxml")
-    tables = soup.find_all('table')
+def ingest(**options):
+    """Return a list of dictionaries, one for each race,
+    options are passed on to fetch"""
+
+    webtext = fetch(CALENDAR_URL, **options)
+    return parse_web_text(webtext)
+
+
+def parse_web_text(webtext):
+    """Parse the Penrith calendar page and return a list of
+    dictionaries, one for each race"""
+
+    tables = select(webtext, 'table').find_all('table')
 
     if len(tables) < 6:
         print("No events found in Penrith's web page")
@@ -75,7 +82,7 @@ def ingest():
         
         race['title'] = info
         race['location'] = LOCATION
-        race['hash'] = hashlib.sha1(str(race)).hexdigest()
+        race['hash'] = race_hash(race)
         
         races.append(race)
         
@@ -0,0 +1,129 @@
+#!/usr/bin/python
+#
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+The sources races are ingested from.
+
+A club either publishes an icalendar feed, given by its icalurl, or
+has a parser in races.ingest registered here under its slug. Each
+source says what kind it is and how often it should be fetched so
+that a scheduled ingest can skip sources that aren't due.
+
+The registry is built once when this module is imported. Parser
+modules are only imported the first time a source is used, so a run
+that only reads calendars never loads the scrapers.
+'''
+
+import datetime
+from importlib import import_module
+
+ICAL = 'ical'
+SCRAPER = 'scraper'
+CSV = 'csv'
+KINDS = (ICAL, SCRAPER, CSV)
+
+# how often each kind of source is fetched unless it says otherwise
+INTERVALS = {ICAL: datetime.timedelta(hours=12),
+             SCRAPER: datetime.timedelta(days=1),
+             CSV: datetime.timedelta(days=7)}
+
+
+class IngestSource:
+    """A source of races for a club, module is the dotted name of
+    the parser module, it must have an ingest(**options) function
+    that returns a list of race dictionaries"""
+
+    def __init__(self, slug, kind, module=None, interval=None):
+        if kind not in KINDS:
+            raise ValueError("Unknown ingest source kind %s" % kind)
+        if kind != ICAL and module is None:
+            raise ValueError("A %s source needs a parser module" % kind)
+
+        self.slug = slug.lower()
+        self.kind = kind
+        self.module = module
+        self.interval = interval or INTERVALS[kind]
+        self._parser = None
+
+    def __repr__(self):
+        return "<IngestSource %s %s>" % (self.slug, self.kind)
+
+    @property
+    def parser(self):
+        """The parser module, imported on first use"""
+
+        if self._parser is None:
+            self._parser = import_module(self.module)
+        return self._parser
+
+    def ingest(self, **options):
+        """Fetch and parse the races from this source,
+        options are passed on to races.ingest.fetch.fetch"""
+
+        return self.parser.ingest(**options)
+
+    def is_due(self, last, now=None):
+        """True if a source last fetched at last, a datetime or
+        None if never, should be fetched again"""
+
+        if last is None:
+            return True
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        return now - last >= self.interval
+
+
+_registry = {}
+
+
+def register(slug, kind, module=None, interval=None):
+    """Register the ingest source for the club with this slug,
+    return the IngestSource"""
+
+    source = IngestSource(slug, kind, module, interval)
+    _registry[source.slug] = source
+    return source
+
+
+def unregister(slug):
+    """Remove the source for a club slug if there is one"""
+
+    _registry.pop(slug.lower(), None)
+
+
+def get(slug):
+    """The registered source for a club slug or None"""
+
+    return _registry.get(slug.lower())
+
+
+def sources():
+    """All registered sources ordered by slug"""
+
+    return [_registry[slug] for slug in sorted(_registry)]
+
+
+def source_for(club):
+    """The source for a club, its calendar if it has an icalurl,
+    otherwise its registered parser, or None"""
+
+    if club.icalurl:
+        return IngestSource(club.slug, ICAL)
+    return get(club.slug)
+
+
+register('lacc', SCRAPER, 'races.ingest.lacc')
+register('penrith', SCRAPER, 'races.ingest.penrith')
+register('waratahs', SCRAPER, 'races.ingest.waratahs')
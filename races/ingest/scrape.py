@@ -0,0 +1,51 @@
+#!/usr/bin/python
+#
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+Helpers shared by the web page scrapers in races.ingest.
+
+The scrapers only want a few elements from a page, eg. the rows of one
+table, so select builds a tree of just those elements with a
+SoupStrainer rather than the whole document. race_hash gives a hash
+that is the same on every run for the same race details.
+'''
+
+import hashlib
+import json
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+try:
+    import lxml
+    PARSER = 'lxml'
+except ImportError:
+    PARSER = 'html.parser'
+
+
+def select(webtext, name, **attrs):
+    """Parse only the elements of a page with this tag name and
+    attributes, eg. select(text, 'table', class_='events'),
+    return a BeautifulSoup tree containing just those elements"""
+
+    return BeautifulSoup(webtext, PARSER, parse_only=SoupStrainer(name, **attrs))
+
+
+def race_hash(*parts):
+    """A stable hash of race details, each part is a string
+    or a dictionary"""
+
+    text = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
@@ -21,11 +21,11 @@ Created on Apr 15, 2013
 '''
 WARATAH_URL = 'http://www.waratahmasters.com.au/eventsmenu.cfm'
 
-import urllib.request, urllib.error, urllib.parse
-from bs4 import BeautifulSoup
 import datetime
 import re
-import hashlib
+
+from races.ingest.fetch import fetch
+from races.ingest.scrape import select, race_hash
 
 
 def parse_times(times):
@@ -60,8 +60,7 @@ def parse_web_text(webtext):
     """Parse the content scraped from the Waratahs web page and return
     a list of dictionaries, one for each race"""
     
-    soup = BeautifulSoup(webtext, "lxml")
-    tables = soup.find_all('table', class_='raceroster_table')
+    tables = select(webtext, 'table', class_='raceroster_table').find_all('table', class_='raceroster_table')
 
     if len(tables) == 0:
         print("No table found in Waratah's web page")
@@ -94,27 +93,20 @@ def parse_web_text(webtext):
                 race['url'] = WARATAH_URL
                 # hash will change if this row changes, include time since we split some rows
                 # into two races
-                race['hash'] = hashlib.sha1(str(row)+time[0]).hexdigest()
+                race['hash'] = race_hash(row.get_text('|', strip=True), time[0])
                 
                 races.append(race)
     return races
 
 
 
-def ingest():
-    """Return a list of dictionaries, one for each race"""
+def ingest(**options):
+    """Return a list of dictionaries, one for each race,
+    options are passed on to fetch"""
+
+    webtext = fetch(WARATAH_URL, **options)
+    return parse_web_text(webtext)
 
-    try:
-        webtext = urllib.request.urlopen(WARATAH_URL).read()
-        return parse_web_text(webtext)
-    except urllib.error.HTTPError as e:
-        content = e.read()
-        print("HTTP Error: ", content)
-        return []
-    except urllib.error.URLError as e:
-        print("URLError: ", e)
-        return []
-        
 
 if __name__ == '__main__':
 
@@ -195,10 +195,15 @@ REST_FRAMEWORK = {
     ],
 }
 
-# Saving JSON result uploads for debugging
+# Saving JSON result uploads for debugging, they are written to per-day
+# compressed archives in this directory, see races.apps.cabici.archive
 SAVE_RESULT_UPLOADS = True
 SAVE_RESULT_UPLOADS_DIR = 'result-uploads'
 
+# Calendars and pages fetched by the ingest command are cached here
+# so that unchanged sources can be skipped, see races.ingest.fetch
+INGEST_CACHE_DIR = 'ingest-cache'
+
 # A sample logging configuration. The only tangible logging
 # performed by this configuration is to send an email to
 # the site admins on every HTTP 500 error when DEBUG=False.
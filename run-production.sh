@@ -1,4 +1,5 @@
 docker pull waratahmasters.races:latest
-docker stop cabici
-docker rm cabici
-docker run -d --env-file env.prod -p 8000:8000   --restart unless-stopped  --name cabici waratahmasters.races:latest gunicorn -c ./gunicorn.config.py  races.wsgi
\ No newline at end of file
+docker stop cabici cabici-worker
+docker rm cabici cabici-worker
+docker run -d --env-file env.prod -p 8000:8000   --restart unless-stopped  --name cabici waratahmasters.races:latest gunicorn -c ./gunicorn.config.py  races.wsgi
+docker run -d --env-file env.prod   --restart unless-stopped  --name cabici-worker waratahmasters.races:latest python bin/production.py pointscorejobs
\ No newline at end of file